@@ -0,0 +1,44 @@
+"""Track row updates for incremental cache sync
+
+Revision ID: 3b9d6c1e7a42
+Revises: 8f0a40c45e57
+Create Date: 2026-10-18 10:12:03.114520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9d6c1e7a42'
+down_revision = '8f0a40c45e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+    CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS TRIGGER AS $$
+    BEGIN
+      NEW.updated_at = now();
+      RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+    """)
+    for table in ['listeners', 'beacons']:
+        op.add_column(table, sa.Column(
+            'updated_at', sa.DateTime(timezone=True), nullable=False,
+            server_default=sa.func.now()))
+        op.create_index('{}_updated_at'.format(table), table, ['updated_at'])
+        op.execute("""
+        CREATE TRIGGER touch_{0}_updated_at BEFORE UPDATE ON {0}
+          FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+        """.format(table))
+
+
+def downgrade():
+    for table in ['listeners', 'beacons']:
+        op.execute("DROP TRIGGER touch_{0}_updated_at ON {0}".format(table))
+        op.drop_index('{}_updated_at'.format(table), table)
+        op.drop_column(table, 'updated_at')
+    op.execute("DROP FUNCTION touch_updated_at()")
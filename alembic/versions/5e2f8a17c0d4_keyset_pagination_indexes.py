@@ -0,0 +1,27 @@
+"""Index last_seen for keyset pagination
+
+Revision ID: 5e2f8a17c0d4
+Revises: c71e5a0d9f3b
+Create Date: 2026-10-18 12:20:41.502873
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2f8a17c0d4'
+down_revision = 'c71e5a0d9f3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Must match db.seen_order for the planner to use them
+    for table in ['listeners', 'beacons']:
+        op.execute("CREATE INDEX {0}_seen_id ON {0} "
+                   "(coalesce(last_seen, to_timestamp(0)), id)".format(table))
+
+
+def downgrade():
+    for table in ['listeners', 'beacons']:
+        op.drop_index('{}_seen_id'.format(table), table_name=table)
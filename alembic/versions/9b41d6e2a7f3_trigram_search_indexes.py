@@ -0,0 +1,32 @@
+"""Trigram indexes for name and id search
+
+Revision ID: 9b41d6e2a7f3
+Revises: 5e2f8a17c0d4
+Create Date: 2026-10-18 15:02:17.318840
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9b41d6e2a7f3'
+down_revision = '5e2f8a17c0d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Must match search.search_clause, which LIKEs lower(column)
+    for table in ['listeners', 'beacons']:
+        for column in ['name', 'id']:
+            op.execute("CREATE INDEX {0}_{1}_trgm ON {0} "
+                       "USING gin (lower({1}) gin_trgm_ops)".format(
+                           table, column))
+
+
+def downgrade():
+    for table in ['listeners', 'beacons']:
+        for column in ['name', 'id']:
+            op.drop_index('{}_{}_trgm'.format(table, column),
+                          table_name=table)
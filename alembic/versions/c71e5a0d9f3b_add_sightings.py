@@ -0,0 +1,36 @@
+"""Add partitioned sightings table
+
+Revision ID: c71e5a0d9f3b
+Revises: 3b9d6c1e7a42
+Create Date: 2026-10-18 11:02:45.380117
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c71e5a0d9f3b'
+down_revision = '3b9d6c1e7a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Declarative partitioning is not expressible with op.create_table
+    op.execute("""
+    CREATE TABLE sightings (
+      beacon_id varchar NOT NULL,
+      listener_id varchar NOT NULL,
+      distance float NOT NULL,
+      variance float NOT NULL,
+      timestamp timestamp with time zone NOT NULL
+    ) PARTITION BY RANGE (timestamp);
+    """)
+    op.execute("CREATE TABLE sightings_default PARTITION OF sightings DEFAULT")
+    op.create_index('sightings_beacon_id_timestamp', 'sightings',
+                    ['beacon_id', 'timestamp'])
+
+
+def downgrade():
+    # Drops the daily partitions with it
+    op.drop_table('sightings')
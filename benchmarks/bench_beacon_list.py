@@ -0,0 +1,105 @@
+"""Latency of the /beacons JSON response against the old path (beacon
+select, listener IN query, a Beacon per row and a json.dumps each).
+
+Needs a migrated database at DB_URL; it writes listeners and beacons
+with ids starting 'bench' and deletes them again.
+
+Run with: python benchmarks/bench_beacon_list.py
+"""
+from __future__ import print_function
+
+import json
+import os
+import time
+from datetime import datetime
+
+from pytz import UTC
+from twisted.internet import defer, task
+from twisted.web.test.requesthelper import DummyRequest
+
+from c3next import db
+from c3next.models import Beacon, BytesEncoder
+from c3next.web import b_list, count_pages, model_rp, query_filter
+
+BEACONS = 5000
+LISTENERS = 50
+PAGE_SIZES = [20, 200, 2000]
+ROUNDS = 20
+
+
+class StreamingRequest(DummyRequest):
+    """ DummyRequest drives every producer as a pull producer """
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+def json_request(per_page):
+    request = StreamingRequest([b'beacons'])
+    request.args = {b'limit': [str(per_page).encode()]}
+    request.requestHeaders.setRawHeaders('Accept', ['application/json'])
+    return request
+
+
+@defer.inlineCallbacks
+def legacy_b_list(request):
+    conn = yield db.get_connection()
+    query, pagination, search, where = query_filter(
+        request, db.beacons.select(),
+        search_fields=[db.beacons.c.name, db.beacons.c.id],
+        table=db.beacons)
+    cur = yield conn.execute(query)
+    results = yield cur.fetchall()
+    yield count_pages(db.beacons, where, pagination, conn)
+    beacons = model_rp(pagination['keyset'].page(results, pagination),
+                       Beacon)
+    query = db.listeners.select().where(db.listeners.c.id.in_(
+        [b['listener_id'] for b in beacons if b['listener_id']]))
+    cur = yield conn.execute(query)
+    yield cur.fetchall()
+    yield conn.close()
+    defer.returnValue(json.dumps([b.flatten() for b in beacons],
+                                 cls=BytesEncoder))
+
+
+@defer.inlineCallbacks
+def timed(name, per_page, func):
+    latencies = []
+    for _ in range(ROUNDS):
+        start = time.time()
+        yield func(json_request(per_page))
+        latencies.append(time.time() - start)
+    latencies.sort()
+    print("{:>5} rows {:>7}: p50 {:7.2f} ms  p95 {:7.2f} ms".format(
+        per_page, name, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    now = datetime.now(tz=UTC)
+    conn = yield db.get_connection()
+    try:
+        yield conn.execute(db.listeners.insert(), [
+            {'id': u'bench{:04d}'.format(i), 'name': u'Bench {}'.format(i),
+             'last_seen': now} for i in range(LISTENERS)])
+        yield conn.execute(db.beacons.insert(), [
+            {'id': u'bench{:08d}'.format(i), 'name': u'Beacon {}'.format(i),
+             'listener_id': u'bench{:04d}'.format(i % LISTENERS),
+             'key': os.urandom(16), 'dk': 0, 'clock': 0, 'last_seen': now}
+            for i in range(BEACONS)])
+        for per_page in PAGE_SIZES:
+            yield timed('legacy', per_page, legacy_b_list)
+            yield timed('joined', per_page, b_list)
+    finally:
+        yield conn.execute(db.beacons.delete().where(
+            db.beacons.c.id.like(u'bench%')))
+        yield conn.execute(db.listeners.delete().where(
+            db.listeners.c.id.like(u'bench%')))
+        yield conn.close()
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,45 @@
+"""Memory held per cached Beacon.
+
+Run with: python benchmarks/bench_container_memory.py
+"""
+from __future__ import print_function
+
+import os
+import time
+import tracemalloc
+from binascii import hexlify
+
+from c3next.models import Beacon
+
+N = 100000
+
+
+def make_beacons(n):
+    now = time.time()
+    beacons = {}
+    for i in range(n):
+        b_id = os.urandom(6)
+        b = Beacon()
+        b.update({'id': hexlify(b_id), 'name': u'Beacon', 'key': b'k' * 16,
+                  'dk': i, 'clock': i, 'clock_origin': 0.0,
+                  'listener_id': u'Listener', 'last_seen': now})
+        beacons[b_id] = b
+    return beacons
+
+
+def main():
+    # Values shared by all beacons are allocated before measuring, so
+    # only the per-object overhead (plus ids and ints) is counted
+    make_beacons(1)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    beacons = make_beacons(N)
+    Beacon.drain_dirty()
+    after = tracemalloc.take_snapshot()
+    total = sum(s.size_diff for s in after.compare_to(before, 'filename'))
+    print("{} beacons: {:.0f} bytes per beacon".format(
+        len(beacons), total / len(beacons)))
+
+
+if __name__ == '__main__':
+    main()
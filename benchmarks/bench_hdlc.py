@@ -0,0 +1,99 @@
+"""Compare the per-byte HDLC receive loop with HDLCDeframer, and the
+single-frame functions with the batch ones.
+
+Run with: python benchmarks/bench_hdlc.py
+"""
+from __future__ import print_function
+
+import random
+import timeit
+
+from c3next.hdlc import (hdlc_frame, hdlc_unframe, hdlc_frame_many,
+                         hdlc_unframe_many, HDLCDeframer, HDLCInvalidFrame)
+
+# A burst of SECURE packets, as a busy listener would send them
+RANDOM = random.Random(0)
+PACKET = b'\x02\x00\x06' + bytes(bytearray(
+    RANDOM.getrandbits(8) for _ in range(45)))
+CHUNK = b''.join(hdlc_frame(PACKET) for _ in range(100))
+ROUNDS = 200
+
+
+def legacy_unframe(frame):
+    """hdlc_unframe as it was before slice-level unescaping."""
+    frame = bytearray(frame)
+    if not frame[0] == frame[-1] == 0x7e:
+        raise HDLCInvalidFrame("Missing flags")
+    frame = frame.strip(b'\x7e')
+    if 0x7e in frame:
+        raise HDLCInvalidFrame("Unescaped FLAG found")
+    data = bytearray()
+    i = 0
+    while i < len(frame):
+        if frame[i] == 0x7d:
+            i += 1
+            if i == len(frame):
+                raise HDLCInvalidFrame("Incomplete escape sequence")
+            data.append(frame[i] | (1 << 5))
+        else:
+            data.append(frame[i])
+        i += 1
+    return bytes(data)
+
+
+def per_byte(chunk):
+    """The receive loop ListenerProtocol.dataReceived used to run."""
+    buf = bytearray()
+    packets = []
+    for byte in bytearray(chunk):
+        buf.append(byte)
+        if byte == 0x7e:
+            if len(buf) > 1:
+                try:
+                    packet = legacy_unframe(buf)
+                except HDLCInvalidFrame:
+                    return packets
+                if len(packet) > 0:
+                    packets.append(packet)
+                    buf = bytearray()
+    return packets
+
+
+def deframer(chunk):
+    return list(HDLCDeframer().feed(chunk))
+
+
+def frame_each(packets):
+    return b''.join(hdlc_frame(p) for p in packets)
+
+
+def unframe_each(frames):
+    return [hdlc_unframe(f) for f in frames]
+
+
+def report(name, nbytes, t):
+    print("{:>18}: {:8.1f} MB/s".format(name, nbytes * ROUNDS / t / 1e6))
+
+
+def main():
+    print("Receive path")
+    assert per_byte(CHUNK) == deframer(CHUNK)
+    for func in (per_byte, deframer):
+        report(func.__name__, len(CHUNK),
+               timeit.timeit(lambda: func(CHUNK), number=ROUNDS))
+
+    print("Batch framing")
+    packets = [PACKET] * 100
+    frames = [hdlc_frame(p) for p in packets]
+    assert frame_each(packets) == hdlc_frame_many(packets)
+    assert unframe_each(frames) == hdlc_unframe_many(CHUNK)
+    for name, func, arg in [('hdlc_frame', frame_each, packets),
+                            ('hdlc_frame_many', hdlc_frame_many, packets),
+                            ('hdlc_unframe', unframe_each, frames),
+                            ('hdlc_unframe_many', hdlc_unframe_many, CHUNK)]:
+        report(name, len(CHUNK),
+               timeit.timeit(lambda: func(arg), number=ROUNDS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""listener_id writes and beacon_logs rows with the location engine
+against "last listener wins", for beacons heard by three listeners.
+
+Every beacon sits at fixed true distances from three listeners, each
+of which reports it about once a second with gaussian noise. The
+persistence tick runs every SYNC_INTERVAL seconds; a beacon whose
+listener_id differs from the last persisted one costs a listener_id
+write there, and fires the beacon_logs trigger.
+
+Run with: python benchmarks/bench_location.py
+"""
+from __future__ import division, print_function
+
+import random
+import time
+import sys
+
+from c3next.config import SYNC_INTERVAL
+from c3next.location import LocationEngine
+
+BEACONS = 500
+LISTENERS = [u'L1', u'L2', u'L3']
+SECONDS = 120
+VARIANCE = 0.5
+
+
+def simulate(rng):
+    """ (time, beacon, listener, distance) in time order, and the
+    nearest listener of each beacon """
+    true = {b: [rng.uniform(1, 6) for _ in LISTENERS]
+            for b in range(BEACONS)}
+    sightings = []
+    for b in range(BEACONS):
+        for (i, l_id) in enumerate(LISTENERS):
+            t = rng.random()
+            while t < SECONDS:
+                sightings.append((t, b, l_id, max(
+                    0.1, rng.gauss(true[b][i], VARIANCE ** 0.5))))
+                t += rng.uniform(0.5, 1.5)
+    sightings.sort()
+    nearest = {b: LISTENERS[d.index(min(d))] for (b, d) in true.items()}
+    return sightings, nearest
+
+
+def count_writes(sightings, nearest, locate):
+    """ listener_id writes over the ticks, and the share of persisted
+    listener_ids that were the nearest listener """
+    current, persisted = {}, {}
+    writes = right = total = 0
+    next_tick = SYNC_INTERVAL
+    for (t, b, l_id, distance) in sightings:
+        while t >= next_tick:
+            for (beacon, listener) in current.items():
+                if persisted.get(beacon) != listener:
+                    writes += 1
+                    persisted[beacon] = listener
+                right += listener == nearest[beacon]
+                total += 1
+            next_tick += SYNC_INTERVAL
+        current[b] = locate(b, l_id, distance, t)
+    return writes, right / total
+
+
+if __name__ == '__main__':
+    sightings, nearest = simulate(random.Random(0))
+    print("{} sightings of {} beacons over {} s".format(
+        len(sightings), BEACONS, SECONDS))
+
+    report = "{:>18}: {:7d} listener_id writes / beacon_logs rows, " \
+        "{:.0%} at the nearest listener"
+    print(report.format('last listener', *count_writes(
+        sightings, nearest, lambda b, l_id, d, t: l_id)))
+
+    engine = LocationEngine()
+    start = time.time()
+    located = count_writes(
+        sightings, nearest, lambda b, l_id, d, t: engine.observe(
+            b, l_id, d, VARIANCE, t))
+    elapsed = time.time() - start
+    size = sum(sys.getsizeof(a) for a in (
+        engine._listener, engine._distance, engine._weight, engine._time,
+        engine._head, engine._current, engine._candidate, engine._streak,
+        engine._slots))
+    print(report.format('location engine', *located))
+    print("{:>18}: {}".format('engine stats', engine.stats()))
+    print("{:>18}: {:.1f} us per sighting, {:.0f} bytes per beacon".format(
+        'cost', elapsed / len(sightings) * 1e6, size / BEACONS))
@@ -0,0 +1,50 @@
+"""Throughput of DATA packet handling for packets with many iBeacon
+records.
+
+Run with: python benchmarks/bench_lproto.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from c3next import lproto
+from c3next.hdlc import hdlc_frame
+from c3next.listenerd import ListenerProtocol, BEACONS
+
+ROUNDS = 200
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+    def getPeer(self):
+        return "Bench"
+
+
+def data_packet(records):
+    return b'\x01\x00\x04Test' + b''.join(
+        lproto.IBEACON.pack(b'\x01' * 16, i, i, -60, -59)
+        for i in range(records))
+
+
+def main():
+    proto = ListenerProtocol()
+    proto.transport = NullTransport()
+    proto.connectionMade()
+    for records in [1, 10, 50]:
+        packet = data_packet(records)
+        data = lproto.get_data(packet)
+        t = timeit.timeit(lambda: list(lproto.iter_ibeacons(data)),
+                          number=ROUNDS * 10)
+        print("{:>3} records/packet: decode {:10.0f} records/s".format(
+            records, records * ROUNDS * 10 / t))
+        frame = hdlc_frame(packet)
+        t = timeit.timeit(lambda: proto.dataReceived(frame), number=ROUNDS)
+        print("{:>3} records/packet: receive {:9.0f} records/s".format(
+            records, records * ROUNDS / t))
+    assert len(BEACONS) == 50
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Write-behind persistence against the old fixed 5 s TimerService,
+on a simulated clock and DB.
+
+BEACONS beacons are updated UPDATES per second. Writes take 20 ms plus
+10 us per row, ten times that while the DB is slow (40-80 s), and fail
+while it is down (60-65 s). Reports the queue depth (dirty objects),
+rows and latency per flush, and the share of time the DB spent on our
+writes. The old loop stops for good at its first failed write, as a
+TimerService does when its call fails.
+
+Run with: python benchmarks/bench_persist.py
+"""
+from __future__ import division, print_function
+
+import random
+
+from twisted.application import internet
+from twisted.internet import defer, task
+
+from c3next import db
+from c3next.listenerd import DataPersistanceService
+from c3next.models import Beacon, Listener
+
+BEACONS = 20000
+UPDATES = 20000
+SECONDS = 120
+STEP = 0.01
+SLOW = (40, 80)
+DOWN = (60, 65)
+
+
+class FakeDB(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.busy = 0.0
+        self.latencies = []
+        self.rows = []
+
+    def get_connection(self):
+        return defer.succeed(self)
+
+    def execute(self, query):
+        return defer.succeed(self)
+
+    def fetchall(self):
+        return defer.succeed([])
+
+    def close(self):
+        return defer.succeed(None)
+
+    def upsert(self, rows, conn=None):
+        now = self.clock.seconds()
+        latency = 0.02 + 1e-5 * len(rows)
+        if SLOW[0] <= now < SLOW[1]:
+            latency *= 10
+        self.busy += latency
+        self.rows.append(len(rows))
+        self.latencies.append(latency)
+
+        def done():
+            if DOWN[0] <= self.clock.seconds() < DOWN[1]:
+                raise RuntimeError("DB down")
+        return task.deferLater(self.clock, latency, done)
+
+
+def legacy_service():
+    """ The old loop: every 5 s, write everything dirty """
+    @defer.inlineCallbacks
+    def run():
+        for cls in (Listener, Beacon):
+            dirty = [o for o in cls.drain_dirty() if o.needs_persist_p()]
+            rows = [o.dirty_pk_dict() for o in dirty]
+            if rows:
+                try:
+                    yield cls.upsert(rows)
+                except Exception:
+                    cls._dirty_set.update(dirty)
+                    raise
+                for o, row in zip(dirty, rows):
+                    o.mark_clean(row)
+    return internet.TimerService(5, run)
+
+
+def simulate(name, make_service):
+    clock = task.Clock()
+    fake = FakeDB(clock)
+    db.get_connection = fake.get_connection
+    Beacon.upsert = Listener.upsert = fake.upsert
+    Beacon.drain_dirty()
+    Listener.drain_dirty()
+    rng = random.Random(0)
+    beacons = []
+    for i in range(BEACONS):
+        b = Beacon()
+        b.update({'id': u'{:012x}'.format(i), 'key': b'', 'dk': 0,
+                  'clock': 0, 'last_seen': 0.0})
+        b.set_missing(False)
+        beacons.append(b)
+
+    service = make_service()
+    if isinstance(service, internet.TimerService):
+        service.clock = clock
+    else:
+        service._loop.clock = clock
+    service.startService()
+    max_depth = 0
+    per_step = int(UPDATES * STEP)
+    for step in range(int(SECONDS / STEP)):
+        now = step * STEP
+        for b in rng.sample(beacons, per_step):
+            b['last_seen'] = now
+        clock.advance(STEP)
+        max_depth = max(max_depth, len(Beacon._dirty_set))
+    rows = sorted(fake.rows) or [0]
+    latencies = sorted(fake.latencies) or [0]
+    print("{:>13}: {:4} flushes, rows/flush mean {:6.0f} max {:6}, "
+          "latency p95 {:6.3f} s max {:6.3f} s, DB busy {:4.1f}%, "
+          "max depth {:6}, depth at end {:6}".format(
+              name, len(fake.rows), sum(rows) / len(rows), rows[-1],
+              latencies[int(len(latencies) * 0.95)], latencies[-1],
+              fake.busy / SECONDS * 100, max_depth,
+              len(Beacon._dirty_set)))
+
+
+if __name__ == '__main__':
+    simulate('legacy', legacy_service)
+    simulate('write-behind', DataPersistanceService)
@@ -0,0 +1,94 @@
+"""Cost of missing detection with the timing wheel against the old
+missing_p, which compared last_seen with now - BEACON_LISTENER_TIMEOUT
+on every call.
+
+Simulates BEACONS beacons sighted every few seconds for a few minutes,
+a tenth of them going quiet halfway, and a missing scan of all of them
+(a filtered list request) every second.
+
+Run with: python benchmarks/bench_presence.py
+"""
+from __future__ import print_function
+
+from datetime import datetime
+import random
+import time
+
+from pytz import UTC
+
+from c3next.config import BEACON_LISTENER_TIMEOUT
+from c3next.models import Beacon
+from c3next.presence import PresenceTracker
+
+BEACONS = 50000
+SECONDS = 180
+PERIOD = 5
+
+
+def beacon(i, last_seen):
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': u'{:012x}'.format(i), 'name': u'{}'.format(i),
+                'last_seen': last_seen})
+    return Beacon(row=row)
+
+
+def legacy_missing_p(last_seen):
+    """ The old missing_p, on last_seen as the datetime it was held as """
+    if last_seen is None:
+        return True
+    min_age = datetime.now(tz=UTC) - BEACON_LISTENER_TIMEOUT
+    return last_seen < min_age
+
+
+def main():
+    rng = random.Random(0)
+    start = 1.5e9
+    tracker = PresenceTracker(BEACON_LISTENER_TIMEOUT.total_seconds(), 1,
+                              now=start)
+    beacons = [beacon(i, start) for i in range(BEACONS)]
+    legacy_last_seen = [datetime.fromtimestamp(start, tz=UTC)] * BEACONS
+    quiet = set(rng.sample(range(BEACONS), BEACONS // 10))
+    phase = [rng.random() * PERIOD for _ in range(BEACONS)]
+
+    seen_time = advance_time = scan_time = legacy_time = 0.0
+    sightings = 0
+    for second in range(SECONDS):
+        now = start + second
+        last_seen = datetime.fromtimestamp(now, tz=UTC)
+        sighted = [i for i in range(BEACONS)
+                   if (second + phase[i]) % PERIOD < 1 and
+                   not (i in quiet and second > SECONDS // 2)]
+        for i in sighted:
+            beacons[i]['last_seen'] = now
+            legacy_last_seen[i] = last_seen
+        sightings += len(sighted)
+        t0 = time.time()
+        for i in sighted:
+            tracker.seen('beacon', i, beacons[i], now)
+        seen_time += time.time() - t0
+
+        t0 = time.time()
+        # expire(), less its STATE lookup
+        for (_, i) in tracker.wheel.advance(now):
+            beacons[i].set_missing(True)
+        advance_time += time.time() - t0
+
+        t0 = time.time()
+        new = sum(1 for b in beacons if b.missing_p())
+        scan_time += time.time() - t0
+        t0 = time.time()
+        sum(1 for last_seen in legacy_last_seen
+            if legacy_missing_p(last_seen))
+        legacy_time += time.time() - t0
+
+    print("{} beacons, {} s, {} sightings, {} missing at the end".format(
+        BEACONS, SECONDS, sightings, new))
+    print("seen:    {:7.3f} us per sighting".format(
+        seen_time / sightings * 1e6))
+    print("advance: {:7.3f} ms per tick".format(advance_time / SECONDS * 1e3))
+    print("scan:    {:7.3f} ms flag, {:7.3f} ms legacy per {} beacons".format(
+        scan_time / SECONDS * 1e3, legacy_time / SECONDS * 1e3, BEACONS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Search latency over 100k beacons: the in-memory trigram index, and
+with --db the ranked LIKE query against the pg_trgm indexes.
+
+The DB mode needs a database migrated to head at DB_URL; it writes
+beacons with ids starting 'bench' and deletes them again.
+
+Run with: python benchmarks/bench_search.py [--db]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from c3next import db
+from c3next.models import Beacon
+from c3next.search import NgramIndex, rank_order, search_clause
+
+BEACONS = 100000
+QUERIES = 500
+PER_PAGE = 20
+WORDS = ['dock', 'forklift', 'pallet', 'cart', 'badge', 'tool', 'bin',
+         'crate', 'door', 'asset']
+
+
+def beacon_rows(n):
+    rng = random.Random(0)
+    return [{'id': u'bench{:08x}'.format(i),
+             'name': u'{} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS),
+                                        i),
+             'key': os.urandom(16), 'dk': 0, 'clock': 0}
+            for i in range(n)]
+
+
+def queries(n):
+    """ Name prefixes, name substrings, id fragments and misses """
+    rng = random.Random(1)
+    out = []
+    for _ in range(n):
+        word = rng.choice(WORDS)
+        out.append(rng.choice([
+            word[:rng.randint(2, len(word))],
+            word[1:],
+            u'{} {}'.format(word, rng.choice(WORDS)),
+            u'{:05x}'.format(rng.randrange(BEACONS >> 4)),
+            u'zzz{}'.format(rng.randrange(1000))]))
+    return out
+
+
+def report(name, latencies):
+    latencies.sort()
+    p50, p95 = [latencies[int(len(latencies) * p)] * 1000
+                for p in (0.5, 0.95)]
+    print("{:>12}: p50 {:7.2f} ms  p95 {:7.2f} ms  max {:7.2f} ms".format(
+        name, p50, p95, latencies[-1] * 1000))
+
+
+def bench_memory(rows):
+    cache = {}
+    for row in rows:
+        full = {c.name: None for c in Beacon._table.columns}
+        full.update(row)
+        cache[row['id']] = Beacon(row=full)
+    index = NgramIndex(cache, refresh_interval=3600)
+    start = time.time()
+    index.refresh()
+    print("{:>12}: {:.2f} s for {} beacons".format(
+        'index build', time.time() - start, len(rows)))
+    latencies = []
+    for q in queries(QUERIES):
+        start = time.time()
+        index.search([q], 0, PER_PAGE)
+        latencies.append(time.time() - start)
+    report('memory', latencies)
+
+
+@defer.inlineCallbacks
+def bench_db(reactor, rows):
+    conn = yield db.get_connection()
+    fields = [db.beacons.c.name, db.beacons.c.id]
+    try:
+        yield conn.execute(db.beacons.insert(), rows)
+        yield conn.execute('ANALYZE beacons')
+        latencies = []
+        for q in queries(QUERIES):
+            query = db.beacons.select().where(
+                search_clause([q], fields)).order_by(
+                    *rank_order([q], fields, db.beacons.c.id)).limit(
+                        PER_PAGE + 1)
+            start = time.time()
+            cur = yield conn.execute(query)
+            yield cur.fetchall()
+            latencies.append(time.time() - start)
+        report('db', latencies)
+    finally:
+        yield conn.execute(db.beacons.delete().where(
+            db.beacons.c.id.like(u'bench%')))
+        yield conn.close()
+
+
+if __name__ == '__main__':
+    rows = beacon_rows(BEACONS)
+    bench_memory(rows)
+    if '--db' in sys.argv[1:]:
+        task.react(bench_db, [rows])
@@ -0,0 +1,58 @@
+"""Per-object JSON encoding: the old flat_dict + json.dumps(cls=
+BytesEncoder) per object against serializer.dumps of a whole page.
+
+Run with: python benchmarks/bench_serializer.py
+"""
+from __future__ import print_function
+
+from calendar import timegm
+from datetime import datetime
+import json
+import timeit
+
+from pytz import UTC
+
+from c3next.models import Beacon
+from c3next.serializer import BACKEND, dumps
+
+OBJECTS = 2000
+ROUNDS = 20
+
+
+class LegacyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return timegm(obj.utctimetuple())
+        return json.JSONEncoder(self, obj)
+
+
+def beacons(n):
+    now = datetime.now(tz=UTC)
+    out = []
+    for i in range(n):
+        row = {c.name: None for c in Beacon._table.columns}
+        row.update({'id': u'{:012x}'.format(i), 'name': u'Beacon {}'.format(i),
+                    'key': b'k' * 16, 'last_seen': now, 'updated_at': now,
+                    'listener_id': u'L1', 'rejected_mac': 0})
+        out.append(Beacon(row=row))
+    return out
+
+
+def legacy(objects):
+    return json.dumps([json.dumps(
+        {k: v for (k, v) in zip(o._fields, o._values)
+         if k not in o._private_fields}, cls=LegacyEncoder)
+        for o in objects])
+
+
+def current(objects):
+    return dumps([o.json_dict() for o in objects])
+
+
+if __name__ == '__main__':
+    objects = beacons(OBJECTS)
+    for name, func in [('legacy', legacy), (BACKEND, current)]:
+        t = min(timeit.repeat(lambda: func(objects), number=1,
+                              repeat=ROUNDS))
+        print("{:>8}: {:7.2f} ms per {} beacons".format(
+            name, t * 1000, OBJECTS))
@@ -0,0 +1,67 @@
+"""Rows/sec of Beacon.upsert against the old single-statement upsert.
+
+Needs a migrated database at DB_URL; it writes beacons with ids
+starting 'bench' and deletes them again.
+
+Run with: python benchmarks/bench_upsert.py
+"""
+from __future__ import print_function
+
+import os
+import time
+from datetime import datetime
+
+from pytz import UTC
+from sqlalchemy.dialects.postgresql import insert
+from twisted.internet import defer, task
+
+from c3next import db, models
+from c3next.models import Beacon
+
+SIZES = [1000, 10000, 100000]
+
+
+@defer.inlineCallbacks
+def legacy_upsert(rows, conn):
+    """ The old path: one INSERT for the whole group, updating every
+    column from EXCLUDED """
+    query = insert(db.beacons, rows)
+    conflict_query = query.on_conflict_do_update(
+        index_elements=[db.beacons.c.id], set_={
+            a.name: a for a in query.excluded if a is not None})
+    yield conn.execute(conflict_query)
+
+
+def dirty_rows(n, clock):
+    now = datetime.now(tz=UTC)
+    return [{'id': u'bench{:08d}'.format(i), 'key': os.urandom(16),
+             'dk': i, 'clock': clock, 'last_seen': now} for i in range(n)]
+
+
+@defer.inlineCallbacks
+def timed(name, n, func, *args):
+    start = time.time()
+    yield func(*args)
+    t = time.time() - start
+    print("{:>8} rows {:>15}: {:10.0f} rows/s".format(n, name, n / t))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    conn = yield db.get_connection()
+    try:
+        for n in SIZES:
+            yield timed('legacy', n, legacy_upsert, dirty_rows(n, 1), conn)
+            models.COPY_UPSERT_THRESHOLD = n + 1
+            yield timed('chunked INSERT', n, Beacon.upsert,
+                        dirty_rows(n, 2), conn)
+            models.COPY_UPSERT_THRESHOLD = 1
+            yield timed('COPY', n, Beacon.upsert, dirty_rows(n, 3), conn)
+    finally:
+        yield conn.execute(db.beacons.delete().where(
+            db.beacons.c.id.like(u'bench%')))
+        yield conn.close()
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,48 @@
+"""Time Beacon.valid_dk against the old per-tick loop over long gaps.
+
+Run with: python benchmarks/bench_valid_dk.py
+"""
+from __future__ import print_function
+
+import timeit
+
+from c3next.config import DK0_INTERVAL, DK1_INTERVAL
+from c3next.models import Beacon
+from c3next.util import evolve_dk
+
+GAPS = [('1 minute', 60), ('1 hour', 3600), ('1 day', 86400),
+        ('1 week', 7 * 86400)]
+
+
+def loop_valid_dk(b, new_dk, new_clock):
+    """ Beacon.valid_dk as it was, one evolve_dk per tick """
+    mask = 0xffffffff
+    b_dk = b['dk']
+    for i in range(b['clock']+1, new_clock+1):
+        if i % DK0_INTERVAL == 0:
+            b_dk, mask = evolve_dk(b_dk, mask, 0)
+        if i % DK1_INTERVAL == 0:
+            b_dk, mask = evolve_dk(b_dk, mask, 1)
+    if mask == 0:
+        return True
+    return b_dk == (new_dk & mask)
+
+
+def main():
+    b = Beacon()
+    b.update({'dk': 0x12345678, 'clock': 1000})
+    for name, gap in GAPS:
+        new_clock = 1000 + gap
+        assert (b.valid_dk(0x12345678, new_clock) ==
+                loop_valid_dk(b, 0x12345678, new_clock))
+        number = max(1, 100000 // gap)
+        loop = timeit.timeit(lambda: loop_valid_dk(b, 0x12345678, new_clock),
+                             number=number) / number
+        closed = timeit.timeit(lambda: b.valid_dk(0x12345678, new_clock),
+                               number=10000) / 10000
+        print("{:>9}: loop {:10.1f} us, closed form {:6.2f} us".format(
+            name, loop * 1e6, closed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Load generator for the listener port: simulated listeners send
+SECURE packets for their beacons and wait for each ACK.
+
+Start the server (e.g. LISTENER_WORKERS=4 twistd -ny ...), then run:
+    python benchmarks/loadgen.py [host] [port] [clients] [seconds]
+
+Every client is a separate process and connection, i.e. one listener
+with its own set of beacons, so SO_REUSEPORT can spread them across
+workers. Beacon ids are random per run, so every run trusts new keys.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import time
+
+from Crypto.Cipher import AES
+
+from c3next.hdlc import hdlc_frame
+from c3next.util import derive_key
+
+BEACONS_PER_CLIENT = 50
+
+
+def secure_packet(l_id, b_id, b_key, clock):
+    nonce = os.urandom(16)
+    cipher = AES.new(b_key, AES.MODE_EAX, nonce, mac_len=4)
+    cipher.update(b_id)
+    msg, tag = cipher.encrypt_and_digest(struct.pack("<IIB", clock, 0, 0))
+    header = struct.pack("BBB", 2, 0, len(l_id))
+    return hdlc_frame(header + l_id + b_id + nonce + msg + tag +
+                      struct.pack("<HH", 150, 20))
+
+
+def client(args):
+    host, port, index, seconds = args
+    l_id = 'loadgen{}'.format(index).encode()
+    beacons = []
+    for _ in range(BEACONS_PER_CLIENT):
+        b_id = os.urandom(6)
+        beacons.append((b_id, derive_key(b_id)))
+    sock = socket.create_connection((host, port))
+    sent = 0
+    clock = 1
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for b_id, b_key in beacons:
+            sock.sendall(secure_packet(l_id, b_id, b_key, clock))
+            # NACKs count too, they cost the server the same work
+            if not sock.recv(16):
+                return sent
+            sent += 1
+        clock += 1
+    sock.close()
+    return sent
+
+
+def main(host='127.0.0.1', port=9999, clients=8, seconds=10):
+    port, clients, seconds = int(port), int(clients), float(seconds)
+    pool = multiprocessing.Pool(clients)
+    start = time.time()
+    counts = pool.map(client, [(host, port, i, seconds)
+                               for i in range(clients)])
+    elapsed = time.time() - start
+    total = sum(counts)
+    print("{} clients: {} packets in {:.1f}s, {:.0f} packets/s".format(
+        clients, total, elapsed, total / elapsed))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
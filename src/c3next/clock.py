@@ -0,0 +1,69 @@
+""" Wall clock for the packet path, and conversions of its timestamps.
+
+Cached objects keep their DateTime columns as epoch seconds (floats),
+which are cheaper to make, compare and hold than timezone-aware
+datetimes. They are converted when rows are read from or written to
+the DB; JSON takes the whole seconds. Timestamps are rounded to the
+microseconds the DB keeps, so one read back compares equal to the value
+that was written.
+"""
+from __future__ import absolute_import
+
+from datetime import datetime
+import time
+
+from pytz import UTC
+
+from c3next.serializer import EPOCH
+
+
+def to_timestamp(value):
+    """ Epoch seconds of a datetime (naive ones are taken as UTC), or
+    value itself if it is a timestamp already or None """
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=UTC)
+        return round((value - EPOCH).total_seconds(), 6)
+    return value
+
+
+def to_datetime(value):
+    """ Inverse of to_timestamp, the UTC datetime of epoch seconds """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromtimestamp(value, tz=UTC)
+
+
+class ReactorClock(object):
+    """ time.time(), read once per reactor iteration.
+
+    The first read in an iteration caches the time and schedules a
+    call for the end of it that drops the cache, so every packet
+    handled in one iteration shares a timestamp and an idle reactor is
+    not woken up. Without a running reactor (tests, scripts) every
+    read is fresh. """
+    def __init__(self, reactor=None, clock=time.time):
+        self._reactor = reactor
+        self._clock = clock
+        self._now = None
+        self.reads = 0
+
+    def now(self):
+        if self._now is not None:
+            return self._now
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        now = round(self._clock(), 6)
+        self.reads += 1
+        if getattr(reactor, 'running', True):
+            self._now = now
+            reactor.callLater(0, self._expire)
+        return now
+
+    def _expire(self):
+        self._now = None
+
+
+CLOCK = ReactorClock()
@@ -1,18 +1,174 @@
+import io
+from binascii import hexlify
+from datetime import datetime
+import threading
+import time
+
+import six
 import sqlalchemy as sa
 from alchimia import TWISTED_STRATEGY
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
+from twisted.python import failure
 
-from .config import DB_URL
+from .config import DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_URL
 
 ENGINE = sa.create_engine(DB_URL, reactor=reactor,
-                          strategy=TWISTED_STRATEGY, pool_size=90)
+                          strategy=TWISTED_STRATEGY, pool_size=DB_POOL_SIZE,
+                          max_overflow=DB_MAX_OVERFLOW,
+                          pool_timeout=DB_POOL_TIMEOUT)
 
 METADATA = sa.MetaData()
 
 
+class PoolStats(object):
+    """ Checkouts from the connection pool, and how long get_connection
+    callers waited for one. Pool events fire on the connections' worker
+    threads """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def listen(self, pool):
+        sa.event.listen(pool, 'connect', self._connect)
+        sa.event.listen(pool, 'checkout', self._checkout)
+        sa.event.listen(pool, 'checkin', self._checkin)
+
+    def _connect(self, dbapi_conn, record):
+        with self._lock:
+            self.connects += 1
+
+    def _checkout(self, dbapi_conn, record, proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out,
+                                       self.checked_out)
+
+    def _checkin(self, dbapi_conn, record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def waited(self, seconds):
+        self.waits += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def stats(self):
+        return {'connects': self.connects, 'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'wait_mean': round(self.wait_total / self.waits, 4)
+                if self.waits else 0.0,
+                'wait_max': round(self.wait_max, 4)}
+
+
+POOL_STATS = PoolStats()
+POOL_STATS.listen(ENGINE._engine.pool)
+
+
 def get_connection():
-    return ENGINE.connect()
+    started = time.time()
+    d = ENGINE.connect()
+
+    def connected(conn):
+        POOL_STATS.waited(time.time() - started)
+        return conn
+    return d.addCallback(connected)
+
+
+class ConnectionScope(object):
+    """ One connection shared by the DB work of a web request or a
+    persistence tick, checked out on first use and held until close().
+    With transaction, that work runs in one transaction, committed by
+    close() (or rolled back, with commit False).
+
+    Pass the scope as the conn of model methods; work in a scope is
+    expected to run one statement at a time """
+    def __init__(self, transaction=False):
+        self.transaction = transaction
+        self._conn = None
+        self._txn = None
+        self._after = []
+
+    @defer.inlineCallbacks
+    def connection(self):
+        """ Deferred firing with the scope's connection """
+        if self._conn is None:
+            conn = yield get_connection()
+            if self.transaction:
+                try:
+                    self._txn = yield conn.begin()
+                except Exception:
+                    yield conn.close()
+                    raise
+            self._conn = conn
+        defer.returnValue(self._conn)
+
+    def execute(self, *args, **kwargs):
+        return self.connection().addCallback(
+            lambda conn: conn.execute(*args, **kwargs))
+
+    def after_commit(self, func, *args, **kwargs):
+        """ Call func(*args, **kwargs) once close() has committed the
+        scope's work; dropped if it is rolled back or the commit fails.
+        For telling the caches about a change only once it is in the DB """
+        self._after.append((func, args, kwargs))
+
+    @defer.inlineCallbacks
+    def close(self, commit=True):
+        """ End the transaction, if any, and give the connection back to
+        the pool. The scope can be used again afterwards """
+        conn, txn, after = self._conn, self._txn, self._after
+        self._conn = self._txn = None
+        self._after = []
+        if conn is not None:
+            try:
+                if txn is not None and commit:
+                    yield txn.commit()
+                elif txn is not None:
+                    yield txn.rollback()
+            finally:
+                yield conn.close()
+        if commit:
+            for (func, args, kwargs) in after:
+                func(*args, **kwargs)
+
+    def finish(self, result):
+        """ close() committing unless result is a Failure, passing
+        result on; for the end of a callback chain """
+        d = self.close(commit=not isinstance(result, failure.Failure))
+        return d.addCallback(lambda _: result)
+
+
+@defer.inlineCallbacks
+def with_connection(conn, func, *args, **kwargs):
+    """ func(connection, *args, **kwargs) on conn, the connection of
+    conn if it is a ConnectionScope, or one checked out for the call
+    when conn is None """
+    if isinstance(conn, ConnectionScope):
+        conn = yield conn.connection()
+    if conn is not None:
+        result = yield func(conn, *args, **kwargs)
+        defer.returnValue(result)
+    conn = yield get_connection()
+    try:
+        result = yield func(conn, *args, **kwargs)
+    finally:
+        yield conn.close()
+    defer.returnValue(result)
+
+
+def seen_order(table):
+    """ last_seen with never seen rows as the epoch, the sort key of
+    keyset pages by last_seen (and of the *_seen_id indexes) """
+    return sa.func.coalesce(table.c.last_seen, sa.func.to_timestamp(0))
 
 
 # CREATE TABLE zones (
@@ -41,8 +197,16 @@ beacon_groups = sa.Table('beacon_groups', METADATA,
 #   name varchar DEFAULT NULL,
 #   description text DEFAULT NULL,
 #   zone_id integer REFERENCES zones,
-#   last_seen timestamp DEFAULT NULL
+#   last_seen timestamp DEFAULT NULL,
+#   updated_at timestamp NOT NULL DEFAULT now()
 # );
+# CREATE INDEX listeners_updated_at ON listeners(updated_at);
+# CREATE INDEX listeners_seen_id
+#   ON listeners(coalesce(last_seen, to_timestamp(0)), id);
+# CREATE INDEX listeners_name_trgm
+#   ON listeners USING gin (lower(name) gin_trgm_ops);
+# CREATE INDEX listeners_id_trgm
+#   ON listeners USING gin (lower(id) gin_trgm_ops);
 
 listeners = sa.Table('listeners', METADATA,
                      sa.Column('id', sa.String, primary_key=True),
@@ -50,7 +214,11 @@ listeners = sa.Table('listeners', METADATA,
                      sa.Column('zone_id', sa.ForeignKey('zones.id'),
                                nullable=True),
                      sa.Column('last_seen', sa.DateTime(timezone=True),
-                               default=sa.func.now()))
+                               default=sa.func.now()),
+                     sa.Column('updated_at', sa.DateTime(timezone=True),
+                               nullable=False, server_default=sa.func.now()))
+sa.Index('listeners_updated_at', listeners.c.updated_at)
+sa.Index('listeners_seen_id', seen_order(listeners), listeners.c.id)
 
 
 # CREATE TABLE beacons (
@@ -60,8 +228,16 @@ listeners = sa.Table('listeners', METADATA,
 #   description text DEFAULT NULL,
 #   battery percent DEFAULT NULL,
 #   listener_id varchar REFERENCES listeners,
-#   last_seen timestamp DEFAULT NULL
+#   last_seen timestamp DEFAULT NULL,
+#   updated_at timestamp NOT NULL DEFAULT now()
 # );
+# CREATE INDEX beacons_updated_at ON beacons(updated_at);
+# CREATE INDEX beacons_seen_id
+#   ON beacons(coalesce(last_seen, to_timestamp(0)), id);
+# CREATE INDEX beacons_name_trgm
+#   ON beacons USING gin (lower(name) gin_trgm_ops);
+# CREATE INDEX beacons_id_trgm
+#   ON beacons USING gin (lower(id) gin_trgm_ops);
 
 beacons = sa.Table('beacons', METADATA,
                    sa.Column('id', sa.String, primary_key=True),
@@ -86,7 +262,11 @@ beacons = sa.Table('beacons', METADATA,
                    sa.Column('rejected_mac', sa.Integer, nullable=False,
                              default=0),
                    sa.Column('rejected_dk', sa.Integer, nullable=False,
-                             default=0))
+                             default=0),
+                   sa.Column('updated_at', sa.DateTime(timezone=True),
+                             nullable=False, server_default=sa.func.now()))
+sa.Index('beacons_updated_at', beacons.c.updated_at)
+sa.Index('beacons_seen_id', seen_order(beacons), beacons.c.id)
 
 # CREATE TABLE beacon_logs (
 #   id serial PRIMARY KEY,
@@ -104,6 +284,29 @@ beacon_logs = sa.Table('beacon_logs', METADATA,
                        sa.Column('timestamp', sa.DateTime(timezone=True),
                                  nullable=False, default=sa.func.now()))
 
+# CREATE TABLE sightings (
+#   beacon_id varchar NOT NULL,
+#   listener_id varchar NOT NULL,
+#   distance float NOT NULL,
+#   variance float NOT NULL,
+#   timestamp timestamp NOT NULL
+# ) PARTITION BY RANGE (timestamp);
+# CREATE TABLE sightings_default PARTITION OF sightings DEFAULT;
+# CREATE INDEX sightings_beacon_id_timestamp
+#   ON sightings(beacon_id, timestamp);
+# Daily partitions are created ahead by c3next.sightings.SightingWriter
+
+sightings = sa.Table('sightings', METADATA,
+                     sa.Column('beacon_id', sa.String, nullable=False),
+                     sa.Column('listener_id', sa.String, nullable=False),
+                     sa.Column('distance', sa.Float, nullable=False),
+                     sa.Column('variance', sa.Float, nullable=False),
+                     sa.Column('timestamp', sa.DateTime(timezone=True),
+                               nullable=False),
+                     postgresql_partition_by='RANGE (timestamp)')
+sa.Index('sightings_beacon_id_timestamp', sightings.c.beacon_id,
+         sightings.c.timestamp)
+
 # CREATE OR REPLACE FUNCTION log_beacon_changes() RETURNS TRIGGER AS $$
 # BEGIN
 #   IF (OLD.listener_id IS DISTINCT FROM NEW.listener_id)
@@ -118,6 +321,18 @@ beacon_logs = sa.Table('beacon_logs', METADATA,
 # CREATE TRIGGER insert_beacon_log_rows AFTER UPDATE ON beacons FOR EACH ROW
 #   EXECUTE PROCEDURE log_beacon_changes();
 
+# CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS TRIGGER AS $$
+# BEGIN
+#   NEW.updated_at = now();
+#   RETURN NEW;
+# END;
+# $$ LANGUAGE plpgsql;
+
+# CREATE TRIGGER touch_listeners_updated_at BEFORE UPDATE ON listeners
+#   FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+# CREATE TRIGGER touch_beacons_updated_at BEFORE UPDATE ON beacons
+#   FOR EACH ROW EXECUTE PROCEDURE touch_updated_at();
+
 # CREATE TABLE users (
 #   id serial PRIMARY KEY,
 #   username varchar UNIQUE NOT NULL,
@@ -153,3 +368,103 @@ users = sa.Table('users', METADATA,
 
 def execute(*args, **kwargs):
     return ENGINE.execute(*args, **kwargs)
+
+
+def _copy_text(value, binary=False):
+    """ Render value in the COPY text format """
+    if value is None:
+        return u'\\N'
+    if binary:
+        return u'\\\\x' + hexlify(value).decode('ascii')
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, bytes):
+        value = value.decode('latin-1')
+    elif isinstance(value, float):
+        # Python 2's str() keeps only 12 significant digits
+        value = six.text_type(repr(value))
+    elif not isinstance(value, six.text_type):
+        value = six.text_type(value)
+    return (value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+            .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+
+def _copy_buffer(table, columns, rows):
+    """ COPY text data for rows, sequences in columns order """
+    binary = [isinstance(table.c[c].type, sa.LargeBinary) for c in columns]
+    buf = io.BytesIO()
+    for row in rows:
+        line = u'\t'.join(_copy_text(value, is_binary)
+                          for value, is_binary in zip(row, binary))
+        buf.write(line.encode('utf-8') + b'\n')
+    buf.seek(0)
+    return buf
+
+
+def _with_cursor(sa_conn, func, *args):
+    """ Run func(cursor, *args) on the DBAPI connection behind sa_conn,
+    committing unless an outer transaction is open """
+    dbapi_conn = sa_conn.connection
+    cursor = dbapi_conn.cursor()
+    try:
+        func(cursor, *args)
+    except Exception:
+        if not sa_conn.in_transaction():
+            dbapi_conn.rollback()
+        raise
+    else:
+        if not sa_conn.in_transaction():
+            dbapi_conn.commit()
+    finally:
+        cursor.close()
+
+
+def _defer_with_cursor(conn, func, *args):
+    # alchimia has no COPY support, run on the connection's worker
+    return conn._defer_to_cxn(_with_cursor, conn._connection, func, *args)
+
+
+def _copy_upsert(cursor, table, columns, update_columns, rows, guard):
+    tmp = 'upsert_{}'.format(table.name)
+    cols = ', '.join('"{}"'.format(c) for c in columns)
+    cursor.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS {} ON COMMIT DELETE ROWS AS '
+        'SELECT * FROM {} WITH NO DATA'.format(tmp, table.name))
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN'.format(tmp, cols),
+        _copy_buffer(table, columns,
+                     ([row[c] for c in columns] for row in rows)))
+    if guard is None:
+        where = ''
+    else:
+        where = (' WHERE {0}."{1}" IS NULL OR '
+                 '{0}."{1}" <= EXCLUDED."{1}"').format(table.name, guard)
+    cursor.execute(
+        'INSERT INTO {table} ({cols}) SELECT {cols} FROM {tmp} '
+        'ON CONFLICT (id) DO UPDATE SET {set_}{where}'.format(
+            table=table.name, cols=cols, tmp=tmp, where=where,
+            set_=', '.join('"{0}" = EXCLUDED."{0}"'.format(c)
+                           for c in update_columns)))
+    # Inside an outer transaction ON COMMIT has not fired yet
+    cursor.execute('DELETE FROM {}'.format(tmp))
+
+
+def copy_upsert(conn, table, columns, update_columns, rows, guard=None):
+    """ Upsert rows (dicts holding every name in columns) by COPYing
+    them into a temp table and merging with one INSERT ... SELECT.
+    With guard, existing rows are only updated if the guard column
+    does not move backwards """
+    return _defer_with_cursor(conn, _copy_upsert, table, columns,
+                              update_columns, rows, guard)
+
+
+def _copy_rows(cursor, table, columns, rows):
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN'.format(
+            table.name, ', '.join('"{}"'.format(c) for c in columns)),
+        _copy_buffer(table, columns, rows))
+
+
+def copy_rows(conn, table, columns, rows):
+    """ Append rows (sequences in columns order) to table with COPY """
+    return _defer_with_cursor(conn, _copy_rows, table, columns, rows)
@@ -0,0 +1,152 @@
+""" Change events for the dashboard, sent as server-sent events.
+
+The listener and the DB sync report every beacon or listener they
+change with EVENTS.changed(). Changes are collected per object and
+broadcast every interval seconds, so an object updated many times in
+an interval costs one event holding its latest state. Nothing is
+collected while no client is connected.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+from twisted.internet import task
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import log
+from zope.interface import implementer
+
+from c3next.config import EVENT_INTERVAL, EVENT_KEEPALIVE
+from c3next.serializer import dumps
+from c3next.state import STATE
+
+# Sent to a client whose backlog overflowed; it must reload its state
+RESYNC = b'event: resync\ndata: {}\n\n'
+KEEPALIVE = b': keepalive\n\n'
+
+
+def format_event(kind, obj_id, obj):
+    if obj is None:
+        event, data = b'delete', {'kind': kind, 'id': obj_id}
+    else:
+        event, data = kind.encode(), obj.json_dict()
+    return b'event: ' + event + b'\ndata: ' + dumps(data) + b'\n\n'
+
+
+class EventStream(object):
+    """ Coalesces changes and broadcasts them to EventClients """
+    def __init__(self, interval, keepalive):
+        self.interval = interval
+        self.keepalive = keepalive
+        self.clients = set()
+        self.sent = 0
+        self._pending = {}
+        self._idle = 0
+        self._loop = task.LoopingCall(self.flush)
+
+    def changed(self, kind, obj):
+        if self.clients:
+            self._pending[(kind, obj['id'])] = obj
+
+    def deleted(self, kind, obj_id):
+        if self.clients:
+            self._pending[(kind, obj_id)] = None
+
+    def add_client(self, client):
+        self.clients.add(client)
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def remove_client(self, client):
+        self.clients.discard(client)
+        if not self.clients:
+            self._pending.clear()
+            if self._loop.running:
+                self._loop.stop()
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            self._idle += 1
+            if self._idle * self.interval >= self.keepalive:
+                self._idle = 0
+                self._broadcast(lambda client: client.write(KEEPALIVE))
+            return
+        self._idle = 0
+        events = [(key, format_event(key[0], key[1], obj))
+                  for (key, obj) in pending.items()]
+        self.sent += len(events)
+        self._broadcast(lambda client: client.send(events))
+
+    def _broadcast(self, call):
+        """ call(client) for every client, dropping those it fails for,
+        so one gone request does not stop the loop for the others """
+        for client in list(self.clients):
+            try:
+                call(client)
+            except Exception:
+                log.err()
+                self.remove_client(client)
+
+
+@implementer(IPushProducer)
+class EventClient(object):
+    """ One streaming response. While the transport is paused, events
+    are held per object, newest replacing older ones, up to buffer
+    entries; past that the backlog is dropped and the client is told
+    to resync once it catches up. """
+    def __init__(self, request, buffer):
+        self.request = request
+        self.buffer = buffer
+        self.overflows = 0
+        self.paused = False
+        self._backlog = OrderedDict()
+        self._resync = False
+        request.registerProducer(self, True)
+
+    def write(self, data):
+        if not self.paused:
+            self.request.write(data)
+
+    def send(self, events):
+        if not self.paused:
+            self.request.write(b''.join(data for (_, data) in events))
+            return
+        if self._resync:
+            return
+        for (key, data) in events:
+            self._backlog.pop(key, None)
+            self._backlog[key] = data
+        if len(self._backlog) > self.buffer:
+            self.overflows += 1
+            self._backlog.clear()
+            self._resync = True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self._resync:
+            self._resync = False
+            self.request.write(RESYNC)
+        elif self._backlog:
+            backlog, self._backlog = self._backlog, OrderedDict()
+            self.request.write(b''.join(backlog.values()))
+
+    def stopProducing(self):
+        EVENTS.remove_client(self)
+
+
+EVENTS = EventStream(EVENT_INTERVAL, EVENT_KEEPALIVE)
+
+
+def _state_changed(kind, obj_id, key, fields):
+    if fields is None:
+        EVENTS.deleted(kind, obj_id)
+        return
+    cache = STATE.beacons if kind == 'beacon' else STATE.listeners
+    if key in cache:
+        EVENTS.changed(kind, cache[key])
+
+
+STATE.subscribe(_state_changed)
@@ -5,42 +5,128 @@ FLAG = 0x7e
 ESC = 0x7d
 NEEDS_ESCAPE = [0x7d, 0x7e]
 
+FLAG_BYTE = six.int2byte(FLAG)
+ESC_BYTE = six.int2byte(ESC)
+ESCAPED_FLAG = ESC_BYTE + six.int2byte(FLAG & ~(1 << 5))
+ESCAPED_ESC = ESC_BYTE + six.int2byte(ESC & ~(1 << 5))
 
-__all__ = ['HDLCInvalidFrame', 'hdlc_frame', 'hdlc_unframe']
+
+__all__ = ['HDLCInvalidFrame', 'HDLCDeframer', 'hdlc_frame', 'hdlc_unframe',
+           'hdlc_frame_many', 'hdlc_unframe_many']
 
 
 class HDLCInvalidFrame(Exception):
     pass
 
 
+def _escape(data):
+    return data.replace(ESC_BYTE, ESCAPED_ESC).replace(FLAG_BYTE, ESCAPED_FLAG)
+
+
 def hdlc_frame(data):
-    frame = bytearray()
-    frame.append(FLAG)
-    for byte in six.iterbytes(data):
-        if byte in NEEDS_ESCAPE:
-            frame.extend([ESC, byte & ~(1 << 5)])
-        else:
-            frame.append(byte)
-    frame.append(FLAG)
-    return bytes(frame)
+    return FLAG_BYTE + _escape(bytes(data)) + FLAG_BYTE
+
+
+def hdlc_frame_many(iterable):
+    """Frame each payload in iterable, returning one buffer of frames."""
+    escaped = [_escape(bytes(data)) for data in iterable]
+    if not escaped:
+        return b''
+    return FLAG_BYTE + (FLAG_BYTE * 2).join(escaped) + FLAG_BYTE
+
+
+def _unescape(body):
+    """Unescape the contents of a frame (flags already removed).
+
+    Escapes are rare, so the body is copied in slices between them
+    rather than byte by byte.
+    """
+    i = body.find(ESC_BYTE)
+    if i < 0:
+        return body
+    parts = []
+    start = 0
+    while i >= 0:
+        if i + 1 == len(body):
+            raise HDLCInvalidFrame("Incomplete escape sequence")
+        parts.append(body[start:i])
+        parts.append(six.int2byte(six.indexbytes(body, i + 1) | (1 << 5)))
+        start = i + 2
+        i = body.find(ESC_BYTE, start)
+    parts.append(body[start:])
+    return b''.join(parts)
 
 
 def hdlc_unframe(frame):
-    frame = bytearray(frame)
-    if not frame[0] == frame[-1] == 0x7e:
+    frame = bytes(frame)
+    if not frame[:1] == frame[-1:] == FLAG_BYTE:
         raise HDLCInvalidFrame("Missing flags")
-    frame = frame.strip(b'\x7e')
-    if FLAG in frame:
+    frame = frame.strip(FLAG_BYTE)
+    if FLAG_BYTE in frame:
         raise HDLCInvalidFrame("Unescaped FLAG found")
-    data = bytearray()
-    i = 0
-    while i < len(frame):
-        if frame[i] == 0x7d:
-            i += 1
-            if i == len(frame):
-                raise HDLCInvalidFrame("Incomplete escape sequence")
-            data.append(frame[i] | (1 << 5))
-        else:
-            data.append(frame[i])
-        i += 1
-    return bytes(data)
+    return _unescape(frame)
+
+
+def hdlc_unframe_many(buffer):
+    """Unframe a buffer holding only whole frames, returning payloads.
+
+    Unlike HDLCDeframer, frames may share a FLAG. Empty frames are
+    skipped.
+    """
+    segments = bytes(buffer).split(FLAG_BYTE)
+    if segments[0] or segments[-1]:
+        raise HDLCInvalidFrame("Missing flags")
+    return [_unescape(segment) for segment in segments if segment]
+
+
+class HDLCDeframer(object):
+    """Streaming deframer for a byte stream of HDLC frames.
+
+    Chunks are split on FLAG as they arrive; bytes after the last FLAG
+    are held until the next call. A frame must be opened by its own
+    FLAG, the closing FLAG of the previous frame does not count, and
+    empty frames (runs of FLAG) are skipped.
+
+    If on_invalid is given it is called with the HDLCInvalidFrame for
+    each bad frame and deframing resumes at the next FLAG; otherwise
+    the error is raised from feed. resyncs and dropped_bytes count the
+    frames and bytes skipped this way.
+    """
+
+    def __init__(self, on_invalid=None):
+        self.on_invalid = on_invalid
+        self.resyncs = 0
+        self.dropped_bytes = 0
+        self.reset()
+
+    def reset(self):
+        """Discard any partial frame, e.g. after an error."""
+        self._buf = b''
+        self._open = False
+
+    def feed(self, data):
+        """Yield the unescaped payload of each frame completed by data."""
+        data = bytes(data)
+        if FLAG_BYTE not in data:
+            self._buf += data
+            return
+        segments = (self._buf + data).split(FLAG_BYTE)
+        self._buf = segments.pop()
+        for segment in segments:
+            if not segment:
+                self._open = True
+                continue
+            try:
+                if not self._open:
+                    raise HDLCInvalidFrame("Missing flags")
+                payload = _unescape(segment)
+            except HDLCInvalidFrame as e:
+                self._open = True
+                self.resyncs += 1
+                self.dropped_bytes += len(segment)
+                if self.on_invalid is None:
+                    raise
+                self.on_invalid(e)
+                continue
+            self._open = False
+            yield payload
@@ -2,29 +2,47 @@ from __future__ import division
 from __future__ import absolute_import
 from __future__ import print_function
 
+from datetime import timedelta
+import socket
 import struct
-import time
 from binascii import hexlify
-from datetime import datetime
-from pytz import UTC
 
 from Crypto.Cipher import AES
 
-import sqlalchemy as sa
-
-from twisted.application import internet
-from twisted.internet import protocol, defer
-from twisted.python import log
+from twisted.application import service
+from twisted.internet import protocol, defer, reactor, task, threads
+from twisted.python import failure, log, threadpool
 
 from c3next import db, lproto
-from c3next.hdlc import hdlc_unframe, HDLCInvalidFrame
+from c3next.hdlc import HDLCDeframer
+from c3next.clock import CLOCK
 from c3next.models import Listener, Beacon
-from c3next.util import derive_key
+from c3next.config import (KEY_CACHE_SIZE, PERSIST_FLUSH_DEPTH,
+                           PERSIST_INTERVAL, PERSIST_MAX_INTERVAL,
+                           PERSIST_MAX_ROWS, PERSIST_MIN_INTERVAL,
+                           PERSIST_SLOW_FACTOR, SYNC_OVERLAP)
+from c3next.events import EVENTS
+from c3next.location import LocationEngine
+from c3next.presence import PRESENCE
+from c3next.state import STATE
+from c3next.util import KeyCache, rssi_distance
 
 HEADER_LENGTH = 3
+IBEACON_SUFFIX = struct.Struct(">HH")
+
+LISTENERS = STATE.listeners
+BEACONS = STATE.beacons
+KEY_CACHE = KeyCache(KEY_CACHE_SIZE)
+LOCATION = LocationEngine()
+
+
+def _forget_key(kind, obj_id, key, fields):
+    if kind == 'beacon' and fields is None:
+        KEY_CACHE.invalidate(key)
+        LOCATION.forget(obj_id)
 
-LISTENERS = {}
-BEACONS = {}
+
+STATE.subscribe(_forget_key)
 
 TABLE_NAME_OBJ_MAP = {'listeners': Listener,
                       'beacons': Beacon}
@@ -37,30 +55,31 @@ class PacketType:
 
 
 class ListenerProtocol(protocol.Protocol):
+    # SecureDecryptor to offload SECURE decryption to, None to decrypt
+    # on the reactor thread
+    decryptor = None
+    # SightingWriter recording every accepted SECURE packet, or None
+    sightings = None
 
     def __init__(self):
-        self._buf = bytearray()
+        self._deframer = HDLCDeframer(on_invalid=self.invalid_frame)
 
     def connectionMade(self):
         self._peer = self.transport.getPeer()
 
+    def connectionLost(self, reason):
+        if self._deframer.resyncs:
+            log.msg("HDLC resyncs from {}: {} ({} bytes dropped)".format(
+                self._peer, self._deframer.resyncs,
+                self._deframer.dropped_bytes))
+
     def dataReceived(self, data):
-        data = bytearray(data)
-        for byte in data:
-            self._buf.append(byte)
-            if byte == 0x7e:
-                if len(self._buf) > 1:
-                    try:
-                        packet = hdlc_unframe(self._buf)
-                    except HDLCInvalidFrame as e:
-                        log.err("Invalid HDLC from {}: {}".format(
-                            self._peer, e))
-                        self.transport.write(b'NACK')
-                        self._buf = bytearray()
-                        return
-                    if len(packet) > 0:
-                        self.do_packet(packet)
-                        self._buf = bytearray()
+        for packet in self._deframer.feed(data):
+            self.do_packet(packet)
+
+    def invalid_frame(self, error):
+        log.err("Invalid HDLC from {}: {}".format(self._peer, error))
+        self.transport.write(b'NACK')
 
     def do_packet(self, packet):
         try:
@@ -79,19 +98,51 @@ class ListenerProtocol(protocol.Protocol):
             LISTENERS[l_id] = l
         else:
             l = LISTENERS[l_id]
-        l['last_seen'] = datetime.now(tz=UTC)
+        now = CLOCK.now()
+        l['last_seen'] = now
+        PRESENCE.seen('listener', l_id, l, now)
+        EVENTS.changed('listener', l)
         if packet_type == PacketType.KEEPALIVE:
             self.transport.write(b'ACK')
             return
         elif packet_type == PacketType.DATA:
-            # log.msg(u"Skipping iBeacon format, currently unimplemented.")
-            self.transport.write(b'ACK')
+            self.do_data(l_id, packet)
             return
 
         elif packet_type == PacketType.SECURE:
             self.do_secure(l_id, packet)
             return
 
+    def do_data(self, l_id, packet):
+        try:
+            records = lproto.iter_ibeacons(lproto.get_data(packet))
+        except lproto.LProtoError as e:
+            log.err(u"Invalid data in packet from: {} @ {}: {}".format(
+                l_id, self._peer, e))
+            self.transport.write(b'NACK')
+            return
+        self.transport.write(b'ACK')
+
+        now = CLOCK.now()
+        for (uuid, major, minor, rssi, txpower) in records:
+            # Plain iBeacons are cached and stored with the secure ones,
+            # under the 20 byte id uuid+major+minor and no key material
+            b_id = uuid + IBEACON_SUFFIX.pack(major, minor)
+            b = BEACONS.get(b_id)
+            if b is None:
+                b = Beacon()
+                b.update({'id': hexlify(b_id).decode(), 'key': b'', 'dk': 0,
+                          'clock': 0})
+                b['name'] = "{}".format(b)
+                BEACONS[b_id] = b
+            distance = rssi_distance(rssi, txpower)
+            b.update({'listener_id': LOCATION.observe(
+                b['id'], l_id, distance, 0.0, now),
+                      'last_seen': now})
+            PRESENCE.seen('beacon', b_id, b, now)
+            EVENTS.changed('beacon', b)
+            self.record_sighting(b, l_id, distance, 0.0, now)
+
     def do_secure(self, l_id, packet):
         data = lproto.get_data(packet)
         if len(data) != 39:
@@ -113,7 +164,7 @@ class ListenerProtocol(protocol.Protocol):
 
         if b_id not in BEACONS:
             b = Beacon()
-            b['id'] = hexlify(b_id)
+            b['id'] = hexlify(b_id).decode()
             BEACONS[b_id] = b
         else:
             b = BEACONS[b_id]
@@ -121,36 +172,45 @@ class ListenerProtocol(protocol.Protocol):
         if 'key' in b and b['key'] is not None:
             b_key = b['key']
         else:
-            b_key = derive_key(b_id)
+            b_key = KEY_CACHE.get(b_id)
 
-        cipher = AES.new(b_key, AES.MODE_EAX, nonce, mac_len=4)
-        cipher.update(b_id)
+        args = (b_key, b_id, nonce, msg, tag)
+        if self.decryptor is None:
+            self.apply_secure(l_id, b_id, b, b_key, distance, variance,
+                              decrypt_secure(*args))
+        else:
+            self.decryptor.submit(args, lambda plaintext: self.apply_secure(
+                l_id, b_id, b, b_key, distance, variance, plaintext))
 
-        try:
-            plaintext = cipher.decrypt_and_verify(msg, tag)
-        except ValueError as decrypt_verify_error:
+    def apply_secure(self, l_id, b_id, b, b_key, distance, variance,
+                     plaintext):
+        if plaintext is None:
             if 'rejected_mac' in b:
                 b['rejected_mac'] += 1
-            log.err("Payload Decipher Error: {}".format(
-                decrypt_verify_error))
+            log.err("Payload Decipher Error: MAC check failed")
             # Packet it ACKd even if decrypt is unsuccessful, because
             # this sort of error can not be caused by the listener
             return
         b['key'] = b_key
 
         (clock, dk, flags) = struct.unpack("<IIB", plaintext)
+        now = CLOCK.now()
 
         if 'clock' not in b:
             # New beacons cannot be verified for relay or DK. Trust on
             # first use
-            origin = time.time() - clock
+            origin = now - clock
             origin = origin if origin > 0 else 0.0
-            b.update({'listener_id': l_id,
+            b.update({'listener_id': LOCATION.observe(
+                b['id'], l_id, distance, variance, now),
                       'name': "{}".format(b),
                       'clock': clock,
                       'dk': dk,
                       'clock_origin': origin,
-                      'last_seen': datetime.now(tz=UTC)})
+                      'last_seen': now})
+            PRESENCE.seen('beacon', b_id, b, now)
+            EVENTS.changed('beacon', b)
+            self.record_sighting(b, l_id, distance, variance, now)
             return
 
         if b['clock'] and (clock < b['clock']):
@@ -163,8 +223,12 @@ class ListenerProtocol(protocol.Protocol):
         if b.valid_dk(dk, clock):
             b.update({'dk': dk,
                       'clock': clock,
-                      'listener_id': l_id,
-                      'last_seen': datetime.now(tz=UTC)})
+                      'listener_id': LOCATION.observe(
+                          b['id'], l_id, distance, variance, now),
+                      'last_seen': now})
+            PRESENCE.seen('beacon', b_id, b, now)
+            EVENTS.changed('beacon', b)
+            self.record_sighting(b, l_id, distance, variance, now)
         else:
             if 'rejected_dk' in b:
                 b['rejected_dk'] += 1
@@ -172,83 +236,312 @@ class ListenerProtocol(protocol.Protocol):
                 b['rejected_dk'] = 1
             log.msg("Invalid DK")
 
-
-class DataPersistanceService(internet.TimerService):
-    def __init__(self, interval):
+    def record_sighting(self, b, l_id, distance, variance, now):
+        if self.sightings is not None:
+            self.sightings.add(b['id'], l_id, distance, variance, now)
+
+
+def decrypt_secure(b_key, b_id, nonce, msg, tag):
+    """ Returns the plaintext of a SECURE payload, or None if the MAC
+    does not verify. Safe to call from any thread. """
+    cipher = AES.new(b_key, AES.MODE_EAX, nonce, mac_len=4)
+    cipher.update(b_id)
+    try:
+        return cipher.decrypt_and_verify(msg, tag)
+    except ValueError:
+        return None
+
+
+def decrypt_secure_batch(batch):
+    return [decrypt_secure(*args) for args in batch]
+
+
+class SecureDecryptor(service.Service):
+    """ Decrypts SECURE payloads in batches on a thread pool.
+
+    Packets are split into one lane per thread by beacon id. Each lane
+    has at most one batch in flight and its callbacks run on the
+    reactor in arrival order, so packets from one beacon are applied
+    in order and the clock replay check still holds.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._pool = threadpool.ThreadPool(size, size, "SecureDecryptor")
+        self._lanes = [[] for _ in range(size)]
+        self._busy = [False] * size
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self._pool.stop()
+
+    def submit(self, args, callback):
+        """ args are those of decrypt_secure, callback takes the result """
+        lane = hash(args[1]) % self.size
+        self._lanes[lane].append((args, callback))
+        if not self._busy[lane]:
+            self._busy[lane] = True
+            # Let the rest of this reactor tick fill the batch
+            reactor.callLater(0, self._flush, lane)
+
+    def _flush(self, lane):
+        batch, self._lanes[lane] = self._lanes[lane], []
+        d = threads.deferToThreadPool(reactor, self._pool,
+                                      decrypt_secure_batch,
+                                      [args for (args, _) in batch])
+        d.addCallback(self._apply, batch)
+        d.addErrback(log.err)
+        d.addBoth(self._done, lane)
+
+    def _apply(self, results, batch):
+        for (_, callback), plaintext in zip(batch, results):
+            try:
+                callback(plaintext)
+            except Exception:
+                log.err()
+
+    def _done(self, _, lane):
+        if self._lanes[lane]:
+            self._flush(lane)
+        else:
+            self._busy[lane] = False
+
+
+class ReusePortServer(service.Service):
+    """ TCP listener bound with SO_REUSEPORT, so several worker
+    processes can listen on the same port and the kernel spreads
+    incoming connections between them """
+    def __init__(self, port, factory, interface=''):
+        self.port = port
+        self.factory = factory
+        self.interface = interface
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.interface, self.port))
+        sock.listen(50)
+        sock.setblocking(False)
+        self._port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET,
+                                             self.factory)
+        # adoptStreamPort dups the descriptor
+        sock.close()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            d, self._port = self._port.stopListening(), None
+            return d
+
+
+class DataPersistanceService(service.Service):
+    """ Write-behind of the caches: writes dirty cache entries to the DB
+    and pulls in rows changed by others. The first flush loads both
+    tables in full, later ones only fetch rows whose updated_at is past
+    the last one seen. With persist False it only syncs, for processes
+    that serve the caches without receiving packets.
+
+    The queue is the classes' dirty sets, so an object changed many
+    times between flushes is written once. A flush runs every interval
+    seconds, or min_interval after the last one once flush_depth
+    objects are waiting, and writes at most max_rows of them. Only one
+    flush is in flight at a time; the next waits at least slow_factor
+    times as long as the last one took, and after failures the
+    interval doubles, up to max_interval.
+
+    Flushes share one connection, which is only given back (and a new
+    one taken) after a flush fails and when the service stops. """
+    def __init__(self, interval=PERSIST_INTERVAL, persist=True,
+                 min_interval=PERSIST_MIN_INTERVAL,
+                 max_interval=PERSIST_MAX_INTERVAL,
+                 flush_depth=PERSIST_FLUSH_DEPTH,
+                 max_rows=PERSIST_MAX_ROWS,
+                 slow_factor=PERSIST_SLOW_FACTOR):
         self.serial = 0
-        internet.TimerService.__init__(self, interval, self._run)
-
-    # @defer.inlineCallbacks
-    # def _resync_listeners(self):
-    #     global LISTENERS
-    #     result = yield self._conn.execute(db.listeners.select())
-    #     result = yield result.fetchall()
-    #     new_cache = {r['id']: Listener(row=r) for r in result}
-    #     for k in new_cache.keys():
-    #         if (k in LISTENERS and
-    #             LISTENERS[k]['last_seen'] > new_cache[k]['last_seen']):
-    #                 new_cache[k] = LISTENERS[k]
-    #         LISTENERS = new_cache
-
-    # @defer.inlineCallbacks
-    # def _resync_beacons(self):
-    #     global BEACONS
-    #     result = yield self._conn.execute(db.beacons.select())
-    #     result = yield result.fetchall()
-    #     new_cache = {r['id']: Beacon(row=r) for r in result}
-    #     for k in new_cache.keys():
-    #         if (k in BEACONS and
-    #             BEACONS[k]['last_seen'] > new_cache[k]['last_seen']):
-    #                 new_cache[k] = BEACONS[k]
-    #         BEACONS = new_cache
-
-    # def _resync(self):
-    #     return defer.DeferredList([self._resync_listeners(),
-    #                                self._resync_beacons()])
+        self.persist = persist
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.flush_depth = flush_depth
+        self.max_rows = max_rows
+        self.slow_factor = slow_factor
+        self.failed_flushes = 0
+        self.rows_written = 0
+        self.last_rows = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._failures = 0
+        self._high_water = {}
+        # cls -> {id: updated_at} of rows read within the overlap
+        self._synced = {}
+        self._scope = db.ConnectionScope()
+        self._flushing = None
+        self._loop = task.LoopingCall(self._check)
+        # The first flush (the full load) is due right away
+        self._due = self._earliest = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop.start(self.min_interval)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop.running:
+            self._loop.stop()
+        # A flush may already be in flight, the second writes the rest
+        yield self.flush()
+        yield self.flush()
+        yield self._scope.close()
+
+    def depth(self):
+        """ Objects waiting to be written """
+        if not self.persist:
+            return 0
+        return len(Listener._dirty_set) + len(Beacon._dirty_set)
+
+    def stats(self):
+        return {'queued': self.depth(), 'flushes': self.serial,
+                'failed_flushes': self.failed_flushes,
+                'rows_written': self.rows_written,
+                'last_rows': self.last_rows,
+                'last_latency': round(self.last_latency, 3),
+                'max_latency': round(self.max_latency, 3),
+                'next_in': round(max(
+                    0, self._due - self._loop.clock.seconds()), 3)}
+
+    def _check(self):
+        if self._flushing is not None:
+            return
+        now = self._loop.clock.seconds()
+        if now >= self._due or (now >= self._earliest and
+                                self.depth() >= self.flush_depth):
+            self.flush()
+
+    def flush(self):
+        """ Start a flush unless one is in flight. Returns a Deferred
+        firing when the flush in flight is done """
+        flushing = self._flushing
+        if flushing is None:
+            # A run that finishes at once has _flushed reset _flushing
+            flushing = self._flushing = self._run()
+            flushing.addBoth(self._flushed, self._loop.clock.seconds())
+        d = defer.Deferred()
+        flushing.addBoth(lambda r: d.callback(None) or r)
+        return d
+
+    def _flushed(self, result, started):
+        self._flushing = None
+        now = self._loop.clock.seconds()
+        self.last_latency = now - started
+        self.max_latency = max(self.max_latency, self.last_latency)
+        if isinstance(result, failure.Failure):
+            log.err(result, "Persist {} failed".format(self.serial))
+            self.failed_flushes += 1
+            self._failures += 1
+        else:
+            self._failures = 0
+        # Back off while the DB is slow or failing
+        pause = self.last_latency * self.slow_factor
+        if self._failures:
+            pause = max(pause, self.interval * 2 ** self._failures)
+        self._due = now + min(max(self.interval, pause), self.max_interval)
+        self._earliest = now + min(max(self.min_interval, pause),
+                                   self.max_interval)
+
+    @defer.inlineCallbacks
+    def _sync(self, cls, cache, kind):
+        """ Pull rows changed in the DB since the last pass into cache,
+        returning how many were new or changed """
+        table = cls._table
+        query = table.select()
+        high_water = self._high_water.get(cls)
+        synced = self._synced.setdefault(cls, {})
+        if high_water is not None:
+            # now() is the transaction start, so rows committed late
+            # can carry an older stamp than ones already seen; a slow
+            # DB commits later still
+            since = high_water - max(
+                SYNC_OVERLAP, timedelta(seconds=2 * self.max_latency))
+            query = query.where(table.c.updated_at > since)
+            for (obj_id, updated_at) in list(synced.items()):
+                if updated_at <= since:
+                    del synced[obj_id]
+        rp = yield self._scope.execute(query)
+        rows = yield rp.fetchall()
+        count = 0
+        for r in rows:
+            if high_water is None or r['updated_at'] > high_water:
+                high_water = r['updated_at']
+            # Read again only because of the overlap
+            if synced.get(r['id']) == r['updated_at']:
+                continue
+            synced[r['id']] = r['updated_at']
+            try:
+                key = STATE.cache_key(kind, r['id'])
+            except (TypeError, ValueError):
+                log.msg("Skipping {} with bad id {!r}".format(kind, r['id']))
+                continue
+            count += 1
+            obj = cache.get(key)
+            if obj is None:
+                obj = cache[key] = cls(row=r)
+                PRESENCE.seen_row(kind, key, obj)
+                EVENTS.changed(kind, obj)
+            else:
+                stamp = obj.stamp
+                PRESENCE.seen_row(kind, key, obj.refresh(r))
+                if obj.stamp != stamp:
+                    EVENTS.changed(kind, obj)
+        self._high_water[cls] = high_water
+        defer.returnValue(count)
+
+    @defer.inlineCallbacks
+    def _persist(self, cls, limit):
+        """ Upsert up to limit instances of cls changed since the last
+        flush, returning how many were written """
+        dirty = [o for o in cls.drain_dirty(limit) if o.needs_persist_p()]
+        rows = [o.dirty_pk_dict() for o in dirty]
+        if not rows:
+            defer.returnValue(0)
+        try:
+            yield cls.upsert(rows, conn=self._scope)
+        except Exception:
+            cls._dirty_set.update(dirty)
+            raise
+        for o, row in zip(dirty, rows):
+            o.mark_clean(row)
+        defer.returnValue(len(rows))
 
     @defer.inlineCallbacks
     def _run(self):
-        log.msg("Running persist {}".format(self.serial))
-        self._conn = yield db.get_connection()
-        # if self.serial % SYNC_INTERVAL == 0:
-        #     self.serial =+ 1
-        #     t1 = time.time()
-        #     yield self._resync()
-        #     t2 = time.time()
-        #     log.msg("Resync Completed in {} seconds".format(t2 - t1))
-
-        # Listeners
-        # Get listeners missing from cache
-        cur = yield self._conn.execute(sa.select([db.listeners.c.id]))
-        rp = yield cur.fetchall()
-        missing_from_cache_id = [r for (r,) in rp if r not in LISTENERS]
-        missing_from_cache = yield Listener.fetch_many(
-            missing_from_cache_id, conn=self._conn)
-        missing_dict = {r['id']: r for r in missing_from_cache}
-        LISTENERS.update(missing_dict)
-
-        # Send Updates
-        dirty_listeners = [
-            a.dirty_pk_dict() for a in LISTENERS.values(
-            ) if a.needs_persist_p()]
-        if dirty_listeners is not []:
-            yield Listener.upsert(dirty_listeners, conn=self._conn)
-
-        # Beacons
-        # Get beacons missing from cache
-        cur = yield self._conn.execute(sa.select([db.beacons.c.id]))
-        rp = yield cur.fetchall()
-        missing_from_cache_id = [r for (r,) in rp if r not in BEACONS]
-        missing_from_cache = yield Beacon.fetch_many(
-            missing_from_cache_id, conn=self._conn)
-        missing_dict = {r['id']: r for r in missing_from_cache}
-        BEACONS.update(missing_dict)
-
-        # Send Updates
-        dirty_beacons = [
-            a.dirty_pk_dict() for a in BEACONS.values() if a.needs_persist_p()]
-        if dirty_beacons is not []:
-            yield Beacon.upsert(dirty_beacons, conn=self._conn)
-
-        yield self._conn.close()
+        log.msg("Running persist {}, key cache: {}, location: {}, "
+                "presence: {}, queue: {}, pool: {}".format(
+                    self.serial, KEY_CACHE.stats(), LOCATION.stats(),
+                    PRESENCE.stats(), self.stats(), db.POOL_STATS.stats()))
+        try:
+            # Listeners first, beacons reference them
+            written = 0
+            synced = yield self._sync(Listener, LISTENERS, 'listener')
+            if self.persist:
+                written += yield self._persist(Listener, self.max_rows)
+            synced += yield self._sync(Beacon, BEACONS, 'beacon')
+            if self.persist:
+                written += yield self._persist(
+                    Beacon, self.max_rows - written)
+        except Exception:
+            # The connection may be broken, the next flush takes another
+            f = failure.Failure()
+            yield self._scope.close().addErrback(log.err)
+            f.raiseException()
+        if synced:
+            log.msg("Synced {} changed rows".format(synced))
+        self.last_rows = written
+        self.rows_written += written
         self.serial += 1
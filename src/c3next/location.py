@@ -0,0 +1,164 @@
+""" Nearest-listener estimation for beacons heard by several listeners.
+
+Each beacon keeps its last few sightings, (listener, distance,
+variance, time), in a ring. The listener with the best variance
+weighted distance over the ring is the likely one, but a beacon only
+moves to it once it has stayed the best for several sightings in a
+row, so a beacon between listeners does not flap between them (each
+flap is a listener_id write and a beacon_logs row).
+"""
+from __future__ import absolute_import, division
+
+from array import array
+import math
+
+from c3next.config import (LOCATION_MARGIN, LOCATION_MAX_AGE,
+                           LOCATION_MIN_VARIANCE, LOCATION_STABLE_COUNT,
+                           LOCATION_WINDOW)
+
+# Listener number of an empty ring entry, and of no current listener
+NONE = -1
+
+
+class LocationEngine(object):
+    """ The rings of every beacon live in flat arrays, window entries
+    per beacon slot, with listener ids interned to small ints; slots
+    of forgotten beacons are reused.
+
+    A listener's score is the inverse-variance weighted mean of its
+    distances in the ring plus the standard error of that mean, so few
+    or noisy sightings count against it. Another listener becomes the
+    candidate only when it scores margin metres below the current one.
+    Sightings older than max_age seconds are ignored. """
+    def __init__(self, window=LOCATION_WINDOW, stable=LOCATION_STABLE_COUNT,
+                 margin=LOCATION_MARGIN, max_age=LOCATION_MAX_AGE,
+                 min_variance=LOCATION_MIN_VARIANCE):
+        self.window = window
+        self.stable = stable
+        self.margin = margin
+        self.max_age = max_age
+        self.min_variance = min_variance
+        # Sightings whose listener differs from the beacon's previous
+        # sighting (the writes of "last listener wins"), and changes
+        # of the estimate actually made
+        self.flaps = 0
+        self.switches = 0
+        self._slots = {}
+        self._free = []
+        self._listener_numbers = {}
+        self._listener_ids = []
+        # Per window entry
+        self._listener = array('i')
+        self._distance = array('f')
+        self._weight = array('f')
+        self._time = array('d')
+        # Per slot
+        self._head = array('H')
+        self._current = array('i')
+        self._candidate = array('i')
+        self._streak = array('H')
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        if self._free:
+            slot = self._free.pop()
+            start = slot * self.window
+            for i in range(start, start + self.window):
+                self._listener[i] = NONE
+            self._head[slot] = 0
+            self._current[slot] = NONE
+            self._candidate[slot] = NONE
+            self._streak[slot] = 0
+        else:
+            slot = len(self._head)
+            self._listener.extend([NONE] * self.window)
+            self._distance.extend([0.0] * self.window)
+            self._weight.extend([0.0] * self.window)
+            self._time.extend([0.0] * self.window)
+            self._head.append(0)
+            self._current.append(NONE)
+            self._candidate.append(NONE)
+            self._streak.append(0)
+        self._slots[key] = slot
+        return slot
+
+    def _listener_number(self, l_id):
+        number = self._listener_numbers.get(l_id)
+        if number is None:
+            number = self._listener_numbers[l_id] = len(self._listener_ids)
+            self._listener_ids.append(l_id)
+        return number
+
+    def _best(self, slot, now):
+        """ The listener number with the lowest score in slot's ring,
+        and the scores of the listeners present """
+        weights = {}
+        weighted = {}
+        oldest = now - self.max_age
+        start = slot * self.window
+        for i in range(start, start + self.window):
+            listener = self._listener[i]
+            if listener == NONE or self._time[i] < oldest:
+                continue
+            w = self._weight[i]
+            weights[listener] = weights.get(listener, 0.0) + w
+            weighted[listener] = (weighted.get(listener, 0.0) +
+                                  w * self._distance[i])
+        scores = {listener: weighted[listener] / w + math.sqrt(1 / w)
+                  for (listener, w) in weights.items()}
+        best = min(scores, key=scores.get) if scores else NONE
+        return best, scores
+
+    def observe(self, key, l_id, distance, variance, now):
+        """ Record a sighting of beacon key by l_id (now in epoch
+        seconds) and return the listener id the beacon is at """
+        slot = self._slot(key)
+        listener = self._listener_number(l_id)
+        head = self._head[slot]
+        start = slot * self.window
+        previous = self._listener[start + (head - 1) % self.window]
+        if previous != NONE and previous != listener:
+            self.flaps += 1
+        i = start + head
+        self._listener[i] = listener
+        self._distance[i] = distance
+        self._weight[i] = 1 / max(variance, self.min_variance)
+        self._time[i] = now
+        self._head[slot] = (head + 1) % self.window
+
+        best, scores = self._best(slot, now)
+        current = self._current[slot]
+        if current == NONE or current not in scores:
+            # Nothing to hold on to
+            if current != NONE:
+                self.switches += 1
+            self._current[slot] = current = best
+            self._streak[slot] = 0
+        elif best == current or \
+                scores[best] + self.margin >= scores[current]:
+            self._streak[slot] = 0
+        else:
+            if best == self._candidate[slot]:
+                self._streak[slot] += 1
+            else:
+                self._candidate[slot] = best
+                self._streak[slot] = 1
+            if self._streak[slot] >= self.stable:
+                self._current[slot] = current = best
+                self._streak[slot] = 0
+                self.switches += 1
+        return self._listener_ids[current]
+
+    def forget(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def stats(self):
+        return {'beacons': len(self._slots), 'flaps': self.flaps,
+                'switches': self.switches}
@@ -1,10 +1,15 @@
 import enum
+import struct
 from binascii import hexlify
 
 import six
 
 HEADER_LENGTH = 3
 
+# One iBeacon advertisement in a DATA payload: UUID, major, minor,
+# RSSI and txpower
+IBEACON = struct.Struct(">16sHHbb")
+
 
 class PacketType(enum.IntEnum):
     KEEPALIVE = 0
@@ -24,6 +29,10 @@ class InvalidListenerId(LProtoError):
     pass
 
 
+class InvalidData(LProtoError):
+    pass
+
+
 def ensure_header_length(packet):
     if len(packet) < HEADER_LENGTH:
         raise InvalidHeader
@@ -61,3 +70,20 @@ def get_listener_id(packet):
 def get_data(packet):
     lid_len = get_listener_id_len(packet)
     return packet[HEADER_LENGTH+lid_len:]
+
+
+def _iter_unpack(fmt, data):
+    if hasattr(fmt, 'iter_unpack'):
+        return fmt.iter_unpack(data)
+    return (fmt.unpack_from(data, offset)
+            for offset in range(0, len(data), fmt.size))
+
+
+def iter_ibeacons(data):
+    """ (uuid, major, minor, rssi, txpower) for each advertisement in
+    a DATA payload, unpacked in place without slicing per record """
+    if len(data) % IBEACON.size:
+        raise InvalidData(
+            "DATA length ({}) is not a multiple of {}".format(
+                len(data), IBEACON.size))
+    return _iter_unpack(IBEACON, data)
@@ -1,39 +1,90 @@
-from binascii import hexlify
-from datetime import datetime
-from functools import reduce
-import operator
+import itertools
 import json
-from pytz import UTC
-from calendar import timegm
+
+import six
 
 from twisted.internet import defer
 from twisted.python import log
 
 import c3next.db as db
 from c3next.config import (DK0_INTERVAL, DK1_INTERVAL,
-                           BEACON_LISTENER_TIMEOUT)
-from c3next.util import evolve_dk
+                           UPSERT_CHUNK_SIZE,
+                           COPY_UPSERT_THRESHOLD)
+from c3next.clock import to_datetime, to_timestamp
+from c3next.serializer import dumps, hex_bytes, to_json_type
+from c3next.util import evolve_dk_many
 
+import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import insert
 
+# (table name, sorted column names) -> upsert query
+_UPSERT_QUERIES = {}
+
 
 class BytesEncoder(json.JSONEncoder):
+    """ For json.dumps callers; serializer.dumps is faster """
     def default(self, obj):
-        if isinstance(obj, datetime):
-            return timegm(obj.utctimetuple())
-        if isinstance(obj, DirtyContainer):
-            return obj.flatten()
-        return json.JSONEncoder(self, obj)
+        return to_json_type(obj)
+
+
+def _json_converter(column_type):
+    if isinstance(column_type, sa.DateTime):
+        # Held as epoch seconds, see clock
+        return int
+    if isinstance(column_type, sa.LargeBinary):
+        return hex_bytes
+    return None
 
 
 class MissingData(KeyError):
     pass
 
 
+# Marks a field that has not been populated
+_MISSING = object()
+# Source of DirtyContainer.stamp, increasing on every change
+_STAMPS = itertools.count(1)
+
+
+class ContainerType(type):
+    """ Precomputes the field layout of each DirtyContainer class, so
+    instances only carry their values and a dirty bitmask """
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        if cls._table is not None:
+            # Plain str, column names are a str subclass orjson rejects
+            cls._fields = tuple(str(col.name) for col in cls._table.columns)
+            cls._field_index = {f: i for (i, f) in enumerate(cls._fields)}
+            if cls._pk_column is None:
+                cls._pk_column = cls._table.c.id
+            cls._pk = cls._pk_column.name
+            # Indexes of the DateTime fields, held as epoch seconds
+            cls._time_fields = tuple(
+                i for (i, f) in enumerate(cls._fields)
+                if isinstance(cls._table.c[f].type, sa.DateTime))
+            # (index, name, JSON conversion or None) of public fields
+            cls._json_fields = tuple(
+                (i, f, _json_converter(cls._table.c[f].type))
+                for (i, f) in enumerate(cls._fields)
+                if f not in cls._private_fields)
+
+
+@six.add_metaclass(ContainerType)
 class DirtyContainer(object):
+    __slots__ = ('_values', '_dirty', '_stamp')
     _private_fields = []
     _table = None
     _pk_column = None
+    # Column that only moves forward; an upsert carrying an older value
+    # than the stored row is not applied, so several processes writing
+    # the same row cannot roll it back
+    _upsert_guard = None
+    _fields = ()
+    _json_fields = ()
+    _time_fields = ()
+    _field_index = {}
+    # Children must provide their own set of dirty instances
+    _dirty_set = None
 
     @classmethod
     @defer.inlineCallbacks
@@ -52,70 +103,76 @@ class DirtyContainer(object):
         if cls._table is None:
             raise NotImplementedError(
                 "Must specify _table in {}".format(cls.__name__))
-        if cls._pk_column is None:
-            pk_c = cls._table.c.id
-        else:
-            pk_c = cls._pk_column
-        if not conn:
-            _conn = yield db.get_connection()
-        else:
-            _conn = conn
-        rp = yield _conn.execute(cls._table.select().where(
-            pk_c.in_(id_list)))
-        results = yield rp.fetchall()
-        if not conn:
-            yield _conn.close()
+        query = cls._table.select().where(cls._pk_column.in_(id_list))
+
+        @defer.inlineCallbacks
+        def fetch(_conn):
+            rp = yield _conn.execute(query)
+            results = yield rp.fetchall()
+            defer.returnValue(results)
+        results = yield db.with_connection(conn, fetch)
         if results:
             defer.returnValue([cls(r) for r in results])
         else:
             defer.returnValue([])
 
     def __init__(self, row=None):
-        self._dirty = []
-        self._fields = [col.name for col in self._table.columns]
         if self._table is None:
             raise NotImplementedError(
                 "Children of DirtyContainer must override _table")
-        if self._pk_column is None:
-            self._pk_column = self._table.c.id
-        self._pk = self._pk_column.name
+        self._dirty = 0
+        self._stamp = next(_STAMPS)
         if row is not None:
-            for f in self._fields:
-                self[f] = row[f]
-            self.mark_clean()
+            self._values = [row[f] for f in self._fields]
+            for i in self._time_fields:
+                self._values[i] = to_timestamp(self._values[i])
+        else:
+            self._values = [_MISSING] * len(self._fields)
 
-    def __setitem__(self, key, value):
-        if key not in self._fields:
+    def _index(self, key):
+        try:
+            return self._field_index[key]
+        except KeyError:
             raise KeyError("Invalid field for Container")
-        if key in self.__dict__ and self.__dict__[key] == value:
+
+    def __setitem__(self, key, value):
+        i = self._index(key)
+        if self._values[i] is not _MISSING and self._values[i] == value:
             return
-        self.__dict__[key] = value
-        if key not in self._dirty:
-            self._dirty.append(key)
+        self._values[i] = value
+        self._dirty |= 1 << i
+        self._stamp = next(_STAMPS)
+        self._dirty_set.add(self)
 
     def __getitem__(self, key):
-        if key not in self._fields:
-            raise KeyError("Invalid field for Container")
-        try:
-            return self.__dict__[key]
-        except KeyError:
+        value = self._values[self._index(key)]
+        if value is _MISSING:
             raise MissingData("Proxy Container not populated")
+        return value
 
     def __contains__(self, key):
-        return key in self.__dict__ and key in self._fields
+        i = self._field_index.get(key)
+        return i is not None and self._values[i] is not _MISSING
+
+    @property
+    def stamp(self):
+        """ Changes whenever a value does, later changes get higher
+        stamps """
+        return self._stamp
 
     def complete_p(self):
-        return reduce(operator.and_,
-                      (key in self for key in self._fields))
+        return _MISSING not in self._values
 
     def dirty_p(self):
-        return self._dirty is not []
+        return bool(self._dirty)
 
     def dirty_fields(self):
-        return self._dirty
+        return [f for (i, f) in enumerate(self._fields)
+                if self._dirty & (1 << i)]
 
     def dirty_dict(self):
-        return {k: self.__dict__[k] for k in self._dirty}
+        return {f: self._values[i] for (i, f) in enumerate(self._fields)
+                if self._dirty & (1 << i)}
 
     def dirty_pk_dict(self):
         """ PK is needed in dirty dict for multi-insert/update """
@@ -131,6 +188,21 @@ class DirtyContainer(object):
             dd['clock'] = self['clock']
         return dd
 
+    def refresh(self, row):
+        """ Take values from a DB row (or a dict of some fields) for
+        every field not changed locally, without marking them dirty """
+        changed = False
+        for (f, value) in row.items():
+            i = self._field_index[f]
+            if i in self._time_fields:
+                value = to_timestamp(value)
+            if not self._dirty & (1 << i) and self._values[i] != value:
+                self._values[i] = value
+                changed = True
+        if changed:
+            self._stamp = next(_STAMPS)
+        return self
+
     def update(self, d):
         for key in d.keys():
             self[key] = d[key]
@@ -139,77 +211,177 @@ class DirtyContainer(object):
     def needs_persist_p(self):
         return self.dirty_p()
 
-    def mark_clean(self):
-        self._dirty = []
+    def mark_clean(self, persisted=None):
+        """ Without persisted, mark every field clean. Otherwise only
+        fields whose value still matches the persisted dict are marked
+        clean, so changes made while a write was in flight survive """
+        if persisted is None:
+            self._dirty = 0
+        else:
+            for (k, v) in persisted.items():
+                i = self._field_index[k]
+                if self._values[i] == v:
+                    self._dirty &= ~(1 << i)
+        if not self._dirty:
+            self._dirty_set.discard(self)
+
+    @classmethod
+    def drain_dirty(cls, limit=None):
+        """ Return and forget the instances changed since the last drain,
+        at most limit of them """
+        if limit is None or len(cls._dirty_set) <= limit:
+            dirty = list(cls._dirty_set)
+            cls._dirty_set.clear()
+        else:
+            pop = cls._dirty_set.pop
+            dirty = [pop() for _ in range(limit)]
+        return dirty
 
     def merge(self, existing):
         return existing.update(self)
 
     def flatten(self):
-        flat_dict = {
-            k: self.__dict__[k] for k in self.__dict__.keys(
-            ) if k in self._fields}
-        for private in self._private_fields:
-            if private in flat_dict:
-                del flat_dict[private]
-        for binary_field in ['key']:
-            if binary_field in flat_dict:
-                if flat_dict[binary_field] is not None:
-                    flat_dict[binary_field] = hexlify(
-                        flat_dict[binary_field])
-        return json.dumps(flat_dict, cls=BytesEncoder)
+        """ Public fields as UTF-8 encoded JSON """
+        return dumps(self.json_dict())
+
+    def flat_dict(self):
+        """ Public fields as a dict, binary ones as hex and DateTime
+        ones as epoch seconds """
+        values = self._values
+        flat_dict = {}
+        for (i, f, convert) in self._json_fields:
+            v = values[i]
+            if v is _MISSING:
+                continue
+            if convert is hex_bytes and v is not None:
+                v = hex_bytes(v)
+            flat_dict[f] = v
+        return flat_dict
+
+    def json_dict(self):
+        """ flat_dict with every value converted for JSON, DateTime
+        fields as whole epoch seconds """
+        values = self._values
+        json_dict = {}
+        for (i, f, convert) in self._json_fields:
+            v = values[i]
+            if v is _MISSING:
+                continue
+            json_dict[f] = v if convert is None or v is None else convert(v)
+        return json_dict
 
     @defer.inlineCallbacks
     def delete(self, conn=None):
         query = self._table.delete().where(
             self._pk_column == self[self._pk])
-        if conn is None:
-            rp = yield db.execute(query)
-            rp.close()
-        else:
-            yield conn.execute(query)
+        rp = yield db.with_connection(
+            conn, lambda _conn: _conn.execute(query))
+        yield rp.close()
 
     @defer.inlineCallbacks
     def save(self, conn=None):
+        """ Write the changed fields of an edit. An existing row has only
+        those columns updated, without the upsert guard, so an edit made
+        from an older read of the row is not dropped; a missing row is
+        upserted """
         if self.dirty_p():
             log.msg("Updated {}".format(self))
+            values = {f: to_datetime(v)
+                      if self._field_index[f] in self._time_fields else v
+                      for (f, v) in self.dirty_dict().items()}
+            query = self._table.update().where(
+                self._pk_column == self[self._pk]).values(values)
+
+            @defer.inlineCallbacks
+            def update(_conn):
+                rp = yield _conn.execute(query)
+                updated = rp.rowcount
+                yield rp.close()
+                defer.returnValue(updated)
             try:
-                yield self.__class__.upsert(
-                    self.dirty_pk_dict(), conn=conn)
-            except Exception as e:
-                raise e
+                updated = yield db.with_connection(conn, update)
+                if not updated:
+                    yield self.__class__.upsert(
+                        self.dirty_pk_dict(), conn=conn)
+            except Exception:
+                # Edits are saved by whoever made them; a failed save must
+                # not leave a detached copy queued for the next persist
+                self._dirty_set.discard(self)
+                raise
+            self.mark_clean()
+
+    @classmethod
+    def _upsert_query(cls, keys):
+        """ INSERT ... ON CONFLICT updating only keys, cached per key set """
+        cache_key = (cls._table.name, keys)
+        if cache_key not in _UPSERT_QUERIES:
+            query = insert(cls._table)
+            guard = cls._upsert_guard
+            if guard in keys:
+                where = sa.or_(cls._table.c[guard].is_(None),
+                               cls._table.c[guard] <= query.excluded[guard])
             else:
-                self.mark_clean()
+                where = None
+            _UPSERT_QUERIES[cache_key] = query.on_conflict_do_update(
+                index_elements=[cls._table.c.id], set_={
+                    k: query.excluded[k] for k in keys if k != 'id'},
+                where=where)
+        return _UPSERT_QUERIES[cache_key]
+
+    @classmethod
+    def _copy_columns(cls, keys):
+        """ Columns to COPY for rows with keys, with the scalar defaults
+        an INSERT would have filled in for the others """
+        defaults = {c.name: c.default.arg for c in cls._table.columns
+                    if c.name not in keys and c.default is not None and
+                    c.default.is_scalar}
+        return list(keys) + sorted(defaults), defaults
 
     @classmethod
     @defer.inlineCallbacks
     def upsert(cls, upsertable, conn=None):
+        """ Insert or update rows. Rows only overwrite the columns they
+        carry, DateTime ones as datetimes or epoch seconds. Groups of
+        COPY_UPSERT_THRESHOLD rows or more are COPYed through a temp
+        table, smaller ones are sent as multi-row INSERTs of at most
+        UPSERT_CHUNK_SIZE rows """
         if upsertable in [[], {}]:
             log.msg("Null Upsert")
             defer.returnValue(None)
-        if isinstance(upsertable, list):
-            # Problems if member dicts of list have different numbers
-            # of fields, must separate
-            sort_dict = {}
-            for d in upsertable:
-                hsh = ''.join(sorted(d.keys()))
-                if hsh not in sort_dict:
-                    sort_dict[hsh] = [d]
-                else:
-                    sort_dict[hsh].append(d)
-            upsertable = sort_dict.values()
-        else:
+        if not isinstance(upsertable, list):
             upsertable = [upsertable]
-        for i in upsertable:
-            query = insert(cls._table, i)
-            conflict_query = query.on_conflict_do_update(
-                index_elements=[cls._table.c.id], set_={
-                    a.name: a for a in query.excluded if a is not None})
-            if conn is None:
-                rp = yield db.execute(conflict_query)
+        # Problems if member dicts of list have different numbers
+        # of fields, must separate
+        groups = {}
+        for d in upsertable:
+            groups.setdefault(tuple(sorted(d.keys())), []).append(d)
+        yield db.with_connection(conn, cls._upsert_groups, groups)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _upsert_groups(cls, _conn, groups):
+        """ upsert() of rows grouped by their sorted keys """
+        for keys, rows in groups.items():
+            times = [k for k in keys
+                     if cls._field_index.get(k) in cls._time_fields]
+            if times:
+                rows = [dict(r, **{k: to_datetime(r[k]) for k in times})
+                        for r in rows]
+            if len(rows) >= COPY_UPSERT_THRESHOLD:
+                columns, defaults = cls._copy_columns(keys)
+                if defaults:
+                    rows = [dict(defaults, **r) for r in rows]
+                yield db.copy_upsert(
+                    _conn, cls._table, columns,
+                    [k for k in keys if k != 'id'], rows,
+                    guard=cls._upsert_guard if cls._upsert_guard in keys
+                    else None)
+                continue
+            query = cls._upsert_query(keys)
+            for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+                rp = yield _conn.execute(
+                    query.values(rows[i:i+UPSERT_CHUNK_SIZE]))
                 yield rp.close()
-            else:
-                yield conn.execute(conflict_query)
 
     def __repr__(self):
         if 'name' in self and self['name'] is not None:
@@ -220,39 +392,60 @@ class DirtyContainer(object):
 
 
 class LastSeenable(DirtyContainer):
+    """ Missing until presence.PRESENCE has seen it recently; see
+    there """
+    __slots__ = ('_missing',)
+
+    def __init__(self, row=None):
+        self._missing = True
+        DirtyContainer.__init__(self, row=row)
+
     def missing_p(self):
-        if 'last_seen' not in self:
-            return True
-        min_age = datetime.now(tz=UTC) - BEACON_LISTENER_TIMEOUT
-        return self['last_seen'] < min_age
+        return self._missing
+
+    def set_missing(self, missing):
+        if missing != self._missing:
+            self._missing = missing
+            self._stamp = next(_STAMPS)
+
+    def json_dict(self):
+        json_dict = DirtyContainer.json_dict(self)
+        json_dict['missing'] = self._missing
+        return json_dict
 
     def needs_persist_p(self):
         return DirtyContainer.needs_persist_p(self) and not self.missing_p()
 
 
 class Listener(LastSeenable):
+    __slots__ = ()
     _table = db.listeners
+    _upsert_guard = 'last_seen'
+    _dirty_set = set()
 
     def __init__(self, row=None):
-        DirtyContainer.__init__(self, row=row)
+        LastSeenable.__init__(self, row=row)
 
 
 class Beacon(LastSeenable):
+    __slots__ = ()
     _table = db.beacons
+    _upsert_guard = 'clock'
+    _dirty_set = set()
     _private_fields = ['key', 'dk', 'clock']
 
     def __init__(self, row=None):
-        DirtyContainer.__init__(self, row=row)
+        LastSeenable.__init__(self, row=row)
 
     def valid_dk(self, new_dk, new_clock):
-        # Reset and calculate mask
-        mask = 0xffffffff
-        b_dk = self['dk']
-        for i in range(self['clock']+1, new_clock+1):
-            if i % DK0_INTERVAL == 0:
-                b_dk, mask = evolve_dk(b_dk, mask, 0)
-            if i % DK1_INTERVAL == 0:
-                b_dk, mask = evolve_dk(b_dk, mask, 1)
+        # Reset and calculate mask. Evolve once for every DK0/DK1
+        # interval boundary in (clock, new_clock]
+        clock = self['clock']
+        b_dk, mask = evolve_dk_many(
+            self['dk'], 0xffffffff, 0,
+            new_clock // DK0_INTERVAL - clock // DK0_INTERVAL)
+        b_dk, mask = evolve_dk_many(
+            b_dk, mask, 1, new_clock // DK1_INTERVAL - clock // DK1_INTERVAL)
         # If the beacon has been out of sight long enough that we have
         # no contemporary dk info
         if mask == 0:
@@ -0,0 +1,160 @@
+""" Missing beacon and listener detection.
+
+Every sighting re-arms a timer for the object, BEACON_LISTENER_TIMEOUT
+after it; when one expires the object is marked missing and a change
+event is sent. missing_p() then only reads that flag, instead of doing
+datetime arithmetic for each object on each check.
+"""
+from __future__ import absolute_import, division
+
+import time
+
+from twisted.application import internet
+from twisted.python import log
+
+from c3next.config import BEACON_LISTENER_TIMEOUT, PRESENCE_RESOLUTION
+from c3next.events import EVENTS
+from c3next.state import STATE
+
+
+class TimingWheel(object):
+    """ Hierarchical timing wheel of keys and deadlines (epoch seconds),
+    in ticks of resolution seconds. Level 0 has a slot per tick for
+    the next `slots` ticks, each level above covers `slots` times the
+    span of the one below, and its slots are cascaded down as the
+    lower level wraps around.
+
+    Re-arming a key already in the wheel only updates its deadline; the
+    old slot re-places it when it comes up, so frequent re-arming costs
+    a dict store and each key moves through at most a slot per level
+    per timeout. """
+    def __init__(self, resolution, now, slots=64, levels=3):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self._tick = int(now // resolution)
+        self._deadlines = {}
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    @property
+    def now(self):
+        """ Start of the current tick, in epoch seconds """
+        return self._tick * self.resolution
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        """ Expire key at deadline, unless it is already scheduled for
+        later """
+        tick = -int(-deadline // self.resolution)
+        scheduled = self._deadlines.get(key)
+        if scheduled is None:
+            self._deadlines[key] = tick
+            self._place(key, tick)
+        elif tick > scheduled:
+            self._deadlines[key] = tick
+
+    def _place(self, key, tick, due=1):
+        """ Put key in the slot for tick, or due ticks from now if that
+        is later; the current tick's level 0 slot is only still to come
+        while cascading """
+        tick = max(tick, self._tick + due)
+        delta = tick - self._tick
+        level, span = 0, self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        if delta >= span:
+            # Past the top level; re-placed when its slot comes up
+            tick = self._tick + span - 1
+        slot = (tick // (span // self.slots)) % self.slots
+        self._wheels[level][slot].append(key)
+
+    def advance(self, now):
+        """ Move to now and return the keys whose deadline passed """
+        target = int(now // self.resolution)
+        expired = []
+        deadlines = self._deadlines
+        while self._tick < target:
+            self._tick += 1
+            tick = self._tick
+            # Cascade from the top so keys land in level 0 in time
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if tick % span == 0:
+                    slot = (tick // span) % self.slots
+                    keys = self._wheels[level][slot]
+                    self._wheels[level][slot] = []
+                    for key in keys:
+                        self._place(key, deadlines[key], due=0)
+            slot = tick % self.slots
+            keys = self._wheels[0][slot]
+            self._wheels[0][slot] = []
+            for key in keys:
+                deadline = deadlines[key]
+                if deadline <= tick:
+                    del deadlines[key]
+                    expired.append(key)
+                else:
+                    # Re-armed since it was placed
+                    self._place(key, deadline)
+        return expired
+
+
+class PresenceTracker(object):
+    """ Marks the cached beacons and listeners missing once they have
+    not been seen for timeout seconds """
+    def __init__(self, timeout, resolution, now=None):
+        self.timeout = timeout
+        self.wheel = TimingWheel(resolution,
+                                 time.time() if now is None else now)
+        self.went_missing = 0
+
+    def seen(self, kind, key, obj, when):
+        """ obj, cached under key, was seen at when (epoch seconds) """
+        deadline = when + self.timeout
+        if deadline <= self.wheel.now:
+            # Missing already, e.g. an old row loaded from the DB
+            return
+        self.wheel.schedule((kind, key), deadline)
+        if obj.missing_p():
+            obj.set_missing(False)
+
+    def seen_row(self, kind, key, obj):
+        """ seen() for obj's last_seen, after loading it from the DB """
+        if 'last_seen' in obj and obj['last_seen'] is not None:
+            self.seen(kind, key, obj, obj['last_seen'])
+
+    def expire(self, now):
+        for (kind, key) in self.wheel.advance(now):
+            cache = STATE.beacons if kind == 'beacon' else STATE.listeners
+            obj = cache.get(key)
+            if obj is not None and not obj.missing_p():
+                obj.set_missing(True)
+                self.went_missing += 1
+                EVENTS.changed(kind, obj)
+
+    def stats(self):
+        return {'tracked': len(self.wheel), 'went_missing': self.went_missing}
+
+
+class PresenceService(internet.TimerService):
+    """ Expires the timers of tracker every resolution seconds """
+    def __init__(self, tracker):
+        self.tracker = tracker
+        internet.TimerService.__init__(
+            self, tracker.wheel.resolution, self._expire)
+
+    def _expire(self):
+        try:
+            self.tracker.expire(time.time())
+        except Exception:
+            log.err(None, "Missing detection failed")
+
+
+PRESENCE = PresenceTracker(BEACON_LISTENER_TIMEOUT.total_seconds(),
+                           PRESENCE_RESOLUTION)
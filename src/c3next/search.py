@@ -0,0 +1,145 @@
+""" Name and id search for beacons and listeners.
+
+In the DB, searches are substring LIKEs over lower(name) and lower(id),
+served by the pg_trgm GIN indexes, and ranked with prefix matches first,
+then by trigram similarity. NgramIndex answers the same searches from
+the in-memory caches, for when the DB is unavailable and for the live
+JSON endpoints.
+"""
+from __future__ import absolute_import
+
+import heapq
+import time
+from collections import defaultdict
+
+import sqlalchemy as sa
+
+from c3next.config import SEARCH_REFRESH_INTERVAL
+from c3next.state import STATE
+
+
+def search_clause(terms, fields):
+    """ Rows where any field contains any term, ignoring case for
+    string fields, or None without terms """
+    or_payload = []
+    for h in terms:
+        for sf in fields:
+            if isinstance(sf.type, sa.sql.sqltypes.String):
+                or_payload.append(
+                    sa.func.lower(sf).like("%"+sa.func.lower(h)+"%"))
+            else:
+                or_payload.append(
+                    sf.like("%"+h+"%"))
+    return sa.or_(*or_payload) if or_payload else None
+
+
+def rank_order(terms, fields, pk):
+    """ ORDER BY clauses for search results: rows where a field starts
+    with a term first, then by best trigram similarity, then pk """
+    lowered = [sa.func.lower(f) for f in fields]
+    prefix = sa.or_(*[f.like(sa.func.lower(t) + "%")
+                      for t in terms for f in lowered])
+    similarity = sa.func.greatest(*[sa.func.similarity(f, sa.func.lower(t))
+                                    for t in terms for f in lowered])
+    return [sa.case([(prefix, 0)], else_=1), similarity.desc(), pk]
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NgramIndex(object):
+    """ Trigram index over the name and id of the objects in cache (a
+    dict of containers), kept up to date lazily: searches re-read
+    the cache at most every refresh_interval seconds, and only reindex
+    the entries whose name or id changed.
+
+    Terms of three or more characters only check the objects holding
+    all of their trigrams; shorter ones scan every entry.
+    """
+    def __init__(self, cache, refresh_interval=SEARCH_REFRESH_INTERVAL):
+        self.cache = cache
+        self.refresh_interval = refresh_interval
+        self._fields = {}
+        self._grams = defaultdict(set)
+        self._refreshed = None
+
+    @staticmethod
+    def _index_fields(obj):
+        name = obj['name'] if 'name' in obj else None
+        return ((name or u'').lower(), obj['id'].lower())
+
+    def _add(self, key, fields):
+        self._fields[key] = fields
+        for field in fields:
+            for gram in trigrams(field):
+                self._grams[gram].add(key)
+
+    def _remove(self, key):
+        for field in self._fields.pop(key):
+            for gram in trigrams(field):
+                keys = self._grams[gram]
+                keys.discard(key)
+                if not keys:
+                    del self._grams[gram]
+
+    def refresh(self):
+        for key, obj in list(self.cache.items()):
+            fields = self._index_fields(obj)
+            indexed = self._fields.get(key)
+            if indexed != fields:
+                if indexed is not None:
+                    self._remove(key)
+                self._add(key, fields)
+        for key in set(self._fields).difference(self.cache):
+            self._remove(key)
+        self._refreshed = time.time()
+
+    def _candidates(self, term):
+        grams = trigrams(term)
+        if not grams:
+            return self._fields
+        postings = sorted((self._grams.get(g, ()) for g in grams), key=len)
+        return set(postings[0]).intersection(*postings[1:])
+
+    def rank(self, terms):
+        """ {key: rank} of the cached objects whose name or id contains
+        any of terms; lower ranks first: prefix matches, then by match
+        position, then by id """
+        if (self._refreshed is None or
+                time.time() - self._refreshed >= self.refresh_interval):
+            self.refresh()
+        ranks = {}
+        fields = self._fields
+        for term in terms:
+            term = term.lower()
+            if not term:
+                continue
+            for key in self._candidates(term):
+                name, obj_id = fields[key]
+                position = name.find(term)
+                id_position = obj_id.find(term)
+                if position < 0 or 0 <= id_position < position:
+                    position = id_position
+                if position < 0:
+                    continue
+                rank = (position, obj_id)
+                if key not in ranks or rank < ranks[key]:
+                    ranks[key] = rank
+        return ranks
+
+    def search(self, terms, offset=0, limit=None):
+        """ The number of cached objects matching terms, and the slice
+        from offset (up to limit of them) in rank order """
+        ranks = self.rank(terms)
+        if limit is None:
+            keys = sorted(ranks, key=ranks.get)[offset:]
+        else:
+            keys = heapq.nsmallest(offset + limit, ranks,
+                                   key=ranks.get)[offset:]
+        return len(ranks), [self.cache[key] for key in keys
+                            if key in self.cache]
+
+
+BEACON_INDEX = NgramIndex(STATE.beacons)
+LISTENER_INDEX = NgramIndex(STATE.listeners)
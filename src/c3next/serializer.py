@@ -0,0 +1,146 @@
+""" JSON encoding for the web and event responses.
+
+Encodes with orjson, or else ujson, when installed and with the json
+module otherwise. Every backend gives the same values: datetimes become
+whole epoch seconds, bytes become hex and containers their json_dict().
+Large lists can be streamed to a request a chunk at a time rather than
+encoded whole.
+"""
+from __future__ import absolute_import
+
+from binascii import hexlify
+from datetime import datetime
+import json
+
+from pytz import UTC
+
+from twisted.internet import task
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import failure
+from zope.interface import implementer
+
+from c3next.config import JSON_CHUNK_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+
+def epoch(dt):
+    """ timegm(dt.utctimetuple()) without building the time tuple;
+    naive datetimes are taken as UTC """
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=UTC)
+    # Python 2 can't divide timedeltas
+    delta = dt - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def hex_bytes(value):
+    return hexlify(value).decode('ascii')
+
+
+def to_json_type(obj):
+    """ The default hook of every backend """
+    if isinstance(obj, datetime):
+        return epoch(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return hex_bytes(obj)
+    if hasattr(obj, 'json_dict'):
+        return obj.json_dict()
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(obj):
+        """ obj as UTF-8 encoded JSON """
+        # Row keys are SQLAlchemy's str subclass, which needs NON_STR_KEYS
+        return orjson.dumps(obj, default=to_json_type,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME |
+                            orjson.OPT_NON_STR_KEYS)
+elif ujson is not None:
+    BACKEND = 'ujson'
+
+    def dumps(obj):
+        """ obj as UTF-8 encoded JSON """
+        return ujson.dumps(obj, default=to_json_type, ensure_ascii=False,
+                           escape_forward_slashes=False).encode('utf-8')
+else:
+    BACKEND = 'json'
+
+    def dumps(obj):
+        """ obj as UTF-8 encoded JSON """
+        return json.dumps(obj, default=to_json_type, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+
+@implementer(IPushProducer)
+class ListProducer(object):
+    """ Writes items to request as a JSON list, chunk_size of them per
+    reactor turn, pausing while the transport is full; prefix and
+    suffix wrap the list. Only one chunk is encoded at a time. """
+    def __init__(self, request, items, chunk_size=JSON_CHUNK_SIZE,
+                 prefix=b'', suffix=b''):
+        self.request = request
+        self.items = items
+        self.chunk_size = chunk_size
+        self.prefix = prefix
+        self.suffix = suffix
+        self._task = None
+        self._paused = False
+
+    def start(self):
+        """ Returns a Deferred fired once everything is written """
+        self._task = task.cooperate(self._chunks())
+        self.request.registerProducer(self, True)
+        d = self._task.whenDone()
+        d.addBoth(self._done)
+        return d
+
+    def _chunks(self):
+        opening = self.prefix + b'['
+        for i in range(0, len(self.items), self.chunk_size):
+            chunk = dumps(self.items[i:i + self.chunk_size])
+            # Each chunk is itself a list; splice them into one
+            self.request.write(opening + chunk[1:-1])
+            opening = b','
+            yield
+        closing = b']' + self.suffix
+        self.request.write(closing if opening == b',' else opening + closing)
+
+    def _done(self, result):
+        self.request.unregisterProducer()
+        if isinstance(result, failure.Failure):
+            return result
+
+    def pauseProducing(self):
+        if not self._paused:
+            self._paused = True
+            self._task.pause()
+
+    def resumeProducing(self):
+        if self._paused:
+            self._paused = False
+            self._task.resume()
+
+    def stopProducing(self):
+        self._task.stop()
+
+
+def write_list(request, items, prefix=b'', suffix=b''):
+    """ items as a JSON list wrapped in prefix and suffix: returned
+    whole when small, streamed to request by a ListProducer (returning
+    a Deferred) when longer than JSON_CHUNK_SIZE """
+    if len(items) <= JSON_CHUNK_SIZE:
+        return prefix + dumps(items) + suffix
+    return ListProducer(request, items, prefix=prefix,
+                        suffix=suffix).start()
@@ -0,0 +1,200 @@
+""" Buffered writer for the sightings time series """
+from datetime import datetime, timedelta
+
+from pytz import UTC
+from twisted.application import service
+from twisted.internet import defer, task
+from twisted.python import failure, log
+
+from c3next import db
+from c3next.clock import to_datetime
+from c3next.config import SIGHTING_PARTITION_DAYS, SIGHTING_PARTITION_INTERVAL
+
+COLUMNS = ['beacon_id', 'listener_id', 'distance', 'variance', 'timestamp']
+
+# Serializes partition changes between the listener processes
+PARTITION_LOCK = "SELECT pg_advisory_xact_lock(hashtext('sightings'))"
+
+
+def partition_name(day):
+    return 'sightings_{:%Y%m%d}'.format(day)
+
+
+def day_range(day):
+    """ SQL bounds of the UTC day (a date) """
+    return ("'{:%Y-%m-%d} 00:00+00'".format(day),
+            "'{:%Y-%m-%d} 00:00+00'".format(day + timedelta(days=1)))
+
+
+def partition_ddl(day):
+    """ DDL for the daily sightings partition holding day (a date) """
+    return ("CREATE TABLE IF NOT EXISTS {} PARTITION OF sightings "
+            "FOR VALUES FROM ({}) TO ({})").format(
+                partition_name(day), *day_range(day))
+
+
+def move_default_ddl(day):
+    """ Statements creating day's partition once rows for it are in the
+    default partition, which rejects the new partition until they are
+    moved out. Run in one transaction """
+    where = "timestamp >= {} AND timestamp < {}".format(*day_range(day))
+    return ["ALTER TABLE sightings DETACH PARTITION sightings_default",
+            partition_ddl(day),
+            "INSERT INTO {} SELECT * FROM sightings_default WHERE {}".format(
+                partition_name(day), where),
+            "DELETE FROM sightings_default WHERE {}".format(where),
+            "ALTER TABLE sightings ATTACH PARTITION sightings_default "
+            "DEFAULT"]
+
+
+class SightingWriter(service.Service):
+    """ Buffers sightings in memory and COPYs them to the DB when
+    batch_size have queued or every interval seconds.
+
+    Only one flush is in flight at a time. While the DB is slow or down
+    the buffer grows up to max_buffer sightings; past that new ones are
+    shed and counted. Rows from a failed flush are queued again.
+    Flushes share one connection, replaced after a failed one.
+
+    Daily partitions are created days_ahead days ahead, on start and
+    then every partition_interval seconds, not on the write path. Rows
+    of a day without one land in the default partition and are moved
+    to the day's partition when it is created. """
+    def __init__(self, batch_size, interval, max_buffer,
+                 days_ahead=SIGHTING_PARTITION_DAYS,
+                 partition_interval=SIGHTING_PARTITION_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.days_ahead = days_ahead
+        self.written = 0
+        self.shed = 0
+        self.failed_flushes = 0
+        self._buf = []
+        self._flushing = None
+        self._partitions = set()
+        self._scope = db.ConnectionScope()
+        self._loop = task.LoopingCall(self.flush)
+        self._partition_loop = task.LoopingCall(self.maintain_partitions)
+        self._partition_interval = partition_interval
+
+    def startService(self):
+        service.Service.startService(self)
+        self._partition_loop.start(self._partition_interval)
+        self._loop.start(self.interval, now=False)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        service.Service.stopService(self)
+        for loop in (self._loop, self._partition_loop):
+            if loop.running:
+                loop.stop()
+        # A flush may already be in flight, the second writes the rest
+        yield self.flush()
+        yield self.flush()
+        yield self._scope.close()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def add(self, beacon_id, listener_id, distance, variance, timestamp):
+        if len(self._buf) >= self.max_buffer:
+            self.shed += 1
+            return
+        self._buf.append(
+            (beacon_id, listener_id, distance, variance, timestamp))
+        if len(self._buf) >= self.batch_size and self._flushing is None:
+            self.flush()
+
+    def stats(self):
+        return {'queued': len(self._buf), 'written': self.written,
+                'shed': self.shed, 'failed_flushes': self.failed_flushes}
+
+    def flush(self):
+        """ Start writing the buffer unless a flush is in flight.
+        Returns a Deferred firing when the flush in flight is done """
+        flushing = self._flushing
+        if flushing is None and self._buf:
+            rows, self._buf = self._buf, []
+            # A write that finishes at once has _flushed reset _flushing
+            flushing = self._flushing = self._write(rows)
+            flushing.addBoth(self._flushed)
+        if flushing is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        flushing.addBoth(lambda r: d.callback(None) or r)
+        return d
+
+    def _flushed(self, _):
+        self._flushing = None
+
+    @defer.inlineCallbacks
+    def _write(self, rows):
+        try:
+            conn = yield self._scope.connection()
+            # Queued with epoch second timestamps
+            db_rows = [r[:4] + (to_datetime(r[4]),) for r in rows]
+            yield db.copy_rows(conn, db.sightings, COLUMNS, db_rows)
+        except Exception:
+            log.err(None, "Sighting flush of {} rows failed".format(
+                len(rows)))
+            self.failed_flushes += 1
+            # Oldest rows are shed first if the buffer is full
+            room = self.max_buffer - len(self._buf)
+            self.shed += max(0, len(rows) - room)
+            self._buf[:0] = rows[-room:] if room > 0 else []
+            # The connection may be broken, the next flush takes another
+            yield self._scope.close().addErrback(log.err)
+        else:
+            self.written += len(rows)
+
+    @defer.inlineCallbacks
+    def maintain_partitions(self, today=None):
+        """ Create the partitions of today and the next days_ahead days,
+        and of any day with rows in the default partition. A day whose
+        partition could not be created is tried again next time """
+        if today is None:
+            today = datetime.now(tz=UTC).date()
+        days = set(today + timedelta(days=i)
+                   for i in range(self.days_ahead + 1))
+        try:
+            rp = yield db.execute(
+                "SELECT DISTINCT (timestamp AT TIME ZONE 'UTC')::date "
+                "FROM sightings_default")
+            rows = yield rp.fetchall()
+            days.update(r[0] for r in rows)
+        except Exception:
+            log.err(None, "Could not read the default sightings partition")
+        for day in sorted(days - self._partitions):
+            try:
+                yield self._create_partition(day)
+            except Exception:
+                log.err(None, "Could not create sightings partition for "
+                        "{}".format(day))
+            else:
+                self._partitions.add(day)
+
+    @defer.inlineCallbacks
+    def _create_partition(self, day):
+        scope = db.ConnectionScope(transaction=True)
+        try:
+            yield scope.execute(PARTITION_LOCK)
+            rp = yield scope.execute(
+                "SELECT to_regclass('{}')".format(partition_name(day)))
+            exists = yield rp.scalar()
+            if exists is None:
+                rp = yield scope.execute(
+                    "SELECT EXISTS (SELECT 1 FROM sightings_default "
+                    "WHERE timestamp >= {} AND timestamp < {})".format(
+                        *day_range(day)))
+                if (yield rp.scalar()):
+                    ddl = move_default_ddl(day)
+                else:
+                    ddl = [partition_ddl(day)]
+                for statement in ddl:
+                    yield scope.execute(statement)
+        except Exception:
+            f = failure.Failure()
+            yield scope.close(commit=False).addErrback(log.err)
+            f.raiseException()
+        yield scope.close()
@@ -0,0 +1,209 @@
+""" Stores holding the LISTENERS/BEACONS caches.
+
+Every process keeps its own model instances. Edits made outside the
+listener, e.g. a rename or delete in the web UI, go through the store
+as invalidation messages: update() and delete() publish them and every
+process applies them to its own caches. LocalStore delivers them in
+process; MmapStore passes them between processes through a ring buffer
+in a shared file, read by poll().
+"""
+from __future__ import absolute_import
+
+import fcntl
+import json
+import mmap
+import errno
+import os
+import stat
+import struct
+from binascii import unhexlify
+
+from twisted.python import log
+
+from c3next.config import STATE_PATH, STATE_RING_SIZE
+
+
+class StateStore(object):
+    """ Base store: the caches, keyed like the listener expects (raw
+    bytes for beacons, the id for listeners), and message handling.
+    Messages address objects by kind ('beacon' or 'listener') and
+    their DB id. """
+    shared = False
+
+    def __init__(self):
+        self.listeners = {}
+        self.beacons = {}
+        self._caches = {'listener': (self.listeners, lambda pk: pk),
+                        'beacon': (self.beacons, unhexlify)}
+        self._handlers = []
+
+    def cache_key(self, kind, obj_id):
+        return self._caches[kind][1](obj_id)
+
+    def subscribe(self, handler):
+        """ handler(kind, obj_id, key, fields) is called after each
+        message is applied, fields is None for deletes """
+        self._handlers.append(handler)
+
+    def update(self, kind, obj_id, fields):
+        """ Publish fields already saved to the DB for obj_id """
+        self.publish(kind, obj_id, fields)
+
+    def delete(self, kind, obj_id):
+        """ Publish the deletion of obj_id """
+        self.publish(kind, obj_id, None)
+
+    def publish(self, kind, obj_id, fields):
+        raise NotImplementedError
+
+    def poll(self):
+        """ Apply messages published by other processes """
+        pass
+
+    def apply(self, kind, obj_id, fields):
+        cache, cache_key = self._caches[kind]
+        key = cache_key(obj_id)
+        if fields is None:
+            obj = cache.pop(key, None)
+            if obj is not None:
+                # Or the next persist would write it back
+                obj._dirty_set.discard(obj)
+        elif key in cache:
+            # The values are in the DB already, don't mark them dirty
+            cache[key].refresh(fields)
+        for handler in self._handlers:
+            try:
+                handler(kind, obj_id, key, fields)
+            except Exception:
+                log.err()
+
+
+class LocalStore(StateStore):
+    """ Store for a single process, messages apply immediately """
+    def publish(self, kind, obj_id, fields):
+        self.apply(kind, obj_id, fields)
+
+
+HEADER = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+
+
+def open_private(path):
+    """ Open (creating) path for reading and writing, refusing a file
+    other users could have planted or can write to. A missing parent
+    directory is created 0700; an existing one must be ours and not
+    writable by others, the file ours, regular and private """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(directory)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o022):
+        raise OSError(errno.EPERM, "State directory not private to this "
+                      "user", directory)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    st = os.fstat(fd)
+    if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        os.close(fd)
+        raise OSError(errno.EPERM, "State file not private to this user",
+                      path)
+    return fd
+
+
+class MmapStore(StateStore):
+    """ Store whose messages go through a file shared by every process.
+
+    The file holds the total number of bytes ever written followed by
+    a ring of ring_size bytes of length prefixed JSON messages. Writers
+    append under an exclusive flock, readers copy out what was written
+    since their last poll under a shared one. A reader lapped by the
+    writers has lost messages; it logs that and skips ahead.
+    """
+    shared = True
+
+    def __init__(self, path, ring_size=STATE_RING_SIZE):
+        StateStore.__init__(self)
+        self.ring_size = ring_size
+        self.lost = 0
+        self._pid = os.getpid()
+        self._fd = open_private(path)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != HEADER.size + ring_size:
+                os.ftruncate(self._fd, HEADER.size + ring_size)
+            self._map = mmap.mmap(self._fd, HEADER.size + ring_size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        # Messages from before this process started are already in the
+        # DB it loads from
+        self._read = self._written()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _written(self):
+        return HEADER.unpack_from(self._map, 0)[0]
+
+    def _copy_in(self, pos, data):
+        start = HEADER.size + pos % self.ring_size
+        first = min(len(data), HEADER.size + self.ring_size - start)
+        self._map[start:start + first] = data[:first]
+        self._map[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        start = HEADER.size + pos % self.ring_size
+        first = min(length, HEADER.size + self.ring_size - start)
+        return (self._map[start:start + first] +
+                self._map[HEADER.size:HEADER.size + length - first])
+
+    def publish(self, kind, obj_id, fields):
+        message = json.dumps([self._pid, kind, obj_id, fields]).encode()
+        data = LENGTH.pack(len(message)) + message
+        if len(data) > self.ring_size:
+            raise ValueError("Message larger than the state ring")
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            written = self._written()
+            self._copy_in(written, data)
+            HEADER.pack_into(self._map, 0, written + len(data))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        # Our own message is skipped by poll, apply it now
+        self.apply(kind, obj_id, fields)
+
+    def poll(self):
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+        try:
+            written = self._written()
+            if written - self._read > self.ring_size:
+                self.lost += 1
+                log.msg("State ring overrun, {} bytes of messages "
+                        "lost".format(written - self._read))
+                self._read = written
+            data = self._copy_out(self._read, written - self._read)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._read = written
+        pos = 0
+        while pos < len(data):
+            (length,) = LENGTH.unpack_from(data, pos)
+            pos += LENGTH.size
+            pid, kind, obj_id, fields = json.loads(
+                data[pos:pos + length].decode())
+            pos += length
+            if pid != self._pid:
+                self.apply(kind, obj_id, fields)
+
+
+def make_store(path=STATE_PATH):
+    if path:
+        return MmapStore(path)
+    return LocalStore()
+
+
+STATE = make_store()
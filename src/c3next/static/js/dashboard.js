@@ -1,45 +1,85 @@
 define(['ajax','util'], function(ajax, util) {
     'use strict';
-    function update_beacon_table (beacons) {
+    var beacons = {};
+    var render_pending = false;
+    // Only the newest beacons are shown, the rest are dropped
+    var MAX_BEACONS = 1000;
+
+    function add_cell (row, text) {
+	var cell = document.createElement('td');
+	cell.textContent = text;
+	row.appendChild(cell);
+    }
+
+    function render_beacon_table () {
+	render_pending = false;
 	var table = document.getElementById('beacons_table');
 	var old_tbody = table.getElementsByTagName('tbody')[0];
 	var new_tbody = document.createElement('tbody');
-	for (var i = 0, l = beacons.length; i < l; i++) {
-	    var beacon = beacons[i];
+	var ids = Object.keys(beacons).sort(function (a, b) {
+	    return (beacons[b].last_seen || 0) - (beacons[a].last_seen || 0);
+	});
+	for (var j = MAX_BEACONS, n = ids.length; j < n; j++) {
+	    delete beacons[ids[j]];
+	}
+	ids.length = Math.min(ids.length, MAX_BEACONS);
+	for (var i = 0, l = ids.length; i < l; i++) {
+	    var beacon = beacons[ids[i]];
 	    var row = document.createElement('tr');
-	    if (beacon.hasOwnProperty("mac")) {
-		row.innerHTML += "<td>"+beacon.mac+" (secure)</td>";
-	    } else {
-		row.innerHTML += "<td>Maj:"+beacon.major+" / Min:"+beacon.minor+"</td>";
+	    if (beacon.missing) {
+		row.className = 'danger';
 	    }
-            row.innerHTML += "<td>"+Math.round(beacon.distance*100)/100+"m</td>";
-	    row.innerHTML += "<td>"+Math.round(beacon.error*100)/100+"m</td>";
+	    add_cell(row, beacon.name || beacon.id);
+	    add_cell(row, beacon.listener_id || "");
+	    add_cell(row, new Date(beacon.last_seen*1000).toLocaleTimeString());
 	    new_tbody.appendChild(row);
 	}
 	table.replaceChild(new_tbody, old_tbody);
-	window.setTimeout(fetch_beacons, 2500);
-    }
-    function fetch_beacons() {
-	ajax.get_json('beacons.json').then(update_beacon_table, function (resp) {
-	    console.log("Failed to get recent beacons:", resp);
-	    window.setTimeout(fetch_beacons, 5000);
-	});
     }
 
-    function fetch_last_ack() {
-	ajax.get_json('server.json').then(
-	    function (svr) {
-		document.getElementById(
-		    "last_ack").innerHTML = svr['last_ack'];
-		window.setTimeout(fetch_last_ack, 1500);
-	    },
-	    function (resp) {
-		console.log("Failed to get server.json:", resp);
-		window.setTimeout(fetch_last_ack, 5000);
-	    });
+    function schedule_render () {
+	if (!render_pending) {
+	    render_pending = true;
+	    window.requestAnimationFrame(render_beacon_table);
+	}
     }
 
+    function load_beacons () {
+	ajax.get_json('beacons.json?limit='+MAX_BEACONS).then(function (page) {
+	    beacons = {};
+	    for (var i = 0, l = page.objects.length; i < l; i++) {
+		beacons[page.objects[i].id] = page.objects[i];
+	    }
+	    schedule_render();
+	}, function (resp) {
+	    console.log("Failed to get beacons:", resp);
+	});
+    }
 
+    // Changes are pushed by the server as they happen, the full list
+    // is only fetched on (re)connect and when the server asks for it
+    function stream_beacons () {
+	var events = new EventSource('events');
+	events.addEventListener('open', load_beacons);
+	events.addEventListener('resync', load_beacons);
+	events.addEventListener('beacon', function (evt) {
+	    var beacon = JSON.parse(evt.data);
+	    beacons[beacon.id] = beacon;
+	    var last_ack = document.getElementById("last_ack");
+	    if (last_ack) {
+		last_ack.textContent =
+		    new Date(beacon.last_seen*1000).toLocaleTimeString();
+	    }
+	    schedule_render();
+	});
+	events.addEventListener('delete', function (evt) {
+	    var obj = JSON.parse(evt.data);
+	    if (obj.kind === 'beacon') {
+		delete beacons[obj.id];
+		schedule_render();
+	    }
+	});
+    }
 
     function pretty_print_uci_key (key) {
 	var map = {
@@ -94,6 +134,15 @@ define(['ajax','util'], function(ajax, util) {
     // util.populate_header();
     // populate_netstatus();
     // populate_svrstatus();
-    // fetch_beacons();
-    // fetch_last_ack();
+    // Every page loads this module, only the dashboard has the table
+    function start () {
+	if (document.getElementById('beacons_table')) {
+	    stream_beacons();
+	}
+    }
+    if (document.readyState === 'loading') {
+	document.addEventListener('DOMContentLoaded', start);
+    } else {
+	start();
+    }
 });
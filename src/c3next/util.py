@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from Crypto.Hash import CMAC
 from Crypto.Cipher import AES
 
@@ -20,11 +22,68 @@ def evolve_dk(dk, mask, num):
     return (dk, mask)
 
 
+def evolve_dk_many(dk, mask, num, count):
+    # Same result as calling evolve_dk count times, without the loop.
+    # Shifting a 16 bit half more than 16 times leaves only zeros
+    shift = min(count, 16)
+    h, lo = dk >> 16, dk & 0x0000ffff
+    m_h, m_l = mask >> 16, mask & 0x0000ffff
+    # Like evolve_dk, only num 0 moves any bits; num 1 leaves the
+    # high half as it is
+    if num == 0 and shift > 0:
+        lo = (lo << shift) & 0xffff
+        m_l = (m_l << shift) & 0xffff
+    dk = (h << 16) | lo & 0xffff
+    mask = (m_h << 16) | m_l
+    return (dk, mask)
+
+
 def derive_key(b_id):
     cmac = CMAC.new(MASTER_KEY, ciphermod=AES)
     cmac.update(b_id)
     return cmac.digest()
 
 
+class KeyCache(object):
+    """ LRU-bounded cache of derived beacon keys, keyed by raw b_id. A
+    size of 0 (or less) derives every key and caches none """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+
+    def get(self, b_id):
+        try:
+            key = self._keys.pop(b_id)
+        except KeyError:
+            self.misses += 1
+            key = derive_key(b_id)
+            if self.size < 1:
+                return key
+            if len(self._keys) >= self.size:
+                self._keys.popitem(last=False)
+        else:
+            self.hits += 1
+        self._keys[b_id] = key
+        return key
+
+    def invalidate(self, b_id):
+        self._keys.pop(b_id, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def stats(self):
+        return {'size': len(self._keys), 'hits': self.hits,
+                'misses': self.misses}
+
+
+def rssi_distance(rssi, txpower):
+    """ Free space distance estimate in metres; txpower is the RSSI
+    expected at 1m """
+    return 10 ** ((txpower - rssi) / 20.0)
+
+
 def ceildiv(a, b):
     return -(-a // b)
@@ -1,12 +1,16 @@
 from pkg_resources import resource_filename
-from binascii import unhexlify
-from datetime import datetime
+import base64
+from datetime import timedelta
+import functools
+import hashlib
+import heapq
 import json
-from pytz import UTC
+import time
 
 from twisted.application import service
 from twisted.internet import reactor, endpoints, defer
 from twisted.python import log
+from twisted.web import http
 from twisted.web.server import Site
 from twisted.web.static import File
 
@@ -15,23 +19,37 @@ import sqlalchemy as sa
 from klein import Klein
 
 import jinja2
+import six
+from six.moves.urllib.parse import urlencode
 
 import c3next.db as db
-from c3next.config import DEFAULT_PER_PAGE
-from c3next.models import Beacon, Listener, BytesEncoder
+from c3next.config import (BEACON_LISTENER_TIMEOUT, COUNT_CAP, COUNT_TTL,
+                           DEFAULT_PER_PAGE, EVENT_CLIENT_BUFFER)
+from c3next.clock import to_datetime, to_timestamp
+from c3next.events import EVENTS, EventClient
+from c3next.models import Beacon, Listener
+from c3next.search import (BEACON_INDEX, LISTENER_INDEX, rank_order,
+                           search_clause)
+from c3next.serializer import dumps, write_list
+from c3next.state import STATE
 from c3next.util import ceildiv
 
 
-@defer.inlineCallbacks
-def del_obj(table, o_id, cache=None):
-    if cache and o_id in cache:
-        del cache[o_id]
-    cur = yield db.execute(table.delete().where(table.c.id == o_id))
-    yield cur.close()
+def scoped(handler):
+    """ Pass handler a ConnectionScope after the request, shared by its
+    DB work and closed once it is done. POST and DELETE requests run in
+    one transaction, rolled back if the handler fails """
+    @functools.wraps(handler)
+    def wrapper(request, *args, **kwargs):
+        scope = db.ConnectionScope(
+            transaction=request_method(request) in ('POST', 'DELETE'))
+        d = defer.maybeDeferred(handler, request, scope, *args, **kwargs)
+        return d.addBoth(scope.finish)
+    return wrapper
 
 
 def ago(last_seen):
-    td = datetime.now(tz=UTC) - last_seen
+    td = timedelta(seconds=time.time() - to_timestamp(last_seen))
     if td.seconds < 2:
         return "Now"
     elif td.seconds < 60:
@@ -44,10 +62,22 @@ def ago(last_seen):
         return "{} days ago".format(td.days)
 
 
+def missing(row):
+    """ missing_p() of the cached beacon of a beacon list row, or from
+    its last_seen when the beacon is not cached here """
+    obj = STATE.beacons.get(STATE.cache_key('beacon', row['id']))
+    if obj is not None:
+        return obj.missing_p()
+    last_seen = to_timestamp(row['last_seen'])
+    return last_seen is None or \
+        last_seen < time.time() - BEACON_LISTENER_TIMEOUT.total_seconds()
+
+
 app = Klein()
 env = jinja2.Environment(
     loader=jinja2.PackageLoader(__name__, 'templates'))
 env.filters['ago'] = ago
+env.filters['missing'] = missing
 
 
 @app.route('/static/', branch=True)
@@ -61,20 +91,122 @@ def index(request):
     return page.render()
 
 
-def query_filter(request, query, search_fields=[]):
-    """ Uses requestHeaders to add filtering methods to query"""
+def request_method(request):
+    """ The request method as text """
+    method = request.method
+    return method.decode() if isinstance(method, bytes) else method
+
+
+def request_args(request, name, cls=None):
+    """ Values of query argument name as text (or cls), whether the
+    request args are keyed by bytes or str """
+    values = request.args.get(name.encode(), request.args.get(name, []))
+    values = [v.decode() if isinstance(v, bytes) else v for v in values]
+    if cls is not None:
+        return [cls(v) for v in values]
+    return values
+
+
+class Keyset(object):
+    """ Keyset (cursor) pagination of table, ordered by id or by
+    last_seen, newest first. A page continues from the row named by a
+    cursor instead of skipping OFFSET rows, so deep pages cost the same
+    as the first. Cursors carry the sort they were made for. """
+    SORTS = {'id': False, 'last_seen': True}
+
+    def __init__(self, table, sort='id'):
+        if sort not in self.SORTS:
+            raise ValueError("Unknown sort: {}".format(sort))
+        self.table = table
+        self.sort = sort
+        self.descending = self.SORTS[sort]
+        if sort == 'last_seen':
+            self.columns = [db.seen_order(table), table.c.id]
+        else:
+            self.columns = [table.c.id]
+        self.backwards = False
+
+    def order(self, query, backwards=False):
+        descending = self.descending != backwards
+        return query.order_by(*[c.desc() if descending else c
+                                for c in self.columns])
+
+    def cursor(self, row):
+        if self.sort == 'last_seen':
+            values = [to_timestamp(row['last_seen']) or 0, row['id']]
+        else:
+            values = [row['id']]
+        return base64.urlsafe_b64encode(
+            json.dumps([self.sort] + values).encode()).decode()
+
+    @classmethod
+    def from_cursor(cls, table, cursor):
+        """ The Keyset a cursor was made for and its row values. Raises
+        ValueError if cursor is not one of ours """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(
+                cursor.encode()).decode())
+            keyset = cls(table, values.pop(0))
+            if (len(values) != len(keyset.columns) or
+                    not isinstance(values[-1], six.text_type)):
+                raise ValueError(values)
+            if keyset.sort == 'last_seen':
+                values[0] = to_datetime(values[0])
+        except (AttributeError, IndexError, TypeError, ValueError):
+            raise ValueError("Bad cursor: {!r}".format(cursor))
+        return keyset, values
+
+    def seek(self, query, values, backwards=False):
+        """ Order query and keep the rows after (or before) values """
+        self.backwards = backwards
+        key, bound = sa.tuple_(*self.columns), sa.tuple_(*values)
+        if self.descending != backwards:
+            query = query.where(key < bound)
+        else:
+            query = query.where(key > bound)
+        return self.order(query, backwards)
+
+    def page(self, rows, pagination):
+        """ rows fetched with a limit of per_page + 1, in display order,
+        setting the next/prev cursors of pagination """
+        per_page = pagination['per_page']
+        more = len(rows) > per_page
+        rows = list(rows[:per_page])
+        if self.backwards:
+            rows.reverse()
+        pagination['next'] = pagination['prev'] = None
+        if rows:
+            if more or self.backwards:
+                pagination['next'] = self.cursor(rows[-1])
+            if (more and self.backwards) or (
+                    not self.backwards and pagination['cur_page'] > 1):
+                pagination['prev'] = self.cursor(rows[0])
+        return rows
+
+
+class Ranked(object):
+    """ Pages of search results, in rank order by OFFSET; ranks are not
+    unique so there are no cursors """
+    def page(self, rows, pagination):
+        pagination['next'] = pagination['prev'] = None
+        return list(rows[:pagination['per_page']])
+
+
+def query_filter(request, query, search_fields=[], table=None):
+    """ Uses the request arguments to add filtering methods to query.
+
+    With table, pages are ordered by a Keyset (sort=id or last_seen)
+    and the after/before cursors of the pagination dict continue from
+    the current page without an OFFSET; p (or offset) still jumps to a
+    page directly. Searches are ordered by rank instead, see
+    search.rank_order. The query is then limited to per_page + 1 rows,
+    pass them through pagination['keyset'].page(). Returns the query, the
+    pagination dict, the search string and the search clause (None
+    without a search), for counting.
+    """
     def _last(header, cls=None):
-        if header not in request.args:
-            return None
-        header = request.args[header][-1]
-        return cls(header)
-
-    def _all(header, cls=None):
-        if header not in request.args:
-            return []
-        if cls is not None:
-            return [cls(h) for h in request.args[header]]
-        return request.args[header]
+        values = request_args(request, header, cls=cls)
+        return values[-1] if values else None
 
     pagination = {}
     limit = _last('limit', cls=int)
@@ -82,45 +214,83 @@ def query_filter(request, query, search_fields=[]):
         pagination['per_page'] = limit
     else:
         pagination['per_page'] = DEFAULT_PER_PAGE
-    query = query.limit(pagination['per_page'])
 
     page = _last('p', cls=int)
+    offset = None
     if page:
         pagination['cur_page'] = page
         offset = (page - 1) * pagination['per_page']
     else:
         offset = _last('offset', cls=int)
         if offset:
-            pagination['cur_page'] = ceildiv(offset, pagination['per_page'])
-    if offset:
-        query = query.offset(offset)
+            pagination['cur_page'] = offset // pagination['per_page'] + 1
     if 'cur_page' not in pagination:
         pagination['cur_page'] = 1
 
-    search = _all('search')
-    or_payload = []
-    for h in search:
-        for sf in search_fields:
-            if isinstance(sf.type, sa.sql.sqltypes.String):
-                or_payload.append(
-                    sa.func.lower(sf).like("%"+sa.func.lower(h)+"%"))
-            else:
-                or_payload.append(
-                    sf.like("%"+h+"%"))
-    query = query.where(sa.or_(*or_payload))
-    print(or_payload)
+    # Carried by the page links, so jumping to a page keeps them
+    kept = [(name, v.encode('utf-8')) for name in ('search', 'sort', 'limit')
+            for v in request_args(request, name)[-1:]]
+    pagination['args'] = '&' + urlencode(kept) if kept else ''
+
+    search = request_args(request, 'search')
+    where = search_clause(search, search_fields)
+    if where is not None:
+        query = query.where(where)
+
+    if table is None:
+        query = query.limit(pagination['per_page'])
+        if offset:
+            query = query.offset(offset)
+    elif where is not None:
+        query = query.order_by(*rank_order(search, search_fields,
+                                           table.c.id))
+        if offset:
+            query = query.offset(offset)
+        query = query.limit(pagination['per_page'] + 1)
+        pagination['keyset'] = Ranked()
+    else:
+        after, before = _last('after'), _last('before')
+        keyset = None
+        if after or before:
+            try:
+                keyset, values = Keyset.from_cursor(table, after or before)
+            except ValueError:
+                # A mangled cursor gets page p of the sort instead
+                log.msg("Ignoring cursor {!r}".format(after or before))
+        if keyset is not None:
+            query = keyset.seek(query, values, backwards=not after)
+        else:
+            sort = _last('sort')
+            keyset = Keyset(table, sort if sort in Keyset.SORTS else 'id')
+            query = keyset.order(query)
+            if offset:
+                query = query.offset(offset)
+        query = query.limit(pagination['per_page'] + 1)
+        pagination['keyset'] = keyset
+
     log.msg("Filter Query: {}".format(query))
     search = ' '.join([s for s in search])
-    return query, pagination, search
+    return query, pagination, search, where
 
 
 def model_rp(rp, cls):
     return [cls(row=r) for r in rp]
 
 
+# (table name, column name) -> (time fetched, count)
+_COUNTS = {}
+
+
 @defer.inlineCallbacks
 def get_count(table, column=None, conn=None):
+    """ count(column) over table, refreshed at most every COUNT_TTL
+    seconds """
     column = table.c.id if column is None else column
+    cache_key = (table.name, column.name)
+    if cache_key in _COUNTS:
+        fetched, count = _COUNTS[cache_key]
+        if time.time() - fetched < COUNT_TTL:
+            defer.returnValue(count)
     query = sa.func.count(column)
     if conn is None:
         rp = yield db.execute(query)
@@ -129,42 +299,111 @@ def get_count(table, column=None, conn=None):
     else:
         rp = yield conn.execute(query)
         count = yield rp.scalar()
+    _COUNTS[cache_key] = (time.time(), count)
     defer.returnValue(count)
 
 
+@defer.inlineCallbacks
+def get_filtered_count(table, where, conn, cap=COUNT_CAP):
+    """ Number of rows of table matching where, counting no further
+    than cap. Returns (count, capped) """
+    matching = sa.select([sa.literal_column('1')]).select_from(
+        table).where(where).limit(cap + 1).alias('matching')
+    rp = yield conn.execute(
+        sa.select([sa.func.count()]).select_from(matching))
+    count = yield rp.scalar()
+    defer.returnValue((min(count, cap), count > cap))
+
+
+@defer.inlineCallbacks
+def count_pages(table, where, pagination, conn):
+    """ Fill num_objects/num_pages of pagination. num_objects_capped is
+    set when a search matched more than COUNT_CAP rows """
+    if where is None:
+        count = yield get_count(table, conn=conn)
+        capped = False
+    else:
+        count, capped = yield get_filtered_count(table, where, conn)
+    pagination['num_objects'] = count
+    pagination['num_objects_capped'] = capped
+    pagination['num_pages'] = ceildiv(count, pagination['per_page'])
+
+
+def cache_search(request, index, pagination):
+    """ The current page of a search answered by index, for when the DB
+    is unavailable """
+    per_page = pagination['per_page']
+    count, objects = index.search(request_args(request, 'search'),
+                                  (pagination['cur_page'] - 1) * per_page,
+                                  per_page)
+    pagination['num_objects'] = count
+    pagination['num_objects_capped'] = False
+    pagination['num_pages'] = ceildiv(count, per_page)
+    pagination['next'] = pagination['prev'] = None
+    return objects
+
+
+# The beacon list: public beacon columns and the name of the listener
+# that last saw each beacon, in one query
+BEACON_LIST = sa.select(
+    [c for c in db.beacons.columns if c.name not in Beacon._private_fields] +
+    [db.listeners.c.name.label('listener_name')]).select_from(
+        db.beacons.outerjoin(
+            db.listeners, db.beacons.c.listener_id == db.listeners.c.id))
+
+
+def cached_beacon_rows(beacons):
+    """ Cached beacons shaped like BEACON_LIST rows, DateTime fields as
+    datetimes so they encode as the same integer epochs """
+    time_fields = [Beacon._fields[i] for i in Beacon._time_fields]
+    rows = []
+    for b in beacons:
+        row = b.flat_dict()
+        for f in time_fields:
+            if f in row:
+                row[f] = to_datetime(row[f])
+        listener = STATE.listeners.get(row.get('listener_id'))
+        row['listener_name'] = listener['name'] \
+            if listener is not None and 'name' in listener else None
+        rows.append(row)
+    return rows
+
+
 @app.route('/beacons')
 @defer.inlineCallbacks
 def b_list(request):
+    """ Rows are rendered (or encoded as one JSON list) straight from
+    the result, without building a Beacon for each """
     page = env.get_template('beacon_list.html')
-    conn = yield db.get_connection()
 
     # Todo replace pagination dict with attrs obj
-    query, pagination, search = query_filter(request, db.beacons.select(),
-                                             search_fields=[db.beacons.c.name, db.beacons.c.id])
-    cur = yield conn.execute(query)
-    if not search:
-        pagination['num_objects'] = yield get_count(db.beacons, conn=conn)
-    else:
-        pagination['num_objects'] = cur.rowcount
-    pagination['num_pages'] = ceildiv(pagination['num_objects'],
-                                      pagination['per_page'])
-    results = yield cur.fetchall()
-    beacons = model_rp(results, Beacon)
+    query, pagination, search, where = query_filter(
+        request, BEACON_LIST,
+        search_fields=[db.beacons.c.name, db.beacons.c.id],
+        table=db.beacons)
+    scope = db.ConnectionScope()
+    try:
+        cur = yield scope.execute(query)
+        results = yield cur.fetchall()
+        yield count_pages(db.beacons, where, pagination, scope)
+        beacons = pagination['keyset'].page(results, pagination)
+    except Exception:
+        if where is None:
+            raise
+        log.err(None, "Beacon search falling back to the cache")
+        beacons = cached_beacon_rows(
+            cache_search(request, BEACON_INDEX, pagination))
+    finally:
+        # Given back before the response is written
+        yield scope.close().addErrback(log.err)
     if request.requestHeaders.hasHeader('Accept'):
         accept = request.requestHeaders.getRawHeaders('Accept')[0]
         if accept.endswith('json'):
             request.responseHeaders.addRawHeader('Content-Type', accept)
-            defer.returnValue(
-                json.dumps([b.flatten() for b in beacons],
-                           cls=BytesEncoder))
-    query = db.listeners.select().where(db.listeners.c.id.in_(
-        [b['listener_id'] for b in beacons if b['listener_id']]))
-    cur = yield conn.execute(query)
-    results = yield cur.fetchall()
-    listeners = {i['id']: i for i in model_rp(results, Listener)}
-    yield conn.close()
+            body = yield defer.maybeDeferred(
+                write_list, request, [dict(b) for b in beacons])
+            defer.returnValue(body)
     defer.returnValue(page.render(obj_list=beacons,
-                                  relation=listeners,
                                   pagination=pagination,
                                   search=search))
 
@@ -173,32 +412,150 @@ def b_list(request):
 @defer.inlineCallbacks
 def l_list(request):
     page = env.get_template('listener_list.html')
-    query, pagination, search = query_filter(
+    query, pagination, search, where = query_filter(
         request, db.listeners.select(),
-        search_fields=[db.listeners.c.name, db.listeners.c.id])
-    conn = yield db.get_connection()
-    cur = yield conn.execute(query)
-    if not search:
-        pagination['num_objects'] = yield get_count(db.listeners, conn=conn)
-    else:
-        pagination['num_objects'] = cur.rowcount
-    pagination['num_pages'] = ceildiv(pagination['num_objects'],
-                                      pagination['per_page'])
-    results = yield cur.fetchall()
-    listeners = model_rp(results, Listener)
-    yield conn.close()
+        search_fields=[db.listeners.c.name, db.listeners.c.id],
+        table=db.listeners)
+    scope = db.ConnectionScope()
+    try:
+        cur = yield scope.execute(query)
+        results = yield cur.fetchall()
+        yield count_pages(db.listeners, where, pagination, scope)
+        listeners = model_rp(pagination['keyset'].page(results, pagination),
+                             Listener)
+    except Exception:
+        if where is None:
+            raise
+        log.err(None, "Listener search falling back to the cache")
+        listeners = cache_search(request, LISTENER_INDEX, pagination)
+    finally:
+        yield scope.close().addErrback(log.err)
     if request.requestHeaders.hasHeader('Accept'):
         accept = request.requestHeaders.getRawHeaders('Accept')[0]
         if accept.endswith('json'):
             request.responseHeaders.addRawHeader('Content-Type', accept)
-            defer.returnValue(
-                json.dumps([l.flatten() for l in listeners],
-                           cls=BytesEncoder))
+            body = yield defer.maybeDeferred(
+                write_list, request, [l.json_dict() for l in listeners])
+            defer.returnValue(body)
     defer.returnValue(page.render(obj_list=listeners,
                                   pagination=pagination,
                                   search=search))
 
 
+def live_filter(request, objects):
+    """ The objects matching the listener, since/until (epoch seconds
+    of last_seen) and missing arguments of request, in their order """
+    listeners = set(request_args(request, 'listener'))
+    since = request_args(request, 'since', cls=float)
+    until = request_args(request, 'until', cls=float)
+    missing = request_args(request, 'missing')
+    since = since[-1] if since else None
+    until = until[-1] if until else None
+    missing = missing[-1].lower() in ('1', 'true', 'yes') if missing \
+        else None
+
+    matched = []
+    for o in objects:
+        last_seen = o['last_seen'] if 'last_seen' in o else None
+        if listeners and not ('listener_id' in o and
+                              o['listener_id'] in listeners):
+            continue
+        if since is not None and (last_seen is None or last_seen < since):
+            continue
+        if until is not None and (last_seen is None or last_seen > until):
+            continue
+        if missing is not None and missing != o.missing_p():
+            continue
+        matched.append(o)
+    return matched
+
+
+def live_page(request, objects, index=None):
+    """ Render a filtered, paginated page of cached objects as JSON.
+    Objects are ordered by id; only the ones up to the requested page
+    are picked out, the rest are never sorted. With a search argument,
+    the objects are those index finds instead, in rank order.
+
+    The ETag covers the query and the stamps of every matching object,
+    so it changes with any of them or with the set itself. If it
+    matches If-None-Match the response is a bodiless 304. Stamps are
+    counters, not times, so no Last-Modified is sent.
+    """
+    search = request_args(request, 'search')
+    ranked = bool(search and index is not None)
+    if ranked:
+        matched = live_filter(request, index.search(search)[1])
+    else:
+        matched = live_filter(request, objects)
+    stamps = [o.stamp for o in matched]
+    etag = '"{}"'.format(hashlib.sha1(repr(
+        (request.uri, len(stamps), max(stamps or [0]), sum(stamps))
+    ).encode()).hexdigest())
+
+    request.responseHeaders.setRawHeaders('ETag', [etag])
+    if_none_match = request.requestHeaders.getRawHeaders('If-None-Match')
+    if if_none_match and etag in [t.strip() for h in if_none_match
+                                  for t in h.split(',')]:
+        request.setResponseCode(http.NOT_MODIFIED)
+        return b''
+
+    limit = request_args(request, 'limit', cls=int)
+    page = request_args(request, 'p', cls=int)
+    offset = request_args(request, 'offset', cls=int)
+    # A limit of 0 (or less) gets the default, as in query_filter
+    pagination = {'per_page': limit[-1] if limit and limit[-1] > 0
+                  else DEFAULT_PER_PAGE}
+    if page:
+        pagination['cur_page'] = page[-1]
+        offset = (page[-1] - 1) * pagination['per_page']
+    elif offset:
+        offset = offset[-1]
+        pagination['cur_page'] = offset // pagination['per_page'] + 1
+    else:
+        offset = 0
+        pagination['cur_page'] = 1
+    pagination['num_objects'] = len(matched)
+    pagination['num_pages'] = ceildiv(len(matched), pagination['per_page'])
+    offset = max(offset, 0)
+    end = offset + pagination['per_page']
+    if ranked:
+        shown = matched[offset:end]
+    else:
+        shown = heapq.nsmallest(end, matched, key=lambda o: o['id'])[offset:]
+
+    request.responseHeaders.setRawHeaders('Content-Type',
+                                          ['application/json'])
+    return write_list(
+        request, [o.json_dict() for o in shown],
+        prefix=b'{"pagination":' + dumps(pagination) + b',"objects":',
+        suffix=b'}')
+
+
+@app.route('/beacons.json')
+def b_live(request):
+    return live_page(request, list(STATE.beacons.values()), BEACON_INDEX)
+
+
+@app.route('/listeners.json')
+def l_live(request):
+    return live_page(request, list(STATE.listeners.values()),
+                     LISTENER_INDEX)
+
+
+@app.route('/events')
+def events(request):
+    """ Stream beacon and listener changes as server-sent events. Each
+    event holds the object as in /beacons.json; load that after
+    connecting, and again on a resync event """
+    request.setHeader('Content-Type', 'text/event-stream')
+    request.setHeader('Cache-Control', 'no-cache')
+    client = EventClient(request, EVENT_CLIENT_BUFFER)
+    EVENTS.add_client(client)
+    request.write(b'retry: 2000\n\n')
+    # Klein cancels this when the client goes away
+    return defer.Deferred(lambda _: EVENTS.remove_client(client))
+
+
 def last_header(headers, header, cls=None):
     if not headers.hasHeader("limit"):
         return None
@@ -207,25 +564,26 @@ def last_header(headers, header, cls=None):
 
 
 @app.route('/beacons/<string:b_id>', methods=['GET', 'POST', 'DELETE'])
+@scoped
 @defer.inlineCallbacks
-def b_detail(request, b_id):
-    b = yield Beacon.fetch(b_id)
+def b_detail(request, scope, b_id):
+    b = yield Beacon.fetch(b_id, scope)
     if not b:
         request.setResponseCode(404)
         defer.returnValue("Not Found")
-    if request.method == 'POST':
-        if 'name' in request.args:
-            b['name'] = request.args['name'][0]
-            yield b.save()
-            from listenerd import BEACONS
-            cache_key = unhexlify(b_id)
-            if cache_key in BEACONS:
-                BEACONS[cache_key]['name'] = b['name']
-    elif request.method == 'DELETE':
-        yield b.delete()
+    method = request_method(request)
+    name = request_args(request, 'name')
+    # The caches only hear of changes once they are committed
+    if method == 'POST':
+        if name:
+            b['name'] = name[0]
+            yield b.save(scope)
+            scope.after_commit(STATE.update, 'beacon', b_id,
+                               {'name': b['name']})
+    elif method == 'DELETE':
+        yield b.delete(scope)
         request.setResponseCode(201)
-        from listenerd import BEACONS
-        del BEACONS[b_id]
+        scope.after_commit(STATE.delete, 'beacon', b_id)
         defer.returnValue(None)
     else:
         if request.requestHeaders.hasHeader('Accept'):
@@ -238,21 +596,23 @@ def b_detail(request, b_id):
 
 
 @app.route('/listeners/<string:l_id>', methods=['GET', 'POST', 'DELETE'])
+@scoped
 @defer.inlineCallbacks
-def l_detail(request, l_id):
+def l_detail(request, scope, l_id):
     page = env.get_template('listener_detail.html')
-    l = yield Listener.fetch(l_id)
-    if request.method == 'POST':
-        if 'name' in request.args:
-            l['name'] = request.args['name'][0]
-            yield l.save()
-            from listenerd import LISTENERS
-            LISTENERS[l_id]['name'] = l['name']
-    elif request.method == 'DELETE':
-        yield l.delete()
+    l = yield Listener.fetch(l_id, scope)
+    method = request_method(request)
+    name = request_args(request, 'name')
+    if method == 'POST':
+        if name:
+            l['name'] = name[0]
+            yield l.save(scope)
+            scope.after_commit(STATE.update, 'listener', l_id,
+                               {'name': l['name']})
+    elif method == 'DELETE':
+        yield l.delete(scope)
         request.setResponseCode(201)
-        from listenerd import LISTENERS
-        del LISTENERS[l_id]
+        scope.after_commit(STATE.delete, 'listener', l_id)
         defer.returnValue(None)
     defer.returnValue(page.render(obj=l))
 
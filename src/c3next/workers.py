@@ -0,0 +1,168 @@
+""" Process layout: the listener can run as several worker processes
+sharing port 9999, with the web UI in one of them or on its own.
+
+Each listener worker keeps its own LISTENERS/BEACONS caches. A listener
+stays on one connection, so the kernel's SO_REUSEPORT balancing shards
+listeners between workers; beacons heard by listeners on different
+workers are reconciled through the DB by DataPersistanceService, whose
+upserts never move a beacon's clock (or a listener's last_seen)
+backwards, and whose incremental sync pulls in the other workers'
+writes. Deletes, which the sync cannot see, and edits from the web
+process reach every worker through the shared state store.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+
+from twisted.application import internet, service
+from twisted.internet import protocol, reactor
+from twisted.python import log
+
+from c3next.config import (DECRYPT_POOL_SIZE, LISTENER_WORKERS,
+                           SIGHTING_BATCH_SIZE, SIGHTING_FLUSH_INTERVAL,
+                           SIGHTING_MAX_BUFFER, STATE_POLL_INTERVAL,
+                           WEB_PROCESS)
+from c3next.state import STATE
+
+LISTENER_PORT = 9999
+WEB_ENDPOINT = "tcp:8000"
+RESPAWN_DELAY = 1
+
+
+def listener_services(reuse_port=False):
+    """ Services of one listener process """
+    from c3next.listenerd import (ListenerProtocol, DataPersistanceService,
+                                  ReusePortServer, SecureDecryptor)
+    from c3next.presence import PRESENCE, PresenceService
+    from c3next.sightings import SightingWriter
+
+    services = []
+    if DECRYPT_POOL_SIZE:
+        decryptor = SecureDecryptor(DECRYPT_POOL_SIZE)
+        ListenerProtocol.decryptor = decryptor
+        services.append(decryptor)
+
+    if SIGHTING_BATCH_SIZE:
+        sighting_writer = SightingWriter(SIGHTING_BATCH_SIZE,
+                                         SIGHTING_FLUSH_INTERVAL,
+                                         SIGHTING_MAX_BUFFER)
+        ListenerProtocol.sightings = sighting_writer
+        services.append(sighting_writer)
+
+    f = protocol.ServerFactory()
+    f.protocol = ListenerProtocol
+    if reuse_port:
+        services.append(ReusePortServer(LISTENER_PORT, f))
+    else:
+        services.append(internet.TCPServer(LISTENER_PORT, f))
+
+    services.append(DataPersistanceService())
+    services.append(PresenceService(PRESENCE))
+    return services
+
+
+def web_services(sync=False):
+    """ Services of the web UI. With sync, also keep the caches it
+    serves from loaded, for processes without a listener """
+    from c3next.web import WebService
+    services = [WebService(WEB_ENDPOINT)]
+    if sync:
+        from c3next.listenerd import DataPersistanceService
+        from c3next.presence import PRESENCE, PresenceService
+        services.append(DataPersistanceService(persist=False))
+        services.append(PresenceService(PRESENCE))
+    return services
+
+
+def state_services():
+    """ Services every process needs to follow the state store """
+    if not STATE.shared:
+        return []
+    return [internet.TimerService(STATE_POLL_INTERVAL, STATE.poll)]
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, role, index):
+        self.supervisor = supervisor
+        self.role = role
+        self.index = index
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+class WorkerSupervisor(service.Service):
+    """ Spawns one child process per (role, index) in workers and
+    respawns any that exit while the service is running """
+    def __init__(self, workers):
+        self.workers = list(workers)
+        self._procs = {}
+
+    def startService(self):
+        service.Service.startService(self)
+        for role, index in self.workers:
+            self.spawn(role, index)
+
+    def spawn(self, role, index):
+        proto = WorkerProcess(self, role, index)
+        args = [sys.executable, '-m', 'c3next.workers', role, str(index)]
+        self._procs[(role, index)] = reactor.spawnProcess(
+            proto, sys.executable, args, env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2})
+
+    def worker_ended(self, proto, reason):
+        key = (proto.role, proto.index)
+        self._procs.pop(key, None)
+        if not self.running:
+            return
+        log.msg("Worker {}/{} ended ({}), respawning".format(
+            proto.role, proto.index, reason.value))
+        reactor.callLater(RESPAWN_DELAY, self._respawn, *key)
+
+    def _respawn(self, role, index):
+        if self.running and (role, index) not in self._procs:
+            self.spawn(role, index)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for proc in self._procs.values():
+            try:
+                proc.signalProcess('TERM')
+            except Exception:
+                log.err()
+
+
+def main_services():
+    """ Services of the main process under the configured layout """
+    if LISTENER_WORKERS <= 1 and not WEB_PROCESS:
+        return listener_services() + web_services() + state_services()
+    workers = [('listener', i) for i in range(LISTENER_WORKERS)]
+    if WEB_PROCESS:
+        workers.append(('web', 0))
+        return [WorkerSupervisor(workers)]
+    return ([WorkerSupervisor(workers)] + web_services(sync=True) +
+            state_services())
+
+
+def run(role, index):
+    log.startLogging(sys.stdout)
+    log.msg("Starting {} worker {} (pid {})".format(role, index, os.getpid()))
+    top = service.MultiService()
+    if role == 'listener':
+        services = listener_services(reuse_port=True)
+    elif role == 'web':
+        services = web_services(sync=True)
+    else:
+        raise ValueError("Unknown worker role: {}".format(role))
+    for s in services + state_services():
+        s.setServiceParent(top)
+    # The supervisor stops workers with TERM, which stops the reactor
+    reactor.callWhenRunning(top.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown', top.stopService)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    run(sys.argv[1], int(sys.argv[2]))
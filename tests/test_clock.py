@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from pytz import UTC, timezone
+from twisted.internet import task
+
+from c3next.clock import ReactorClock, to_datetime, to_timestamp
+
+
+class Ticks(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+def test_time_is_read_once_per_iteration():
+    reactor = task.Clock()
+    clock = ReactorClock(reactor, Ticks())
+    assert clock.now() == clock.now() == 1.0
+    assert clock.reads == 1
+    reactor.advance(0)
+    assert clock.now() == 2.0
+
+
+def test_time_is_fresh_without_a_running_reactor():
+    reactor = task.Clock()
+    reactor.running = False
+    clock = ReactorClock(reactor, Ticks())
+    assert (clock.now(), clock.now()) == (1.0, 2.0)
+    assert reactor.getDelayedCalls() == []
+
+
+def test_timestamps_round_trip():
+    dt = datetime(2016, 10, 3, 12, 30, 15, 250000, tzinfo=UTC)
+    assert to_timestamp(dt) == 1475497815.25
+    assert to_datetime(to_timestamp(dt)) == dt
+    assert to_timestamp(datetime(1970, 1, 2)) == 86400.0
+    assert to_timestamp(None) is None and to_datetime(None) is None
+    assert to_timestamp(5.0) == 5.0
+
+
+def test_timestamps_of_pre_epoch_and_aware_datetimes():
+    # Also run under Python 2, where timedeltas do not divide
+    assert to_timestamp(datetime(1969, 12, 31, 23, 59, 59, 500000)) == -0.5
+    assert to_timestamp(timezone('US/Eastern').localize(
+        datetime(2016, 3, 13, 3))) == 1457852400.0
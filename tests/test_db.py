@@ -0,0 +1,122 @@
+from twisted.internet import defer
+from twisted.python import failure
+
+from c3next import db
+
+
+class FakeConnection(object):
+    """ Logs begin/commit/rollback/close and the queries it runs """
+    def __init__(self, log, fail_commit=False):
+        self.log = log
+        self.fail_commit = fail_commit
+
+    def begin(self):
+        self.log.append('begin')
+        return defer.succeed(self)
+
+    def commit(self):
+        self.log.append('commit')
+        if self.fail_commit:
+            return defer.fail(RuntimeError("Commit failed"))
+        return defer.succeed(None)
+
+    def rollback(self):
+        self.log.append('rollback')
+        return defer.succeed(None)
+
+    def execute(self, query):
+        self.log.append(query)
+        return defer.succeed(self)
+
+    def close(self):
+        self.log.append('close')
+        return defer.succeed(None)
+
+
+def fake_pool(monkeypatch, fail_commit=False):
+    log = []
+    connections = []
+
+    def get_connection():
+        connections.append(FakeConnection(log, fail_commit))
+        return defer.succeed(connections[-1])
+    monkeypatch.setattr(db, 'get_connection', get_connection)
+    return log, connections
+
+
+def test_scope_checks_out_one_connection(monkeypatch):
+    log, connections = fake_pool(monkeypatch)
+    scope = db.ConnectionScope()
+    assert log == [] and connections == []
+    scope.execute('a')
+    db.with_connection(scope, lambda conn: conn.execute('b'))
+    scope.close()
+    assert len(connections) == 1 and log == ['a', 'b', 'close']
+    # Closed scopes take another connection when used again
+    scope.execute('c')
+    assert len(connections) == 2
+
+
+def test_scope_transaction_commits_or_rolls_back(monkeypatch):
+    log, _ = fake_pool(monkeypatch)
+    scope = db.ConnectionScope(transaction=True)
+    scope.execute('a')
+    results = []
+    scope.finish('ok').addCallback(results.append)
+    assert log == ['begin', 'a', 'commit', 'close'] and results == ['ok']
+    del log[:]
+    scope.execute('b')
+    scope.finish(failure.Failure(RuntimeError())).addErrback(results.append)
+    assert log == ['begin', 'b', 'rollback', 'close'] and len(results) == 2
+
+
+def test_after_commit_waits_for_the_commit(monkeypatch):
+    log, _ = fake_pool(monkeypatch)
+    scope = db.ConnectionScope(transaction=True)
+    scope.execute('a')
+    scope.after_commit(log.append, 'published')
+    assert log == ['begin', 'a']
+    scope.close()
+    assert log == ['begin', 'a', 'commit', 'close', 'published']
+    # Rolled back work is not published
+    del log[:]
+    scope.execute('b')
+    scope.after_commit(log.append, 'published')
+    scope.close(commit=False)
+    assert log == ['begin', 'b', 'rollback', 'close']
+
+
+def test_after_commit_is_dropped_when_the_commit_fails(monkeypatch):
+    log, _ = fake_pool(monkeypatch, fail_commit=True)
+    scope = db.ConnectionScope(transaction=True)
+    scope.execute('a')
+    scope.after_commit(log.append, 'published')
+    failures = []
+    scope.close().addErrback(failures.append)
+    assert log == ['begin', 'a', 'commit', 'close'] and len(failures) == 1
+
+
+def test_with_connection_closes_its_own(monkeypatch):
+    log, connections = fake_pool(monkeypatch)
+    conn = FakeConnection(log)
+    db.with_connection(conn, lambda c: c.execute('a'))
+    assert log == ['a'] and connections == []
+    db.with_connection(None, lambda c: c.execute('b'))
+    assert log == ['a', 'b', 'close'] and len(connections) == 1
+
+
+def test_pool_stats_track_checkouts():
+    stats = db.PoolStats()
+    stats._connect(None, None)
+    stats._checkout(None, None, None)
+    stats._checkout(None, None, None)
+    stats._checkin(None, None)
+    stats.waited(0.5)
+    assert stats.stats() == {'connects': 1, 'checkouts': 2,
+                             'checked_out': 1, 'max_checked_out': 2,
+                             'wait_mean': 0.5, 'wait_max': 0.5}
+
+
+def test_copy_text_keeps_every_float_digit():
+    value = 1500000000.123456
+    assert float(db._copy_text(value)) == value
@@ -0,0 +1,100 @@
+import json
+
+from c3next.events import EventClient, EventStream, RESYNC
+from c3next.models import Listener
+
+
+class FakeRequest(object):
+    def __init__(self):
+        self.written = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def write(self, data):
+        self.written.append(data)
+
+    def events(self):
+        return [json.loads(line[len(b'data: '):])
+                for chunk in self.written for line in chunk.split(b'\n')
+                if line.startswith(b'data: ')]
+
+
+def listener(l_id):
+    obj = Listener()
+    obj.update({'id': l_id, 'name': l_id})
+    return obj
+
+
+def stream_with_client(buffer=10):
+    stream = EventStream(1, 15)
+    request = FakeRequest()
+    client = EventClient(request, buffer)
+    # Not add_client, that starts the LoopingCall
+    stream.clients.add(client)
+    return stream, client, request
+
+
+def test_changes_are_coalesced_per_object():
+    stream, client, request = stream_with_client()
+    obj = listener(u'A')
+    for name in (u'one', u'two', u'three'):
+        obj['name'] = name
+        stream.changed('listener', obj)
+    stream.deleted('listener', u'B')
+    stream.flush()
+    assert request.events() == [
+        {'id': u'A', 'name': u'three', 'missing': True},
+        {'kind': 'listener', 'id': u'B'}]
+
+
+def test_nothing_collected_without_clients():
+    stream = EventStream(1, 15)
+    stream.changed('listener', listener(u'A'))
+    assert stream._pending == {}
+
+
+def test_paused_client_gets_latest_state_on_resume():
+    stream, client, request = stream_with_client()
+    obj = listener(u'A')
+    client.pauseProducing()
+    for name in (u'one', u'two'):
+        obj['name'] = name
+        stream.changed('listener', obj)
+        stream.flush()
+    assert request.written == []
+    client.resumeProducing()
+    assert request.events() == [{'id': u'A', 'name': u'two', 'missing': True}]
+
+
+def test_overflowing_client_is_told_to_resync():
+    stream, client, request = stream_with_client(buffer=3)
+    client.pauseProducing()
+    for i in range(5):
+        stream.changed('listener', listener(u'L{}'.format(i)))
+    stream.flush()
+    assert client.overflows == 1 and not client._backlog
+    client.resumeProducing()
+    assert request.written == [RESYNC]
+
+
+def test_keepalive_when_idle():
+    stream, client, request = stream_with_client()
+    for _ in range(15):
+        stream.flush()
+    assert request.written == [b': keepalive\n\n']
+
+
+def test_failed_keepalive_drops_only_that_client():
+    stream, client, request = stream_with_client()
+    gone = EventClient(FakeRequest(), 10)
+
+    def fail(data):
+        raise RuntimeError("Request finished")
+    gone.request.write = fail
+    stream.clients.add(gone)
+    for _ in range(15):
+        stream.flush()
+    assert stream.clients == {client}
+    assert request.written == [b': keepalive\n\n']
@@ -1,5 +1,6 @@
 import six
-from c3next.hdlc import hdlc_frame, hdlc_unframe, HDLCInvalidFrame
+from c3next.hdlc import (hdlc_frame, hdlc_unframe, HDLCInvalidFrame,
+                         HDLCDeframer, hdlc_frame_many, hdlc_unframe_many)
 
 
 def test_frame_has_flags():
@@ -74,3 +75,82 @@ def test_unframe_unescapes_esc():
 def test_frame_unframe_are_opposites():
     hard_packet = b'A hard packet contains these \x7e\x7d'
     assert hdlc_unframe(hdlc_frame(hard_packet)) == hard_packet
+
+
+def test_deframer_multiple_frames():
+    deframer = HDLCDeframer()
+    stream = hdlc_frame(b'one') + hdlc_frame(b'\x7etwo\x7d')
+    assert list(deframer.feed(stream)) == [b'one', b'\x7etwo\x7d']
+
+
+def test_deframer_partial_frames():
+    deframer = HDLCDeframer()
+    stream = hdlc_frame(b'partial \x7e frame')
+    frames = []
+    for i in range(len(stream)):
+        frames.extend(deframer.feed(stream[i:i+1]))
+    assert frames == [b'partial \x7e frame']
+
+
+def test_deframer_skips_empty_frames():
+    deframer = HDLCDeframer()
+    assert list(deframer.feed(b'\x7e\x7e\x7e')) == []
+    assert list(deframer.feed(b'!\x7e')) == [b'!']
+
+
+def test_deframer_missing_flags_raises_exception():
+    deframer = HDLCDeframer()
+    try:
+        list(deframer.feed(b'No Flags\x7e'))
+    except Exception as e:
+        assert isinstance(e, HDLCInvalidFrame)
+        return
+    assert False, "Failed to raise InvalidPacket on FLAG-less packet"
+
+
+def test_deframer_invalid_escape_raises_exception():
+    deframer = HDLCDeframer()
+    try:
+        list(deframer.feed(b'\x7e\x7d\x7e'))
+    except Exception as e:
+        assert isinstance(e, HDLCInvalidFrame)
+        return
+    assert False, "Failed to recognise invalid escape"
+
+
+def test_deframer_resyncs_after_invalid_frame():
+    errors = []
+    deframer = HDLCDeframer(on_invalid=errors.append)
+    stream = hdlc_frame(b'one') + b'bad\x7e' + hdlc_frame(b'two')
+    assert list(deframer.feed(stream)) == [b'one', b'two']
+    assert len(errors) == 1 and isinstance(errors[0], HDLCInvalidFrame)
+    assert deframer.resyncs == 1
+    assert deframer.dropped_bytes == 3
+
+
+def test_frame_many_matches_frame():
+    packets = [b'one', b'\x7e\x7d', b'']
+    assert hdlc_frame_many(packets) == b''.join(
+        hdlc_frame(p) for p in packets)
+
+
+def test_frame_many_empty():
+    assert hdlc_frame_many([]) == b''
+
+
+def test_unframe_many_shared_flags():
+    assert hdlc_unframe_many(b'\x7eone\x7etwo\x7e\x7e') == [b'one', b'two']
+
+
+def test_frame_many_unframe_many_are_opposites():
+    packets = [b'A hard packet contains these \x7e\x7d', b'\x7d', b'easy']
+    assert hdlc_unframe_many(hdlc_frame_many(packets)) == packets
+
+
+def test_unframe_many_trailing_data_raises_exception():
+    try:
+        hdlc_unframe_many(hdlc_frame(b'one') + b'two')
+    except Exception as e:
+        assert isinstance(e, HDLCInvalidFrame)
+        return
+    assert False, "Failed to raise InvalidPacket on unterminated frame"
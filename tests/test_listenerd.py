@@ -1,5 +1,19 @@
+from datetime import datetime, timedelta
+import struct
+
+from Crypto.Cipher import AES
+from pytz import UTC
+from twisted.internet import defer, task
+
+from c3next import db
 from c3next.hdlc import hdlc_frame
-from c3next.listenerd import ListenerProtocol
+from c3next.listenerd import (ListenerProtocol, BEACONS, KEY_CACHE,
+                              LOCATION, DataPersistanceService,
+                              decrypt_secure)
+from c3next.models import Beacon, Listener
+from c3next.presence import PRESENCE
+from c3next.state import STATE
+from c3next.util import derive_key
 
 
 def mock_proto_factory():
@@ -23,6 +37,13 @@ def mock_proto_factory():
     return proto
 
 
+def secure_payload(b_id, clock, dk, nonce=b'\x01' * 16):
+    cipher = AES.new(derive_key(b_id), AES.MODE_EAX, nonce, mac_len=4)
+    cipher.update(b_id)
+    msg, tag = cipher.encrypt_and_digest(struct.pack("<IIB", clock, dk, 0))
+    return b_id + nonce + msg + tag + struct.pack("<HH", 150, 20)
+
+
 def assert_nack(proto):
     assert proto.transport._spy() == [b'NACK']
 
@@ -51,12 +72,29 @@ def test_multiple_packets_per_call():
     assert proto.transport._spy() == [b'ACK', b'ACK']
 
 
+def test_packet_split_across_calls():
+    proto = mock_proto_factory()
+    frame = hdlc_frame(b'\x00\x00\x04Test')
+    proto.dataReceived(frame[:4])
+    assert proto.transport._spy() == []
+    proto.dataReceived(frame[4:])
+    assert_ack(proto)
+
+
 def test_invalid_hdlc_does_nack():
     proto = mock_proto_factory()
     proto.dataReceived(b'\x7e\x7d\x7e')
     assert_nack(proto)
 
 
+def test_invalid_hdlc_keeps_following_frames():
+    proto = mock_proto_factory()
+    proto.dataReceived(b'\x7e\x7d\x7e' + hdlc_frame(b'\x00\x00\x04Test'))
+    assert proto.transport._spy() == [b'NACK', b'ACK']
+    assert proto._deframer.resyncs == 1
+    assert proto._deframer.dropped_bytes == 1
+
+
 def test_ack_keepalive():
     proto = mock_proto_factory()
     proto.dataReceived(hdlc_frame(b'\x00\x00\x04Test'))
@@ -82,6 +120,43 @@ def test_invalid_mac_check_does_ack():
     assert_ack(proto)
 
 
+def test_decrypt_secure_verifies_mac():
+    b_id = b'\x00\x01\x02\x03\x04\x05'
+    data = secure_payload(b_id, 10, 0xabcd)
+    args = (derive_key(b_id), b_id, data[6:22], data[22:31], data[31:35])
+    assert decrypt_secure(*args) == struct.pack("<IIB", 10, 0xabcd, 0)
+    assert decrypt_secure(derive_key(b'\x00' * 6), *args[1:]) is None
+
+
+def test_valid_secure_packet_updates_beacon():
+    proto = mock_proto_factory()
+    b_id = b'\x10\x11\x12\x13\x14\x15'
+    proto.dataReceived(hdlc_frame(
+        b'\x02\x00\x04Test' + secure_payload(b_id, 10, 0xabcd)))
+    assert_ack(proto)
+    b = BEACONS.pop(b_id)
+    assert (b['clock'], b['dk'], b['listener_id']) == (10, 0xabcd, u'Test')
+    assert not b.missing_p() and ('beacon', b_id) in PRESENCE.wheel
+
+
+def test_data_packet_updates_ibeacons():
+    proto = mock_proto_factory()
+    uuid = b'\x7e' * 16
+    proto.dataReceived(hdlc_frame(
+        b'\x01\x00\x04Test' + uuid + b'\x00\x01\x00\x02\xc4\xc8'))
+    assert_ack(proto)
+    b = BEACONS.pop(uuid + b'\x00\x01\x00\x02')
+    assert b['listener_id'] == u'Test'
+    # Stored as text, not a bytea literal
+    assert b['id'] == u'7e' * 16 + u'00010002'
+
+
+def test_partial_data_packet_does_nack():
+    proto = mock_proto_factory()
+    proto.dataReceived(hdlc_frame(b'\x01\x00\x04Test\x00'))
+    assert_nack(proto)
+
+
 def test_long_l_id_length_does_nack():
     proto = mock_proto_factory()
     proto.dataReceived(hdlc_frame(b'\x00\x00\xffTest'))
@@ -93,3 +168,204 @@ def test_long_l_id_length_does_nack():
 #     proto = proto = mock_proto_factory()
 #     proto.dataReceived(hdlc_frame(b'\x00\x00\x03Test'))
 #     assert_nack(proto)
+
+
+def test_state_delete_forgets_beacon_and_key():
+    proto = mock_proto_factory()
+    b_id = b'\x20\x21\x22\x23\x24\x25'
+    proto.dataReceived(hdlc_frame(
+        b'\x02\x00\x04Test' + secure_payload(b_id, 10, 0xabcd)))
+    assert b_id in BEACONS and b_id in KEY_CACHE._keys
+    STATE.delete('beacon', u'202122232425')
+    assert b_id not in BEACONS
+    assert b_id not in KEY_CACHE._keys
+    assert u'202122232425' not in LOCATION._slots
+
+
+def test_secure_packet_from_another_listener_keeps_location():
+    proto = mock_proto_factory()
+    b_id = b'\x30\x31\x32\x33\x34\x35'
+    for (clock, l_id) in [(10, b'Test'), (11, b'Other')]:
+        proto.dataReceived(hdlc_frame(
+            b'\x02\x00' + struct.pack('B', len(l_id)) + l_id +
+            secure_payload(b_id, clock, 0xabcd)))
+    b = BEACONS.pop(b_id)
+    assert (b['clock'], b['listener_id']) == (11, u'Test')
+
+
+class FakeConnection(object):
+    """ Answers every query with no rows. Each flush's first query, of
+    the listeners, waits on a Deferred appended to pending """
+    def __init__(self, pending):
+        self.pending = pending
+        self.closed = False
+
+    def execute(self, query):
+        if getattr(query, 'froms', None) == [db.listeners]:
+            self.pending.append(defer.Deferred())
+            return self.pending[-1]
+        return defer.succeed(self)
+
+    def fetchall(self):
+        return defer.succeed([])
+
+    def close(self):
+        self.closed = True
+        return defer.succeed(None)
+
+
+def persistence(monkeypatch, **kwargs):
+    """ A DataPersistanceService on a fake clock, the list of Deferreds
+    its flushes are waiting on, and the connections it took """
+    Listener.drain_dirty()
+    Beacon.drain_dirty()
+    pending = []
+    connections = []
+
+    def get_connection():
+        connections.append(FakeConnection(pending))
+        return defer.succeed(connections[-1])
+    monkeypatch.setattr(db, 'get_connection', get_connection)
+    service = DataPersistanceService(**kwargs)
+    service._loop.clock = task.Clock()
+    return service, service._loop.clock, pending, connections
+
+
+def dirty_listeners(n):
+    for i in range(n):
+        obj = Listener()
+        obj.update({'id': u'P{}'.format(i), 'last_seen': 0.0})
+        obj.set_missing(False)
+
+
+def test_persist_flushes_are_single_flight(monkeypatch):
+    service, clock, pending, _ = persistence(monkeypatch, interval=5)
+    service.startService()
+    assert len(pending) == 1
+    # Still in flight a tick later, and flush() joins it
+    clock.advance(2)
+    done = service.flush()
+    assert len(pending) == 1 and not done.called
+    pending[0].callback(FakeConnection(pending))
+    assert done.called and service.serial == 1
+    assert service.last_latency == 2
+    # The next is due an interval after the last finished
+    clock.advance(4.5)
+    assert len(pending) == 1
+    clock.advance(0.5)
+    assert len(pending) == 2
+
+
+def test_persist_flushes_early_once_deep_enough(monkeypatch):
+    service, clock, pending, _ = persistence(
+        monkeypatch, interval=5, min_interval=0.5, flush_depth=3,
+        max_rows=2)
+    service.startService()
+    pending[0].callback(FakeConnection(pending))
+    dirty_listeners(3)
+    assert service.depth() == 3
+    clock.advance(0.5)
+    assert len(pending) == 2
+    conn = FakeConnection(pending)
+    pending[1].callback(conn)
+    # At most max_rows written, the rest waits for the next flush
+    assert service.stats()['last_rows'] == 2 and service.depth() == 1
+    service.stopService()
+    Listener.drain_dirty()
+
+
+def test_persist_backs_off_after_failures(monkeypatch):
+    service, clock, pending, _ = persistence(monkeypatch, interval=5,
+                                             max_interval=12)
+    service.startService()
+    for (i, wait) in enumerate([10, 12, 12]):
+        pending[i].errback(RuntimeError("DB down"))
+        clock.advance(wait - 0.5)
+        assert len(pending) == i + 1
+        clock.advance(0.5)
+        assert len(pending) == i + 2
+    assert service.failed_flushes == 3
+    pending[3].callback(FakeConnection(pending))
+    clock.advance(5)
+    assert len(pending) == 5
+
+
+def test_slow_flushes_space_out_the_next(monkeypatch):
+    service, clock, pending, _ = persistence(monkeypatch, interval=5,
+                                             slow_factor=2)
+    service.startService()
+    clock.advance(4)
+    pending[0].callback(FakeConnection(pending))
+    clock.advance(7.5)
+    assert len(pending) == 1
+    clock.advance(0.5)
+    assert len(pending) == 2
+
+
+def test_persist_flushes_share_a_connection(monkeypatch):
+    service, clock, pending, connections = persistence(monkeypatch,
+                                                       interval=5)
+    service.startService()
+    pending[0].callback(FakeConnection(pending))
+    clock.advance(5)
+    pending[1].callback(FakeConnection(pending))
+    assert len(connections) == 1 and not connections[0].closed
+    # A failed flush gives its connection back, the next takes another
+    clock.advance(5)
+    pending[2].errback(RuntimeError("Connection lost"))
+    assert connections[0].closed
+    clock.advance(10)
+    assert len(connections) == 2
+    pending[3].callback(FakeConnection(pending))
+    d = service.stopService()
+    # Stopping writes what is left, then gives the connection back
+    pending[4].callback(FakeConnection(pending))
+    pending[5].callback(FakeConnection(pending))
+    assert connections[1].closed and d.called
+
+
+class RowsScope(object):
+    """ A connection scope answering each query with the next rows """
+    def __init__(self, *passes):
+        self.passes = list(passes)
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+        return defer.succeed(self)
+
+    def fetchall(self):
+        return defer.succeed(self.passes.pop(0))
+
+
+def beacon_row(b_id, updated_at):
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': b_id, 'name': b_id, 'key': b'', 'dk': 0, 'clock': 0,
+                'updated_at': updated_at})
+    return row
+
+
+def test_sync_skips_rows_it_read_already_and_bad_ids():
+    t0 = datetime(2016, 10, 3, tzinfo=UTC)
+    first = [beacon_row(u'0a0b', t0), beacon_row(u'bench00000001', t0)]
+    later = beacon_row(u'0c0d', t0 + timedelta(seconds=0.5))
+    service = DataPersistanceService()
+    service._scope = RowsScope(first, first + [later])
+    cache = {}
+    synced = []
+    service._sync(Beacon, cache, 'beacon').addCallback(synced.append)
+    service._sync(Beacon, cache, 'beacon').addCallback(synced.append)
+    # The rows of the overlap are fetched again, but not applied again
+    assert synced == [1, 1]
+    assert sorted(cache) == [b'\x0a\x0b', b'\x0c\x0d']
+    assert 'updated_at >' in str(service._scope.queries[1])
+
+
+def test_flush_finishing_at_once():
+    service = DataPersistanceService(persist=False)
+    service._scope = RowsScope([], [], [], [])
+    done = service.flush()
+    assert done.called and service._flushing is None
+    assert service.serial == 1
+    # And again, with nothing left in flight
+    assert service.flush().called and service.serial == 2
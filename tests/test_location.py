@@ -0,0 +1,50 @@
+from c3next.location import LocationEngine
+
+
+def test_first_sighting_is_taken():
+    engine = LocationEngine(window=4, stable=2)
+    assert engine.observe(u'b', u'L1', 5.0, 1.0, 0) == u'L1'
+
+
+def test_nearer_listener_needs_a_stable_lead():
+    engine = LocationEngine(window=6, stable=3)
+    for t in range(3):
+        engine.observe(u'b', u'far', 8.0, 1.0, t)
+    assert engine.observe(u'b', u'near', 1.0, 1.0, 3) == u'far'
+    # Still the best listener on a sighting by another one
+    assert engine.observe(u'b', u'far', 8.0, 1.0, 4) == u'far'
+    assert engine.observe(u'b', u'far', 8.0, 1.0, 5) == u'near'
+    assert engine.stats() == {'beacons': 1, 'flaps': 2, 'switches': 1}
+
+
+def test_noisy_sightings_weigh_less():
+    engine = LocationEngine(window=8, stable=1)
+    engine.observe(u'b', u'steady', 3.0, 0.1, 0)
+    engine.observe(u'b', u'steady', 3.0, 0.1, 1)
+    # Nearer on paper, but with a variance that makes it unlikely
+    assert engine.observe(u'b', u'noisy', 1.0, 100.0, 2) == u'steady'
+    assert engine.observe(u'b', u'noisy', 1.0, 100.0, 3) == u'steady'
+
+
+def test_interleaved_listeners_do_not_flap():
+    engine = LocationEngine(window=8, stable=3)
+    seen = set()
+    for t in range(100):
+        l_id, distance = [(u'A', 2.0), (u'B', 2.5), (u'C', 2.2)][t % 3]
+        seen.add(engine.observe(u'b', l_id, distance, 0.5, t / 10))
+    assert seen == {u'A'}
+    assert engine.flaps == 99 and engine.switches == 0
+
+
+def test_stale_current_listener_is_dropped():
+    engine = LocationEngine(window=4, stable=3, max_age=10)
+    engine.observe(u'b', u'L1', 1.0, 1.0, 0)
+    assert engine.observe(u'b', u'L2', 5.0, 1.0, 20) == u'L2'
+
+
+def test_forgotten_slots_are_reused():
+    engine = LocationEngine(window=4, stable=2)
+    engine.observe(u'b1', u'L1', 1.0, 1.0, 0)
+    engine.forget(u'b1')
+    assert engine.observe(u'b2', u'L2', 1.0, 1.0, 1) == u'L2'
+    assert len(engine) == 1 and len(engine._head) == 1
@@ -63,3 +63,24 @@ def test_lid_munge_lt_six_is_ascii():
 def test_lid_munge_pt_six_is_ascii():
     assert lproto.lid_munge(
         b'\x00\x01\x02\x03\x04\x05\x06') == u'\x00\x01\x02\x03\x04\x05\x06'
+
+
+def test_iter_ibeacons_decodes_records():
+    uuid = b'\x01' * 16
+    data = (uuid + b'\x00\x02\x00\x03\xc4\xc8' +
+            uuid + b'\x00\x04\x00\x05\xb0\xc5')
+    assert list(lproto.iter_ibeacons(data)) == [
+        (uuid, 2, 3, -60, -56), (uuid, 4, 5, -80, -59)]
+
+
+def test_iter_ibeacons_empty():
+    assert list(lproto.iter_ibeacons(b'')) == []
+
+
+def test_iter_ibeacons_partial_record_does_exception():
+    try:
+        lproto.iter_ibeacons(b'\x00' * (lproto.IBEACON.size + 1))
+    except Exception as e:
+        assert isinstance(e, lproto.InvalidData)
+        return
+    assert False, "Failed to detect partial iBeacon record"
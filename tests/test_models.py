@@ -0,0 +1,244 @@
+from datetime import datetime
+import random
+
+import pytest
+from pytz import UTC
+from sqlalchemy.dialects import postgresql
+from twisted.internet import defer, task
+
+from c3next.clock import ReactorClock, to_datetime
+from c3next.config import DK0_INTERVAL, DK1_INTERVAL
+from c3next.models import Beacon, MissingData
+from c3next.util import evolve_dk
+
+
+def loop_valid_dk(dk, clock, new_dk, new_clock):
+    """ Beacon.valid_dk as it was, one evolve_dk per tick """
+    mask = 0xffffffff
+    b_dk = dk
+    for i in range(clock+1, new_clock+1):
+        if i % DK0_INTERVAL == 0:
+            b_dk, mask = evolve_dk(b_dk, mask, 0)
+        if i % DK1_INTERVAL == 0:
+            b_dk, mask = evolve_dk(b_dk, mask, 1)
+    if mask == 0:
+        return True
+    return b_dk == (new_dk & mask)
+
+
+@pytest.fixture(autouse=True)
+def drain_dirty():
+    """ Containers made here queue themselves for persistence, don't
+    leave them to other tests """
+    Beacon.drain_dirty()
+    yield
+    Beacon.drain_dirty()
+
+
+def beacon(dk, clock):
+    b = Beacon()
+    b.update({'dk': dk, 'clock': clock})
+    return b
+
+
+def random_cases(n, seed=0):
+    rand = random.Random(seed)
+    for _ in range(n):
+        dk = rand.getrandbits(32)
+        clock = rand.choice([0, DK0_INTERVAL - 1, DK1_INTERVAL - 1,
+                             rand.randrange(2 * DK1_INTERVAL)])
+        gap = rand.choice([0, 1, DK0_INTERVAL, DK1_INTERVAL,
+                           rand.randrange(-10, 3 * DK1_INTERVAL)])
+        new_dk = rand.choice([dk, rand.getrandbits(32),
+                              (dk << rand.randrange(4)) & 0xffffffff])
+        yield dk, clock, new_dk, clock + gap
+
+
+@pytest.mark.parametrize("dk,clock,new_dk,new_clock",
+                         list(random_cases(200)))
+def test_valid_dk_matches_loop(dk, clock, new_dk, new_clock):
+    assert (beacon(dk, clock).valid_dk(new_dk, new_clock) ==
+            loop_valid_dk(dk, clock, new_dk, new_clock))
+
+
+def test_valid_dk_accepts_same_dk():
+    assert beacon(0x12345678, 100).valid_dk(0x12345678, 200)
+
+
+def test_valid_dk_rejects_changed_dk():
+    assert not beacon(0x12345678, 100).valid_dk(0x12345679, 200)
+
+
+def test_new_container_is_clean():
+    b = Beacon(row={c.name: None for c in Beacon._table.columns})
+    assert not b.dirty_p()
+    assert b not in Beacon._dirty_set
+
+
+def test_setitem_registers_dirty():
+    b = beacon(1, 2)
+    assert b.dirty_p()
+    assert b in Beacon.drain_dirty()
+    assert b not in Beacon._dirty_set
+
+
+def test_unchanged_value_stays_clean():
+    b = beacon(1, 2)
+    b.mark_clean()
+    b['dk'] = 1
+    assert not b.dirty_p()
+    assert b not in Beacon._dirty_set
+
+
+def test_mark_clean_keeps_fields_changed_after_snapshot():
+    b = beacon(1, 2)
+    persisted = b.dirty_dict()
+    b['clock'] = 3
+    b.mark_clean(persisted)
+    assert b.dirty_fields() == ['clock']
+    assert b in Beacon._dirty_set
+    b.mark_clean()
+    assert b not in Beacon._dirty_set
+
+
+def test_refresh_keeps_local_changes():
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'dk': 1, 'clock': 2, 'name': u'db'})
+    b = Beacon(row=row)
+    b['clock'] = 3
+    b.refresh(dict(row, clock=4, name=u'renamed'))
+    assert (b['clock'], b['name']) == (3, u'renamed')
+    assert b.dirty_fields() == ['clock']
+
+
+def test_upsert_only_updates_given_columns():
+    query = Beacon._upsert_query(('clock', 'dk', 'id', 'key'))
+    set_clause = str(query.compile(dialect=postgresql.dialect())).split(
+        'DO UPDATE SET')[1]
+    assert 'clock' in set_clause
+    assert 'name' not in set_clause
+    assert 'rejected_mac' not in set_clause
+
+
+def test_upsert_guard_rejects_older_clock():
+    query = Beacon._upsert_query(('clock', 'dk', 'id', 'key'))
+    sql = str(query.compile(dialect=postgresql.dialect()))
+    assert 'WHERE beacons.clock IS NULL OR beacons.clock <= excluded.clock' \
+        in sql
+    query = Beacon._upsert_query(('id', 'name'))
+    assert 'WHERE' not in str(query.compile(dialect=postgresql.dialect()))
+
+
+def test_copy_columns_fill_scalar_defaults():
+    columns, defaults = Beacon._copy_columns(('clock', 'dk', 'id', 'key'))
+    assert defaults == {'rejected_replay': 0, 'rejected_mac': 0,
+                        'rejected_dk': 0}
+    assert columns[:4] == ['clock', 'dk', 'id', 'key']
+
+
+def test_containers_have_no_instance_dict():
+    assert not hasattr(Beacon(), '__dict__')
+
+
+def test_missing_field_raises_missing_data():
+    b = Beacon()
+    assert 'name' not in b
+    with pytest.raises(MissingData):
+        b['name']
+    with pytest.raises(KeyError):
+        b['no_such_field'] = 1
+
+
+def test_time_fields_are_held_as_epoch_seconds():
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': u'01', 'last_seen': datetime(1970, 1, 2, 0, 0, 1,
+                                                   500000, tzinfo=UTC)})
+    b = Beacon(row=row)
+    assert b['last_seen'] == 86401.5
+    assert b.json_dict()['last_seen'] == 86401
+    b.refresh({'last_seen': datetime(1970, 1, 3, tzinfo=UTC)})
+    assert b['last_seen'] == 172800.0
+
+
+class RecordingConnection(object):
+    def __init__(self, rowcount=1, fail=False):
+        self.queries = []
+        self.rowcount = rowcount
+        self.fail = fail
+
+    def execute(self, query):
+        self.queries.append(query)
+        if self.fail:
+            return defer.fail(RuntimeError("Query failed"))
+        return defer.succeed(self)
+
+    def close(self):
+        return defer.succeed(None)
+
+
+def test_upsert_writes_time_fields_as_datetimes():
+    conn = RecordingConnection()
+    Beacon.upsert([{'id': u'01', 'key': b'', 'dk': 0, 'clock': 0,
+                    'last_seen': 86401.5}], conn=conn)
+    params = conn.queries[0].compile(dialect=postgresql.dialect()).params
+    assert datetime(1970, 1, 2, 0, 0, 1, 500000, tzinfo=UTC) in \
+        params.values()
+
+
+def test_drain_dirty_limit_leaves_the_rest_queued():
+    for i in range(5):
+        beacon(i, i)
+    assert len(Beacon.drain_dirty(3)) == 3
+    assert len(Beacon.drain_dirty()) == 2
+
+
+def loaded_beacon():
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': u'01', 'key': b'', 'dk': 0, 'clock': 10})
+    return Beacon(row=row)
+
+
+def test_save_updates_only_edited_columns():
+    b = loaded_beacon()
+    b['name'] = u'renamed'
+    conn = RecordingConnection()
+    b.save(conn)
+    assert len(conn.queries) == 1 and not b.dirty_p()
+    query = conn.queries[0].compile(dialect=postgresql.dialect())
+    # No clock guard, so an edit of an older read is not dropped
+    assert str(query).startswith('UPDATE beacons SET name=')
+    assert 'clock' not in str(query)
+
+
+def test_save_upserts_a_missing_row():
+    b = loaded_beacon()
+    b['name'] = u'renamed'
+    conn = RecordingConnection(rowcount=0)
+    b.save(conn)
+    assert len(conn.queries) == 2
+    assert str(conn.queries[1].compile(
+        dialect=postgresql.dialect())).startswith('INSERT INTO beacons')
+
+
+def test_failed_save_is_not_queued_for_persist():
+    b = loaded_beacon()
+    b['name'] = u'renamed'
+    failures = []
+    b.save(RecordingConnection(fail=True)).addErrback(failures.append)
+    assert len(failures) == 1 and b.dirty_p()
+    assert b not in Beacon.drain_dirty()
+
+
+def test_refresh_with_a_written_time_keeps_the_stamp():
+    reactor = task.Clock()
+    reactor.running = False
+    clock = ReactorClock(reactor)
+    b = loaded_beacon()
+    for _ in range(100):
+        now = clock.now()
+        b['last_seen'] = now
+        b.mark_clean()
+        stamp = b.stamp
+        # Read back with the microseconds the DB keeps
+        b.refresh({'last_seen': to_datetime(now)})
+        assert b.stamp == stamp
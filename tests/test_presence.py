@@ -0,0 +1,76 @@
+from c3next.events import EVENTS
+from c3next.models import Listener
+from c3next.presence import PresenceTracker, TimingWheel
+from c3next.state import STATE
+
+
+def expire_times(wheel, until):
+    """ {key: tick it expired on} advancing one tick at a time """
+    expired = {}
+    for now in range(wheel._tick + 1, until + 1):
+        for key in wheel.advance(now):
+            expired[key] = now
+    return expired
+
+
+def test_keys_expire_on_their_tick():
+    wheel = TimingWheel(1, 0, slots=8, levels=3)
+    for deadline in (1, 5, 7, 8, 20, 63, 64, 100, 511):
+        wheel.schedule(deadline, deadline)
+    assert expire_times(wheel, 600) == {d: d for d in
+                                        (1, 5, 7, 8, 20, 63, 64, 100, 511)}
+    assert len(wheel) == 0
+
+
+def test_rearming_extends_the_deadline():
+    wheel = TimingWheel(1, 0, slots=8, levels=2)
+    wheel.schedule('a', 10)
+    wheel.schedule('a', 30)
+    # An earlier deadline does not shorten it
+    wheel.schedule('a', 5)
+    assert expire_times(wheel, 40) == {'a': 30}
+
+
+def test_deadlines_past_the_wheel_are_clamped():
+    wheel = TimingWheel(1, 0, slots=4, levels=2)
+    wheel.schedule('far', 100)
+    assert expire_times(wheel, 120) == {'far': 100}
+
+
+def test_past_deadlines_expire_on_the_next_tick():
+    wheel = TimingWheel(1, 50, slots=8, levels=2)
+    wheel.schedule('late', 10)
+    assert wheel.advance(50) == []
+    assert wheel.advance(51) == ['late']
+
+
+def test_advancing_several_ticks_at_once():
+    wheel = TimingWheel(0.5, 0, slots=8, levels=2)
+    wheel.schedule('a', 3.2)
+    assert wheel.advance(3.4) == []
+    assert wheel.advance(30) == ['a']
+
+
+def test_tracker_marks_missing_and_sends_a_change(monkeypatch):
+    tracker = PresenceTracker(30, 1, now=0)
+    l = Listener()
+    l.update({'id': u'presence', 'name': u'presence'})
+    monkeypatch.setitem(STATE.listeners, u'presence', l)
+    sent = []
+    monkeypatch.setattr(EVENTS, 'changed',
+                        lambda kind, obj: sent.append((kind, obj)))
+    assert l.missing_p()
+    tracker.seen('listener', u'presence', l, 10)
+    assert not l.missing_p()
+    tracker.expire(39)
+    assert not l.missing_p() and sent == []
+    tracker.expire(40)
+    assert l.missing_p() and sent == [('listener', l)]
+    assert tracker.stats() == {'tracked': 0, 'went_missing': 1}
+
+
+def test_sightings_older_than_the_timeout_are_ignored():
+    tracker = PresenceTracker(30, 1, now=100)
+    l = Listener()
+    tracker.seen('listener', u'old', l, 60)
+    assert l.missing_p() and len(tracker.wheel) == 0
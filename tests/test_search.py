@@ -0,0 +1,74 @@
+from sqlalchemy.dialects import postgresql
+
+from c3next import db
+from c3next.models import Listener
+from c3next.search import NgramIndex, rank_order, search_clause
+
+
+def listener(l_id, name):
+    l = Listener()
+    l.update({'id': l_id, 'name': name})
+    return l
+
+
+def index_of(*listeners):
+    cache = {l['id']: l for l in listeners}
+    return cache, NgramIndex(cache, refresh_interval=0)
+
+
+def names(found):
+    return [o['name'] for o in found[1]]
+
+
+def test_prefix_matches_first():
+    cache, index = index_of(listener(u'L1', u'Back Dock'),
+                            listener(u'L2', u'Dock Door'),
+                            listener(u'L3', u'Office'),
+                            listener(u'L4', u'Docking Bay'))
+    assert names(index.search([u'dock'])) == [
+        u'Dock Door', u'Docking Bay', u'Back Dock']
+    assert index.search([u'do'])[0] == 3
+
+
+def test_matches_ids_and_any_term():
+    cache, index = index_of(listener(u'ABC123', None),
+                            listener(u'L2', u'Cart'))
+    assert [l['id'] for l in index.search([u'c12', u'car'])[1]] == [
+        u'L2', u'ABC123']
+
+
+def test_refresh_follows_cache():
+    cache, index = index_of(listener(u'L1', u'Dock'))
+    assert index.search([u'dock'])[0] == 1
+    cache[u'L1']['name'] = u'Office'
+    cache[u'L2'] = listener(u'L2', u'Docks')
+    assert names(index.search([u'dock'])) == [u'Docks']
+    del cache[u'L2']
+    assert index.search([u'dock']) == (0, [])
+    assert set(index._grams) == {u'off', u'ffi', u'fic', u'ice'}
+
+
+def compiled(clause):
+    return clause.compile(dialect=postgresql.dialect())
+
+
+def test_search_clause_likes_the_indexed_expressions():
+    # The *_trgm indexes are on lower(name) and lower(id)
+    where = compiled(search_clause(
+        [u'ab', u'c'], [db.beacons.c.name, db.beacons.c.id]))
+    sql = str(where)
+    assert sql.count('lower(beacons.name) LIKE ') == 2
+    assert sql.count('lower(beacons.id) LIKE ') == 2
+    assert list(where.params.values()).count(u'%') == 8
+    assert search_clause([], [db.beacons.c.name]) is None
+
+
+def test_rank_order_puts_prefixes_first_then_similarity():
+    prefix, similarity, pk = [str(compiled(c)) for c in rank_order(
+        [u'ab'], [db.listeners.c.name, db.listeners.c.id],
+        db.listeners.c.id)]
+    assert prefix.startswith('CASE WHEN (lower(listeners.name) LIKE ')
+    assert similarity == (
+        'greatest(similarity(lower(listeners.name), lower(%(lower_1)s)), '
+        'similarity(lower(listeners.id), lower(%(lower_2)s))) DESC')
+    assert pk == 'listeners.id'
@@ -0,0 +1,67 @@
+from calendar import timegm
+from datetime import datetime
+import json
+
+import pytest
+from pytz import UTC, timezone
+
+from c3next.models import Beacon, BytesEncoder
+from c3next.serializer import ListProducer, dumps, epoch, write_list
+
+
+class FakeRequest(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+def test_epoch_matches_timegm():
+    for dt in [datetime(2016, 10, 3, 12, 30, 15, 999999, tzinfo=UTC),
+               timezone('US/Eastern').localize(datetime(2016, 3, 13, 3)),
+               datetime(1969, 12, 31, 23, 59, 59, 500000, tzinfo=UTC)]:
+        assert epoch(dt) == timegm(dt.utctimetuple())
+    assert epoch(datetime(1970, 1, 2)) == 86400
+
+
+def beacon():
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': u'010203040506', 'name': u'bé', 'key': b'\x01',
+                'last_seen': datetime(2016, 10, 3, tzinfo=UTC)})
+    return Beacon(row=row)
+
+
+def test_container_json():
+    b = beacon()
+    flat = json.loads(b.flatten())
+    assert flat['last_seen'] == 1475452800 and flat['name'] == u'bé'
+    assert 'key' not in flat and 'clock' not in flat
+    assert json.loads(dumps([b])) == [flat]
+    assert json.loads(json.dumps(b, cls=BytesEncoder)) == flat
+    assert json.loads(dumps({'raw': b'\xff'})) == {'raw': u'ff'}
+
+
+def test_unknown_types_raise_type_error():
+    with pytest.raises(TypeError):
+        dumps(object())
+    with pytest.raises(TypeError):
+        json.dumps(object(), cls=BytesEncoder)
+
+
+def test_list_producer_chunks():
+    request = FakeRequest()
+    items = [{'n': i} for i in range(5)]
+    producer = ListProducer(request, items, chunk_size=2,
+                            prefix=b'{"objects":', suffix=b'}')
+    list(producer._chunks())
+    assert len(request.written) == 4
+    assert json.loads(b''.join(request.written)) == {'objects': items}
+
+    request = FakeRequest()
+    list(ListProducer(request, [], chunk_size=2)._chunks())
+    assert json.loads(b''.join(request.written)) == []
+
+
+def test_short_lists_are_returned_whole():
+    assert json.loads(write_list(None, [1, 2], b'[0,', b']')) == [0, [1, 2]]
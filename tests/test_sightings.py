@@ -0,0 +1,118 @@
+from datetime import date, datetime
+
+from pytz import UTC
+from twisted.internet import defer
+
+from c3next import db
+from c3next.sightings import SightingWriter, partition_ddl
+
+
+def test_partition_ddl_covers_one_utc_day():
+    ddl = partition_ddl(date(2016, 12, 31))
+    assert 'sightings_20161231' in ddl
+    assert "FROM ('2016-12-31 00:00+00') TO ('2017-01-01 00:00+00')" in ddl
+
+
+def test_writer_buffers_below_batch_size():
+    writer = SightingWriter(10, 1, 100)
+    writer.add(b'0a', u'L1', 1.0, 0.1, datetime.now(tz=UTC))
+    assert len(writer) == 1
+    assert writer.stats()['written'] == 0
+
+
+def test_writer_sheds_past_max_buffer():
+    writer = SightingWriter(10, 1, 2)
+    for _ in range(5):
+        writer.add(b'0a', u'L1', 1.0, 0.1, datetime.now(tz=UTC))
+    assert len(writer) == 2
+    assert writer.shed == 3
+
+
+class PartitionConnection(object):
+    """ Has partitions for existing days, default partition rows for
+    default_days, and fails statements containing fail """
+    def __init__(self, log, existing=(), default_days=(), fail=None):
+        self.log = log
+        self.existing = existing
+        self.default_days = default_days
+        self.fail = fail
+        self._result = None
+
+    def begin(self):
+        return defer.succeed(self)
+
+    def commit(self):
+        self.log.append('COMMIT')
+        return defer.succeed(None)
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+        return defer.succeed(None)
+
+    def close(self):
+        return defer.succeed(None)
+
+    def execute(self, query):
+        self.log.append(query)
+        if self.fail and self.fail in query:
+            return defer.fail(RuntimeError(query))
+        if query.startswith('SELECT to_regclass'):
+            self._result = any('sightings_{:%Y%m%d}'.format(d) in query
+                               for d in self.existing) or None
+        elif query.startswith('SELECT EXISTS'):
+            self._result = any("'{:%Y-%m-%d} 00:00".format(d) in query
+                               for d in self.default_days)
+        return defer.succeed(self)
+
+    def scalar(self):
+        return defer.succeed(self._result)
+
+    def fetchall(self):
+        return defer.succeed([(d,) for d in self.default_days])
+
+
+def partition_db(monkeypatch, **kwargs):
+    log = []
+    conn = PartitionConnection(log, **kwargs)
+    monkeypatch.setattr(db, 'get_connection', lambda: defer.succeed(conn))
+    monkeypatch.setattr(db, 'execute', conn.execute)
+    return conn, log
+
+
+def test_partitions_are_created_ahead(monkeypatch):
+    conn, log = partition_db(monkeypatch, existing=[date(2016, 12, 31)])
+    writer = SightingWriter(10, 1, 100, days_ahead=2)
+    writer.maintain_partitions(date(2016, 12, 31))
+    assert writer._partitions == {date(2016, 12, 31), date(2017, 1, 1),
+                                  date(2017, 1, 2)}
+    created = [q for q in log if q.startswith('CREATE')]
+    assert created == [partition_ddl(date(2017, 1, 1)),
+                       partition_ddl(date(2017, 1, 2))]
+
+
+def test_rows_in_the_default_partition_are_moved(monkeypatch):
+    day = date(2016, 12, 1)
+    conn, log = partition_db(monkeypatch, default_days=[day])
+    writer = SightingWriter(10, 1, 100, days_ahead=0)
+    writer.maintain_partitions(date(2016, 12, 31))
+    assert day in writer._partitions
+    start = log.index('ALTER TABLE sightings DETACH PARTITION '
+                      'sightings_default')
+    assert log[start + 1] == partition_ddl(day)
+    assert log[start + 2].startswith(
+        'INSERT INTO sightings_20161201 SELECT * FROM sightings_default')
+    assert log[start + 3].startswith('DELETE FROM sightings_default')
+    assert log[start + 4:start + 6] == [
+        'ALTER TABLE sightings ATTACH PARTITION sightings_default DEFAULT',
+        'COMMIT']
+
+
+def test_failed_partitions_are_rolled_back_and_retried(monkeypatch):
+    conn, log = partition_db(monkeypatch, fail='CREATE')
+    writer = SightingWriter(10, 1, 100, days_ahead=0)
+    writer.maintain_partitions(date(2016, 12, 31))
+    assert writer._partitions == set() and log[-1] == 'ROLLBACK'
+    conn.fail = None
+    writer.maintain_partitions(date(2016, 12, 31))
+    assert writer._partitions == {date(2016, 12, 31)}
+    assert log[-2:] == [partition_ddl(date(2016, 12, 31)), 'COMMIT']
@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+from c3next.models import Beacon
+from c3next.state import LocalStore, MmapStore
+
+
+def cached_beacon(store, b_id=b'\x01\x02\x03\x04\x05\x06'):
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': u'010203040506', 'name': u'old', 'clock': 1})
+    b = Beacon(row=row)
+    store.beacons[b_id] = b
+    return b
+
+
+def test_delete_uses_hex_id():
+    store = LocalStore()
+    b = cached_beacon(store)
+    b['clock'] = 2
+    seen = []
+    store.subscribe(lambda *args: seen.append(args))
+    store.delete('beacon', u'010203040506')
+    assert store.beacons == {}
+    assert b not in Beacon._dirty_set
+    assert seen == [('beacon', u'010203040506',
+                     b'\x01\x02\x03\x04\x05\x06', None)]
+
+
+def test_update_does_not_dirty():
+    store = LocalStore()
+    b = cached_beacon(store)
+    store.update('beacon', u'010203040506', {'name': u'new'})
+    assert b['name'] == u'new'
+    assert not b.dirty_p()
+
+
+def test_update_of_uncached_object_is_ignored():
+    store = LocalStore()
+    store.update('listener', u'Test', {'name': u'new'})
+    assert store.listeners == {}
+
+
+def mmap_pair(tmpdir, ring_size=4096):
+    path = str(tmpdir.join('state'))
+    web, listener = MmapStore(path, ring_size), MmapStore(path, ring_size)
+    # Both live in this process, pretend otherwise
+    listener._pid += 1
+    return web, listener
+
+
+def test_mmap_delivers_to_other_store(tmpdir):
+    web, listener = mmap_pair(tmpdir)
+    b = cached_beacon(listener)
+    web.update('beacon', u'010203040506', {'name': u'new'})
+    assert b['name'] == u'old'
+    listener.poll()
+    assert b['name'] == u'new'
+    web.delete('beacon', u'010203040506')
+    listener.poll()
+    assert listener.beacons == {}
+
+
+def test_mmap_skips_own_messages(tmpdir):
+    web, listener = mmap_pair(tmpdir)
+    seen = []
+    web.subscribe(lambda *args: seen.append(args))
+    web.delete('listener', u'Test')
+    web.poll()
+    assert seen == [('listener', u'Test', u'Test', None)]
+
+
+def test_mmap_ring_wraps(tmpdir):
+    web, listener = mmap_pair(tmpdir, ring_size=256)
+    seen = []
+    listener.subscribe(lambda kind, obj_id, key, fields: seen.append(key))
+    for i in range(40):
+        web.delete('listener', u'L{}'.format(i))
+        listener.poll()
+    assert seen == [u'L{}'.format(i) for i in range(40)]
+    assert listener.lost == 0
+
+
+def test_mmap_overrun_skips_ahead(tmpdir):
+    web, listener = mmap_pair(tmpdir, ring_size=256)
+    for i in range(40):
+        web.delete('listener', u'L{}'.format(i))
+    listener.poll()
+    assert listener.lost == 1
+    web.delete('listener', u'last')
+    seen = []
+    listener.subscribe(lambda kind, obj_id, key, fields: seen.append(key))
+    listener.poll()
+    assert seen == [u'last']
+
+
+def test_mmap_creates_a_private_directory(tmpdir):
+    path = str(tmpdir.join('run', 'state'))
+    MmapStore(path, 4096).close()
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_mmap_refuses_a_symlink(tmpdir):
+    target = tmpdir.join('target')
+    target.write('keep')
+    os.symlink(str(target), str(tmpdir.join('state')))
+    with pytest.raises(OSError):
+        MmapStore(str(tmpdir.join('state')), 4096)
+    assert target.read() == 'keep'
+
+
+def test_mmap_refuses_a_file_others_can_use(tmpdir):
+    path = tmpdir.join('state')
+    path.write('')
+    path.chmod(0o644)
+    with pytest.raises(OSError):
+        MmapStore(str(path), 4096)
+
+
+def test_mmap_refuses_a_shared_directory(tmpdir):
+    shared = tmpdir.mkdir('shared')
+    shared.chmod(0o1777)
+    with pytest.raises(OSError):
+        MmapStore(str(shared.join('state')), 4096)
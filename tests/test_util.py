@@ -0,0 +1,41 @@
+from c3next.util import KeyCache, derive_key
+
+
+def test_key_cache_derives_key():
+    cache = KeyCache(2)
+    assert cache.get(b'\x00' * 6) == derive_key(b'\x00' * 6)
+
+
+def test_key_cache_counts_hits_and_misses():
+    cache = KeyCache(2)
+    cache.get(b'a')
+    cache.get(b'a')
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key_cache_evicts_least_recently_used():
+    cache = KeyCache(2)
+    cache.get(b'a')
+    cache.get(b'b')
+    cache.get(b'a')
+    cache.get(b'c')
+    assert len(cache) == 2
+    cache.get(b'a')
+    assert cache.misses == 3
+    cache.get(b'b')
+    assert cache.misses == 4
+
+
+def test_key_cache_of_size_zero_caches_nothing():
+    cache = KeyCache(0)
+    assert cache.get(b'a') == derive_key(b'a')
+    assert cache.get(b'a') == derive_key(b'a')
+    assert (len(cache), cache.hits, cache.misses) == (0, 0, 2)
+
+
+def test_key_cache_invalidate():
+    cache = KeyCache(2)
+    cache.get(b'a')
+    cache.invalidate(b'a')
+    cache.invalidate(b'missing')
+    assert len(cache) == 0
@@ -0,0 +1,277 @@
+from datetime import datetime, timedelta
+import json
+
+from pytz import UTC
+from sqlalchemy.dialects import postgresql
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from c3next import db
+from c3next.config import BEACON_LISTENER_TIMEOUT, DEFAULT_PER_PAGE
+from c3next.models import Beacon
+from c3next.search import NgramIndex
+from c3next.state import STATE
+from c3next.serializer import dumps
+from c3next.web import (BEACON_LIST, Keyset, Ranked, b_detail,
+                        cached_beacon_rows, live_page, missing, query_filter)
+
+NOW = datetime.now(tz=UTC)
+
+
+def beacon(b_id, listener_id, age):
+    row = {c.name: None for c in Beacon._table.columns}
+    row.update({'id': b_id, 'name': b_id, 'listener_id': listener_id,
+                'last_seen': NOW - timedelta(seconds=age)})
+    b = Beacon(row=row)
+    b.set_missing(age > BEACON_LISTENER_TIMEOUT.total_seconds())
+    return b
+
+
+BEACONS = [beacon(u'b{}'.format(i), u'L{}'.format(i % 2), i * 10 + 5)
+           for i in range(10)]
+
+
+def get(args=None, headers=None, objects=BEACONS):
+    request = DummyRequest([b'beacons.json'])
+    request.uri = b'/beacons.json'
+    request.args = {k.encode(): [v.encode() for v in vs]
+                    for (k, vs) in (args or {}).items()}
+    for (k, v) in (headers or {}).items():
+        request.requestHeaders.setRawHeaders(k, [v])
+    body = live_page(request, objects)
+    return request, json.loads(body) if body else None
+
+
+def ids(result):
+    return [o['id'] for o in result['objects']]
+
+
+def test_filters():
+    _, result = get({'listener': ['L1'], 'limit': ['100']})
+    assert ids(result) == [u'b1', u'b3', u'b5', u'b7', u'b9']
+    _, result = get({'missing': ['1'], 'limit': ['100']})
+    assert ids(result) == [u'b3', u'b4', u'b5', u'b6', u'b7', u'b8', u'b9']
+    since = (NOW - timedelta(seconds=30)).timestamp()
+    _, result = get({'since': [str(since)]})
+    assert ids(result) == [u'b0', u'b1', u'b2']
+
+
+def test_pagination():
+    _, result = get({'limit': ['4'], 'p': ['3']})
+    assert ids(result) == [u'b8', u'b9']
+    assert result['pagination'] == {'per_page': 4, 'cur_page': 3,
+                                    'num_objects': 10, 'num_pages': 3}
+    _, result = get({'limit': ['4'], 'offset': ['4']})
+    assert ids(result) == [u'b4', u'b5', u'b6', u'b7']
+    assert result['pagination']['cur_page'] == 2
+
+
+def test_etag_not_modified_until_change():
+    objects = [beacon(u'x{}'.format(i), u'L', 0) for i in range(3)]
+    request, _ = get(objects=objects)
+    etag = request.responseHeaders.getRawHeaders('ETag')[0]
+    request, body = get(headers={'If-None-Match': etag}, objects=objects)
+    assert request.responseCode == 304 and body is None
+    objects[1]['name'] = u'renamed'
+    request, body = get(headers={'If-None-Match': etag}, objects=objects)
+    assert request.responseCode != 304 and len(body['objects']) == 3
+    request, body = get(headers={'If-None-Match': etag},
+                        objects=objects[:2])
+    assert request.responseCode != 304
+
+
+def test_only_the_etag_validates():
+    request, _ = get()
+    assert not request.responseHeaders.hasHeader('Last-Modified')
+    # An edit leaves last_seen alone, it must not be hidden by a date
+    request, body = get(headers={
+        'If-Modified-Since': 'Thu, 01 Jan 2099 00:00:00 GMT'})
+    assert request.responseCode != 304 and len(body['objects']) == 10
+
+
+def test_zero_limit_gets_the_default_page():
+    _, result = get({'limit': ['0']}, objects=BEACONS[::-1])
+    assert result['pagination']['per_page'] == DEFAULT_PER_PAGE
+    assert ids(result) == [u'b{}'.format(i) for i in range(10)]
+
+
+def compiled(query):
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+def test_keyset_cursor_round_trip():
+    row = {'id': u'b1', 'last_seen': NOW}
+    keyset = Keyset(db.beacons, 'last_seen')
+    restored, values = Keyset.from_cursor(db.beacons, keyset.cursor(row))
+    assert restored.sort == 'last_seen'
+    assert values[1] == u'b1'
+    assert abs((values[0] - NOW).total_seconds()) < 1e-3
+
+
+def test_keyset_seek_by_last_seen_is_descending():
+    keyset = Keyset(db.beacons, 'last_seen')
+    sql = compiled(keyset.seek(db.beacons.select(), [NOW, u'b1']))
+    assert ') < (' in sql
+    assert sql.endswith('beacons.id DESC')
+    sql = compiled(Keyset(db.beacons, 'last_seen').seek(
+        db.beacons.select(), [NOW, u'b1'], backwards=True))
+    assert ') > (' in sql
+
+
+def test_keyset_page_cursors():
+    rows = [{'id': u'b{}'.format(i), 'last_seen': None} for i in range(4)]
+    keyset = Keyset(db.beacons)
+    pagination = {'per_page': 3, 'cur_page': 1}
+    page = keyset.page(rows, pagination)
+    assert [r['id'] for r in page] == [u'b0', u'b1', u'b2']
+    assert pagination['prev'] is None
+    assert Keyset.from_cursor(db.beacons, pagination['next'])[1] == [u'b2']
+
+    # Going back from b3 the query runs in reverse, b2 b1 b0 and more
+    keyset.backwards = True
+    pagination = {'per_page': 2, 'cur_page': 2}
+    page = keyset.page(list(reversed(rows[:3])), pagination)
+    assert [r['id'] for r in page] == [u'b1', u'b2']
+    assert Keyset.from_cursor(db.beacons, pagination['prev'])[1] == [u'b1']
+    assert Keyset.from_cursor(db.beacons, pagination['next'])[1] == [u'b2']
+
+
+def test_query_filter_uses_keyset_cursor():
+    cursor = Keyset(db.beacons).cursor({'id': u'b9'})
+    request, _ = get()
+    request.args = {b'after': [cursor.encode()], b'limit': [b'5']}
+    query, pagination, search, where = query_filter(
+        request, db.beacons.select(), [db.beacons.c.name], db.beacons)
+    sql = compiled(query)
+    assert 'OFFSET' not in sql and '(beacons.id) > (' in sql
+    assert where is None and search == u''
+    assert pagination['per_page'] == 5
+
+
+def test_query_filter_ignores_bad_cursors():
+    for cursor in (b'%%%', b'bm90IGpzb24=', b'WyJpZCJd',
+                   Keyset(db.beacons).cursor({'id': 1}).encode()):
+        request, _ = get()
+        request.args = {b'after': [cursor], b'sort': [b'last_seen']}
+        query, pagination, _, _ = query_filter(
+            request, db.beacons.select(), [db.beacons.c.name], db.beacons)
+        assert pagination['keyset'].sort == 'last_seen'
+        assert '(beacons.id) >' not in compiled(query)
+
+
+def test_query_filter_unknown_sort_is_by_id():
+    request, _ = get()
+    request.args = {b'sort': [b'bogus']}
+    _, pagination, _, _ = query_filter(
+        request, db.beacons.select(), [db.beacons.c.name], db.beacons)
+    assert pagination['keyset'].sort == 'id'
+
+
+def test_page_links_keep_search_and_sort():
+    request, _ = get()
+    request.args = {b'search': [b'a b'], b'sort': [b'last_seen'],
+                    b'p': [b'3']}
+    _, pagination, _, _ = query_filter(
+        request, db.beacons.select(), [db.beacons.c.name], db.beacons)
+    assert pagination['args'] == '&search=a+b&sort=last_seen'
+
+
+def test_query_filter_ranks_searches():
+    request, _ = get()
+    request.args = {b'search': [b'x'], b'p': [b'2'], b'limit': [b'5']}
+    query, pagination, search, where = query_filter(
+        request, db.beacons.select(), [db.beacons.c.name], db.beacons)
+    sql = compiled(query)
+    assert 'similarity(lower(beacons.name), lower(' in sql
+    assert 'OFFSET' in sql and isinstance(pagination['keyset'], Ranked)
+    assert where is not None and search == u'x'
+
+
+def test_live_search_is_ranked():
+    index = NgramIndex({b.stamp: b for b in BEACONS})
+    request = DummyRequest([b'beacons.json'])
+    request.args = {b'search': [b'1'], b'listener': [b'L1']}
+    result = json.loads(live_page(request, BEACONS, index))
+    assert ids(result) == [u'b1']
+
+
+def test_beacon_list_is_one_joined_query():
+    sql = compiled(BEACON_LIST)
+    assert 'LEFT OUTER JOIN listeners' in sql
+    assert 'listeners.name AS listener_name' in sql
+    assert 'beacons.key,' not in sql and 'beacons.clock,' not in sql
+
+
+def test_missing_filter():
+    assert missing({'id': u'ff01', 'last_seen': None})
+    assert missing({'id': u'ff01', 'last_seen': NOW - timedelta(days=1)})
+    assert not missing({'id': u'ff01', 'last_seen': datetime.now(tz=UTC)})
+    b = beacon(u'ff01', None, 0)
+    STATE.beacons[b'\xff\x01'] = b
+    try:
+        b.set_missing(True)
+        assert missing({'id': u'ff01', 'last_seen': datetime.now(tz=UTC)})
+    finally:
+        del STATE.beacons[b'\xff\x01']
+
+
+class DetailConnection(object):
+    """ Finds one beacon row, updates it, and logs the commit """
+    def __init__(self, log, fail_commit):
+        self.log = log
+        self.fail_commit = fail_commit
+        self.rowcount = 1
+
+    def begin(self):
+        return defer.succeed(self)
+
+    def execute(self, query):
+        self.log.append(str(query).split()[0])
+        return defer.succeed(self)
+
+    def fetchall(self):
+        row = {c.name: None for c in Beacon._table.columns}
+        row.update({'id': u'b1', 'name': u'old', 'key': b'', 'dk': 0,
+                    'clock': 1})
+        return defer.succeed([row])
+
+    def commit(self):
+        self.log.append('COMMIT')
+        if self.fail_commit:
+            return defer.fail(RuntimeError("Commit failed"))
+        return defer.succeed(None)
+
+    def close(self):
+        return defer.succeed(None)
+
+
+def rename(monkeypatch, fail_commit=False):
+    log = []
+    monkeypatch.setattr(db, 'get_connection', lambda: defer.succeed(
+        DetailConnection(log, fail_commit)))
+    monkeypatch.setattr(STATE, 'update', lambda *args: log.append(args))
+    request = DummyRequest([b'beacons', b'b1'])
+    request.method = b'POST'
+    request.args = {b'name': [b'new']}
+    results = []
+    b_detail(request, b_id=u'b1').addBoth(results.append)
+    return log, results
+
+
+def test_renames_reach_the_caches_after_the_commit(monkeypatch):
+    log, _ = rename(monkeypatch)
+    assert log == ['SELECT', 'UPDATE', 'COMMIT',
+                   ('beacon', u'b1', {'name': u'new'})]
+
+
+def test_failed_renames_do_not_reach_the_caches(monkeypatch):
+    log, results = rename(monkeypatch, fail_commit=True)
+    assert log == ['SELECT', 'UPDATE', 'COMMIT']
+    results[0].trap(RuntimeError)
+
+
+def test_cached_rows_encode_like_db_rows():
+    row, = cached_beacon_rows(BEACONS[:1])
+    db_row = {'last_seen': NOW - timedelta(seconds=5)}
+    assert json.loads(dumps(row))['last_seen'] == \
+        json.loads(dumps(db_row))['last_seen']